@@ -15,8 +15,11 @@ import corrections.MUO as MUO
 
 class Selector(SelectionProcessor):
     """Processor for dilepton ttbar event selection and minitree creation."""
-    def __init__(self, selection_cfg):
-        super().__init__(selection_cfg)
+    # pre_selection only defines the channels, its output can be cached
+    preselection_state = ("channels", "gen_channels")
+
+    def __init__(self, selection_cfg, mode="eager"):
+        super().__init__(selection_cfg, mode=mode)
         self.step_tag = "ttBar_treeVariables_"
         # Additional initialization for dilepton selection can be added here
 
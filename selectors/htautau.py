@@ -52,8 +52,8 @@ def find_vbf_jets_kernel(events_jets, builder):
 
 class Selector(SelectionProcessor):
     """Processor for dilepton ttbar event selection and tree creation."""
-    def __init__(self, selection_cfg):
-        super().__init__(selection_cfg)
+    def __init__(self, selection_cfg, mode="eager"):
+        super().__init__(selection_cfg, mode=mode)
         self.step_tag = "tree_variables_"
         # Additional initialization can be added here
 
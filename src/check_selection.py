@@ -0,0 +1,129 @@
+"""
+    Check that the selector gives identical outputs on one core, in chunks on
+    several cores with the coffea Runner executors and as a dask task graph
+"""
+import argparse
+import awkward as ak
+import dask
+import numpy as np
+from coffea import processor
+from coffea.nanoevents import NanoAODSchema
+import common.utils as utils
+from common.file_context import NanoAODFile
+from common.pipeline import chunk_ranges
+from selection.accumulators import TreeColumns, materialize_output
+from run_processor import file_cfg, load_cfg, load_processor, parse_metadata
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Check that the selection is deterministic "
+                                     "when processed in chunks on several cores "
+                                     "and in dask mode")
+    parser.add_argument("input", type=str, help="Input NanoAOD file")
+    parser.add_argument("--metadata", type=str, default="",
+                        help="Metadata, e.g. era:2024,process:DYto2L,isData:False,isSignal:False")
+    parser.add_argument("--chunksize", type=int, default=100000,
+                        help="Entries per chunk of the Runner and per dask partition "
+                             "(default: 100000)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of processes of the futures executor (default: 4)")
+    return parser.parse_args()
+
+def run_file(selector_class, tree_cfg):
+    """Output of the selector on the whole file in one go, as run_processor does."""
+    with NanoAODFile(tree_cfg["file"]) as input_file:
+        tree_cfg = dict(tree_cfg, input_file=input_file)
+        events = input_file.events(metadata={})
+        selector = selector_class(tree_cfg)
+        return materialize_output(selector.postprocess(selector.process(events)))
+
+def run_chunks(selector_class, tree_cfg, executor, chunksize):
+    """Output of the selector run by a coffea Runner on chunks of the file."""
+    fileset = {"check": {"files": {tree_cfg["file"]: "Events"}, "metadata": {}}}
+    runner = processor.Runner(executor=executor, schema=NanoAODSchema,
+                              chunksize=chunksize)
+    return runner(fileset, processor_instance=selector_class(tree_cfg))
+
+def run_dask(selector_class, tree_cfg, partition_size):
+    """
+    Output of the selector built in dask mode, as in the dask mode of
+    run_processor, on partitions of the file computed by the local scheduler.
+    """
+    with NanoAODFile(tree_cfg["file"]) as input_file:
+        steps = chunk_ranges(0, input_file.num_entries, partition_size)
+        events = input_file.dask_events(steps, metadata={})
+    selector = selector_class(tree_cfg, mode="dask")
+    output = selector.process(events)
+    # TreeColumns are not traversed by dask, their branches are computed as dicts
+    trees = {chan: {key: dict(value) for key, value in chan_trees.items()
+                    if isinstance(value, TreeColumns)}
+             for chan, chan_trees in output.get("tree", {}).items()}
+    output, trees = dask.compute(output, trees)
+    for chan, chan_trees in trees.items():
+        for key, branches in chan_trees.items():
+            output["tree"][chan][key] = TreeColumns(branches)
+    return selector.postprocess(output)
+
+def compare_outputs(reference, output, name=""):
+    """
+    Differences between two selection outputs: channels, weightedEvents, step
+    trees and cutflows. Summed weights may differ by the rounding of the sums.
+
+    Returns:
+        :return: list of the differences, empty if the outputs are identical
+    """
+    differences = []
+    if set(reference["channels"]) != set(output["channels"]):
+        differences.append(f"{name}channels: {sorted(reference['channels'])} != "
+                           f"{sorted(output['channels'])}")
+    for key, histo in (reference["weightedEvents"] or {}).items():
+        other = (output["weightedEvents"] or {}).get(key)
+        if other is None or not np.allclose(histo.values(), other.values(), rtol=1e-9):
+            differences.append(f"{name}weightedEvents/{key} differs")
+    for chan, chan_tree in sorted(reference.get("tree", {}).items()):
+        other_tree = output.get("tree", {}).get(chan, {})
+        for key in sorted(set(chan_tree) | set(other_tree)):
+            if key not in chan_tree or key not in other_tree:
+                differences.append(f"{name}{chan}/{key} missing in one of the outputs")
+                continue
+            value, other = chan_tree[key], other_tree[key]
+            if isinstance(value, TreeColumns):
+                if set(value) != set(other):
+                    differences.append(f"{name}{chan}/{key}: branches differ")
+                    continue
+                for branch in value:
+                    if not ak.array_equal(value[branch], other[branch], equal_nan=True):
+                        differences.append(f"{name}{chan}/{key}/{branch} differs")
+            elif not np.allclose(value.values(flow=True), other.values(flow=True),
+                                 rtol=1e-9, equal_nan=True):
+                differences.append(f"{name}{chan}/{key} differs")
+    return differences
+
+def main():
+    """Main function"""
+    args = argparser()
+    fw_config = utils.parse_main_config()
+    cfg = load_cfg(fw_config["fw_dir"], argparse.Namespace(
+        metadata=parse_metadata(args.metadata), output_format=""))
+    tree_cfg = file_cfg(cfg, {"input": args.input, "output": "", "output_histos": ""})
+    selector_class = load_processor(fw_config)
+
+    print("Processing the whole file...")
+    reference = run_file(selector_class, tree_cfg)
+    differences = []
+    for name, executor in [("iterative", processor.IterativeExecutor()),
+                           (f"futures({args.workers})",
+                            processor.FuturesExecutor(workers=args.workers))]:
+        print(f"Processing chunks of {args.chunksize} entries with the {name} executor...")
+        output = run_chunks(selector_class, tree_cfg, executor, args.chunksize)
+        differences += compare_outputs(reference, output, f"{name}: ")
+    print(f"Processing partitions of {args.chunksize} entries as a dask task graph...")
+    differences += compare_outputs(
+        reference, run_dask(selector_class, tree_cfg, args.chunksize), "dask: ")
+    if differences:
+        raise RuntimeError("Chunked outputs differ from the whole-file output:\n"
+                           + "\n".join(differences))
+    print("Outputs are identical.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark TTree against RNTuple output for the selection trees.
+Compares file size, write time and read time for the same step snapshot.
+"""
+import argparse
+import os
+import time
+import numpy as np
+import awkward as ak
+import uproot
+from common.output_formats import OUTPUT_FORMATS, write_tree, read_tree, group_record_names
+
+def synthetic_snapshot(n_events, seed=42):
+    """
+    Create a snapshot-like set of branches with jagged collections.
+
+    Args:
+        :param n_events: Number of events
+        :param seed: Random seed
+        :return: dict of branch name -> awkward array
+    """
+    rng = np.random.default_rng(seed)
+    branches = {"eventNumber": ak.Array(np.arange(n_events, dtype=np.uint64))}
+    for collection, mean_size in [("jets", 5), ("tau", 2), ("genParticle", 40)]:
+        counts = rng.poisson(mean_size, n_events)
+        total = int(counts.sum())
+        branches[collection] = ak.unflatten(ak.zip({
+            "pt": rng.exponential(40.0, total),
+            "eta": rng.uniform(-2.5, 2.5, total),
+            "phi": rng.uniform(-np.pi, np.pi, total),
+            "mass": rng.exponential(5.0, total),
+            "pdgId": rng.integers(-25, 25, total, dtype=np.int32),
+        }), counts)
+    branches["eventWeight"] = ak.Array(rng.normal(1.0, 0.1, n_events))
+    branches["mjj"] = ak.Array(rng.exponential(500.0, n_events))
+    return branches
+
+def benchmark(branches, output_dir, output_cfg, repeat=3):
+    """
+    Write and read the branches in each output format.
+
+    Args:
+        :param branches: dict of branch name -> awkward array
+        :param output_dir: Directory for the temporary files
+        :param output_cfg: Content of config/selection/output.yml ("Output" block)
+        :param repeat: Number of repetitions, the best time is kept
+        :return: dict of format -> {"size", "write", "read"}
+    """
+    results = {}
+    for output_format in OUTPUT_FORMATS:
+        cfg = dict(output_cfg, format=output_format)
+        path = os.path.join(output_dir, f"benchmark_{output_format}.root")
+        write_times, read_times = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with uproot.recreate(path) as fout:
+                write_tree(fout, "tree_variables_SR", branches, cfg)
+            write_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            read_tree(path, "tree_variables_SR")
+            read_times.append(time.perf_counter() - start)
+        results[output_format] = {
+            "size": os.path.getsize(path),
+            "write": min(write_times),
+            "read": min(read_times),
+        }
+        os.remove(path)
+    return results
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark TTree and RNTuple output formats")
+    parser.add_argument("--input", type=str, default="",
+                        help="Existing selection output file (default: synthetic events)")
+    parser.add_argument("--tree", type=str, default="tree_variables_SR",
+                        help="Tree to read from the input file")
+    parser.add_argument("--events", type=int, default=200000,
+                        help="Number of synthetic events (default: 200000)")
+    parser.add_argument("--cluster_entries", type=int, default=100000,
+                        help="Entries per RNTuple cluster (default: 100000)")
+    parser.add_argument("--cluster_bytes", type=int, default=0,
+                        help="Target RNTuple cluster size in bytes (default: disabled)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per format")
+    parser.add_argument("--output_dir", type=str, default="/tmp",
+                        help="Directory for the temporary files")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    args = argparser()
+    if args.input:
+        branches = group_record_names(read_tree(args.input, args.tree))
+    else:
+        branches = synthetic_snapshot(args.events)
+    output_cfg = {"rntuple": {"cluster_entries": args.cluster_entries,
+                              "cluster_bytes": args.cluster_bytes}}
+    results = benchmark(branches, args.output_dir, output_cfg, args.repeat)
+
+    print(f"{'format':<10}{'size [MB]':>12}{'write [s]':>12}{'read [s]':>12}")
+    for output_format, res in results.items():
+        print(f"{output_format:<10}{res['size']/1e6:>12.2f}"
+              f"{res['write']:>12.3f}{res['read']:>12.3f}")
+
+if __name__ == "__main__":
+    main()
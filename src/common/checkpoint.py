@@ -0,0 +1,129 @@
+"""
+Chunk-level checkpoints of a selection job.
+The outputs of the processed chunks are stored as lz4-compressed pickles next to
+the status file, with a JSON state of the entries done so far and the partial
+cutflow sums. A job that is rerun after preemption resumes from the first
+unfinished entry, and make_selection.py reads the state to find completed jobs.
+
+Layout: selection_status/<file>[_entries<start>-<stop>]_checkpoint/
+    state.json, chunk_<start>-<stop>.pkl.lz4 ...
+"""
+import json
+import os
+import cloudpickle
+import lz4.frame
+
+STATE = "state.json"
+
+def checkpoint_dir(fw_dir, input_file, shard=""):
+    """Checkpoint directory of an input file (or of a shard of it) in selection_status."""
+    return fw_dir + "/selection_status/" + \
+        input_file.split("/")[-1].replace(".root", f"{shard}_checkpoint")
+
+def read_state(path):
+    """State of a checkpoint directory, None if there is none or it is unreadable."""
+    try:
+        with open(os.path.join(path, STATE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_atomic(path, data):
+    """Write bytes to path through a temporary file, so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def cutflow_sums(output):
+    """Cutflow values per channel of a chunk output, as lists for the JSON state."""
+    sums = {}
+    for chan, chan_trees in output.get("tree", {}).items():
+        for key, value in chan_trees.items():
+            if key.startswith("cutflow_") and "efficiency" not in key:
+                sums.setdefault(chan, {})[key] = [float(v) for v in value.values()]
+    return sums
+
+class Checkpoint:
+    """
+    Checkpoint of the chunks of one job, reset if the job input, range, or the
+    selection code and configuration changed.
+    """
+    def __init__(self, path, source, entry_start=0, entry_stop=None, selection=None):
+        """
+        Load the checkpoint in path, or start a new one.
+
+        Args:
+            :param path: Checkpoint directory
+            :param source: Input file of the job
+            :param entry_start: First entry of the job
+            :param entry_stop: Entry after the last one of the job (None for the end)
+            :param selection: Hash of the selector code and configuration
+        """
+        self.path = path
+        job = {"source": source, "entry_start": entry_start, "entry_stop": entry_stop,
+               "selection": selection}
+        state = read_state(path)
+        if state is not None and state["completed"]:
+            # A completed job that is run again is processed from the start
+            state = None
+        if state is not None and ({key: state.get(key) for key in job} != job or any(
+                not os.path.exists(os.path.join(path, chunk["file"]))
+                for chunk in state["chunks"])):
+            print(f"WARNING: Checkpoint {path} does not match the job, starting over.")
+            state = None
+        if state is None:
+            state = dict(job, next_entry=entry_start, chunks=[], cutflows={}, completed=False)
+        self.state = state
+
+    @property
+    def next_entry(self):
+        """First entry not processed yet."""
+        return self.state["next_entry"]
+
+    @property
+    def completed(self):
+        """Whether the outputs of the job were written."""
+        return self.state["completed"]
+
+    def save(self):
+        """Write the state atomically."""
+        os.makedirs(self.path, exist_ok=True)
+        write_atomic(os.path.join(self.path, STATE),
+                     json.dumps(self.state, indent=1).encode("utf-8"))
+
+    def save_chunk(self, chunk, output):
+        """Store the output of a processed chunk, then record it in the state."""
+        os.makedirs(self.path, exist_ok=True)
+        filename = f"chunk_{chunk[0]}-{chunk[1]}.pkl.lz4"
+        write_atomic(os.path.join(self.path, filename),
+                     lz4.frame.compress(cloudpickle.dumps(output)))
+        self.state["chunks"].append({"entry_start": chunk[0], "entry_stop": chunk[1],
+                                     "file": filename})
+        self.state["next_entry"] = chunk[1]
+        for chan, cutflows in cutflow_sums(output).items():
+            chan_sums = self.state["cutflows"].setdefault(chan, {})
+            for key, values in cutflows.items():
+                chan_sums[key] = [a + b for a, b in zip(chan_sums[key], values)] \
+                    if key in chan_sums else values
+        self.save()
+
+    def outputs(self):
+        """Outputs of the chunks processed so far, in entry order."""
+        outputs = []
+        for chunk in self.state["chunks"]:
+            with open(os.path.join(self.path, chunk["file"]), "rb") as f:
+                outputs.append(cloudpickle.loads(lz4.frame.decompress(f.read())))
+        return outputs
+
+    def finish(self):
+        """Mark the job completed and remove the chunk outputs, which are now written."""
+        for chunk in self.state["chunks"]:
+            chunk_path = os.path.join(self.path, chunk["file"])
+            if os.path.exists(chunk_path):
+                os.remove(chunk_path)
+        self.state["chunks"] = []
+        self.state["completed"] = True
+        self.save()
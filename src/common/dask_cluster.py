@@ -0,0 +1,42 @@
+"""
+Dask clients of the dask mode of run_processor.py and make_plotting.py.
+The dask_scheduler key of main.cfg (or --dask_scheduler) selects where the task
+graphs are computed: "local" starts a LocalCluster on this node, for testing,
+and the address of a running scheduler (e.g. tcp://host:8786, started by
+dask-jobqueue or by hand on the cluster) scales the jobs out to its workers.
+"""
+from dask.distributed import Client
+from common.pipeline import available_cpus
+
+PARTITION_SIZE = 100000
+
+def dask_cfg(main_config, scheduler=None):
+    """
+    Dask settings from main.cfg, the scheduler from the command line if given.
+
+    Returns:
+        :return: dict with scheduler, workers and partition_size, or None if
+                 no scheduler is configured
+    """
+    if scheduler is None:
+        scheduler = main_config.get("dask_scheduler", "")
+    if scheduler == "":
+        return None
+    return {
+        "scheduler": scheduler,
+        "workers": int(main_config.get("dask_workers") or 0),
+        "partition_size": int(main_config.get("dask_partition_size") or PARTITION_SIZE),
+    }
+
+def start_client(cfg):
+    """
+    Client of the configured scheduler, set as the default scheduler of dask.compute.
+    A local cluster has one single-threaded worker per available CPU unless
+    workers is set.
+    """
+    if cfg["scheduler"] == "local":
+        workers = cfg["workers"] or available_cpus()
+        print(f"Starting a local dask cluster with {workers} workers...")
+        return Client(n_workers=workers, threads_per_worker=1)
+    print(f"Connecting to the dask scheduler at {cfg['scheduler']}...")
+    return Client(cfg["scheduler"])
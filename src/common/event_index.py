@@ -0,0 +1,182 @@
+"""
+Sorted index of the events in the output trees.
+Each job writes the (run, luminosityBlock, event) of every entry of its step trees
+with the file, tree and entry where it is stored. The indexes of many jobs are
+merged into one, and events are looked up by binary search instead of scanning
+every output file.
+"""
+import argparse
+import numpy as np
+
+EXTENSION = ".evtidx"
+KEY_DTYPE = np.dtype([("run", "<u4"), ("luminosityBlock", "<u4"), ("event", "<u8")])
+# Branches of the event identifiers in snapshot and friend step trees
+KEY_BRANCHES = [("runNumber", "lumiBlock", "eventNumber"), ("run", "luminosityBlock", "event")]
+
+def tree_keys(branches):
+    """
+    Event identifiers of a step tree as a KEY_DTYPE array, or None if the tree
+    does not store them.
+    """
+    for names in KEY_BRANCHES:
+        if all(name in branches for name in names):
+            keys = np.empty(len(branches[names[0]]), dtype=KEY_DTYPE)
+            for field, name in zip(KEY_DTYPE.names, names):
+                keys[field] = np.asarray(branches[name])
+            return keys
+    return None
+
+class EventIndex:
+    """
+    Sorted event identifiers with the file, tree and entry of each one.
+    Files and trees are stored once, in the files and trees tables.
+    """
+    def __init__(self, keys=None, file_ids=None, tree_ids=None, entries=None,
+                 files=None, trees=None):
+        """Initialize from (possibly unsorted) columns, empty by default."""
+        self.keys = np.empty(0, dtype=KEY_DTYPE) if keys is None else keys
+        self.file_ids = np.empty(0, dtype=np.uint32) if file_ids is None else file_ids
+        self.tree_ids = np.empty(0, dtype=np.uint32) if tree_ids is None else tree_ids
+        self.entries = np.empty(0, dtype=np.uint64) if entries is None else entries
+        self.files = list(files or [])
+        self.trees = list(trees or [])
+        self._sort()
+
+    def _sort(self):
+        order = np.argsort(self.keys, kind="stable")
+        self.keys = self.keys[order]
+        self.file_ids = self.file_ids[order]
+        self.tree_ids = self.tree_ids[order]
+        self.entries = self.entries[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_trees(cls, trees):
+        """
+        Index of step trees.
+
+        Args:
+            :param trees: iterable of (file, tree name, dict of branches)
+        """
+        parts = []
+        files, tree_names = [], []
+        for filename, tree_name, branches in trees:
+            keys = tree_keys(branches)
+            if keys is None or len(keys) == 0:
+                continue
+            if filename not in files:
+                files.append(filename)
+            if tree_name not in tree_names:
+                tree_names.append(tree_name)
+            parts.append((keys, files.index(filename), tree_names.index(tree_name)))
+        if not parts:
+            return cls()
+        return cls(
+            np.concatenate([keys for keys, _, _ in parts]),
+            np.concatenate([np.full(len(keys), file_id, dtype=np.uint32)
+                            for keys, file_id, _ in parts]),
+            np.concatenate([np.full(len(keys), tree_id, dtype=np.uint32)
+                            for keys, _, tree_id in parts]),
+            np.concatenate([np.arange(len(keys), dtype=np.uint64) for keys, _, _ in parts]),
+            files, tree_names,
+        )
+
+    @classmethod
+    def merge(cls, indexes):
+        """Merge several indexes, the file and tree tables are joined."""
+        files, trees = {}, {}
+        parts = []
+        for index in indexes:
+            file_map = [files.setdefault(filename, len(files)) for filename in index.files]
+            tree_map = [trees.setdefault(tree_name, len(trees)) for tree_name in index.trees]
+            parts.append((index, np.array(file_map, dtype=np.uint32),
+                          np.array(tree_map, dtype=np.uint32)))
+        files, trees = list(files), list(trees)
+        parts = [part for part in parts if len(part[0]) > 0]
+        if not parts:
+            return cls(files=files, trees=trees)
+        return cls(
+            np.concatenate([index.keys for index, _, _ in parts]),
+            np.concatenate([file_map[index.file_ids] for index, file_map, _ in parts]),
+            np.concatenate([tree_map[index.tree_ids] for index, _, tree_map in parts]),
+            np.concatenate([index.entries for index, _, _ in parts]),
+            files, trees,
+        )
+
+    def save(self, path):
+        """Write the index as a compressed numpy archive."""
+        with open(path, "wb") as fout:
+            np.savez_compressed(fout, keys=self.keys, file_ids=self.file_ids,
+                                tree_ids=self.tree_ids, entries=self.entries,
+                                files=np.array(self.files, dtype=str),
+                                trees=np.array(self.trees, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written with save."""
+        with np.load(path) as data:
+            return cls(data["keys"], data["file_ids"], data["tree_ids"], data["entries"],
+                       data["files"].tolist(), data["trees"].tolist())
+
+    def lookup(self, events):
+        """
+        Locations of a batch of events.
+
+        Args:
+            :param events: iterable of (run, luminosityBlock, event)
+            :return: list with, for each event, a list of (file, tree, entry)
+        """
+        queries = np.array([tuple(event) for event in events], dtype=KEY_DTYPE)
+        starts = np.searchsorted(self.keys, queries, side="left")
+        stops = np.searchsorted(self.keys, queries, side="right")
+        return [
+            [(self.files[self.file_ids[i]], self.trees[self.tree_ids[i]], int(self.entries[i]))
+             for i in range(start, stop)]
+            for start, stop in zip(starts, stops)
+        ]
+
+def parse_event(text):
+    """(run, luminosityBlock, event) from "run:lumi:event"."""
+    run, lumi, event = text.strip().split(":")
+    return int(run), int(lumi), int(event)
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Merge event indexes and look up events")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    merge = subparsers.add_parser("merge", help="Merge the indexes of several jobs")
+    merge.add_argument("output", type=str)
+    merge.add_argument("inputs", type=str, nargs="+")
+    lookup = subparsers.add_parser("lookup", help="Find events given as run:lumi:event")
+    lookup.add_argument("index", type=str)
+    lookup.add_argument("events", type=str, nargs="*", help="Events as run:lumi:event")
+    lookup.add_argument("--events_file", type=str, default="",
+                        help="File with one run:lumi:event per line")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    args = argparser()
+    match args.action:
+        case "merge":
+            index = EventIndex.merge([EventIndex.load(path) for path in args.inputs])
+            index.save(args.output)
+            print(f"Merged {len(args.inputs)} indexes into {args.output} ({len(index)} entries)")
+        case "lookup":
+            events = [parse_event(event) for event in args.events]
+            if args.events_file != "":
+                with open(args.events_file, "r", encoding="utf-8") as f:
+                    events += [parse_event(line) for line in f
+                               if line.strip() and not line.strip().startswith("#")]
+            index = EventIndex.load(args.index)
+            for event, locations in zip(events, index.lookup(events)):
+                name = ":".join(str(value) for value in event)
+                if not locations:
+                    print(f"{name} not found")
+                for filename, tree_name, entry in locations:
+                    print(f"{name} {filename} {tree_name} {entry}")
+
+if __name__ == "__main__":
+    main()
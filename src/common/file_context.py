@@ -0,0 +1,112 @@
+"""
+Input NanoAOD file opened once for all the reads of a job.
+The Runs sums and the Events tree share the same uproot handle, so a remote file
+is only opened (and authenticated) once.
+"""
+import numpy as np
+import uproot
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+
+class NanoAODFile:
+    """Shared handle of an input NanoAOD file."""
+    def __init__(self, path, uproot_options=None):
+        """
+        Initialize the file context, the file is opened on first use.
+
+        Args:
+            :param path: Local path or URL of the NanoAOD file
+            :param uproot_options: Options passed to uproot.open
+        """
+        self.path = path
+        self.uproot_options = uproot_options or {}
+        self._file = None
+
+    @property
+    def file(self):
+        """Open uproot directory of the file."""
+        if self._file is None:
+            self._file = uproot.open(self.path, **self.uproot_options)
+        return self._file
+
+    @property
+    def num_entries(self):
+        """Number of entries of the Events tree."""
+        return self.file["Events"].num_entries
+
+    def runs_sums(self, keys):
+        """
+        Sum over runs of the requested Runs branches.
+        Only the branches present in the file are read, in a single request.
+
+        Args:
+            :param keys: Names of the Runs branches, e.g. genEventSumw
+            :return: dict of branch name and sum
+        """
+        runs = self.file["Runs"]
+        keys = [key for key in keys if key in runs.keys()]
+        if not keys:
+            return {}
+        arrays = runs.arrays(keys, library="np")
+        return {key: float(np.sum(arrays[key])) for key in keys}
+
+    def events(self, events_forms=None, dataset="", metadata=None, entry_start=None,
+               entry_stop=None, preload=None, access_log=None, decompression_executor=None):
+        """
+        NanoEvents of the Events tree, read through the shared handle.
+
+        Args:
+            :param events_forms: FormCache to reuse the form of the dataset (optional)
+            :param dataset: Dataset name used as key of the form cache
+            :param metadata: Metadata attached to the events
+            :param entry_start: First entry to read (default: 0)
+            :param entry_stop: Entry after the last one to read (default: all)
+            :param preload: Branch filter of the branches read eagerly, as in from_root
+            :param access_log: List where the accessed branches are recorded
+            :param decompression_executor: Executor of the eager reads
+        """
+        if events_forms is not None:
+            return events_forms.events(self.file, dataset, metadata=metadata,
+                                       entry_start=entry_start, entry_stop=entry_stop,
+                                       preload=preload, access_log=access_log,
+                                       decompression_executor=decompression_executor)
+        return NanoEventsFactory.from_root(
+            self.file,
+            treepath="Events",
+            entry_start=entry_start,
+            entry_stop=entry_stop,
+            preload=preload,
+            schemaclass=NanoAODSchema,
+            metadata=metadata,
+            access_log=access_log,
+            decompression_executor=decompression_executor
+        ).events()
+
+    def dask_events(self, steps, metadata=None):
+        """
+        Lazy NanoEvents of the Events tree as a dask collection, with one partition
+        per entry range. The partitions are read by the dask workers, which open
+        the file themselves.
+
+        Args:
+            :param steps: Entry ranges (start, stop) of the partitions
+            :param metadata: Metadata attached to the events
+        """
+        return NanoEventsFactory.from_root(
+            {self.path: {"object_path": "Events", "steps": [list(step) for step in steps]}},
+            schemaclass=NanoAODSchema,
+            metadata=metadata,
+            mode="dask",
+            uproot_options=self.uproot_options
+        ).events()
+
+    def close(self):
+        """Close the file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
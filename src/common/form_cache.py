@@ -0,0 +1,209 @@
+"""
+On-disk cache of the NanoEvents base form per dataset.
+Building the form of a NanoAOD file interprets every branch of the Events tree,
+which is repeated for every file although all files of a dataset share the layout.
+The form is stored once per (dataset, NanoAOD version, branch names and types)
+and reused.
+The cache builds the events from the form with coffea internals (the public
+from_root always interprets the branches in virtual mode), it is only enabled
+for the coffea versions they were checked against.
+"""
+import copy
+import hashlib
+import inspect
+import json
+import os
+import re
+import coffea
+import uproot
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+try:
+    from coffea.nanoevents.factory import _OnlySliceableAs # pylint: disable=protected-access
+    from coffea.nanoevents.mapping import UprootSourceMapping, TrivialUprootOpener
+except ImportError:
+    _OnlySliceableAs = UprootSourceMapping = TrivialUprootOpener = None
+
+# coffea versions (year.month) whose internals the cache uses
+COFFEA_VERSIONS = ((2025, 1), (2025, 12))
+
+_memory_cache = {}
+# Signature and branch types of the trees already opened by this process,
+# per (file UUID, tree)
+_signatures = {}
+
+def nanoaod_version(file_path, default="unknown"):
+    """NanoAOD version from the dataset name in the file path, e.g. 'v15'."""
+    match = re.search(r"NanoAODv(\d+)", file_path)
+    return f"v{match.group(1)}" if match else default
+
+def is_supported():
+    """Check that the installed coffea provides the internals used by the cache."""
+    match = re.match(r"(\d+)\.(\d+)", coffea.__version__)
+    if match is None or UprootSourceMapping is None:
+        return False
+    version = (int(match.group(1)), int(match.group(2)))
+    if not COFFEA_VERSIONS[0] <= version <= COFFEA_VERSIONS[1]:
+        return False
+    parameters = inspect.signature(UprootSourceMapping).parameters
+    return all(hasattr(cls, name) for cls, name in [
+        (NanoEventsFactory, "_from_mapping"),
+        (UprootSourceMapping, "_extract_base_form"),
+        (UprootSourceMapping, "preload_column_source"),
+    ]) and "virtual" in parameters and "preloaded_arrays" in parameters
+
+def branch_signature(typenames):
+    """Hash of the branch names and types of a tree (dict of name -> typename)."""
+    digest = hashlib.sha256()
+    for name in sorted(typenames):
+        digest.update(f"{name}:{typenames[name]}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+class FormCache:
+    """
+    Directory of base forms stored as JSON, one file per dataset and layout.
+    Each entry holds the base form and the branch types it was built from.
+    """
+    def __init__(self, cache_dir):
+        """Initialize the form cache in cache_dir."""
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, dataset, version, signature):
+        """Path of the cached form of a dataset layout."""
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{dataset}_{version}_{signature}")
+        return os.path.join(self.cache_dir, name + ".json")
+
+    def load(self, dataset, version, signature):
+        """Cached entry ({"form": ..., "typenames": ...}), or None if missing or unreadable."""
+        key = (dataset, version, signature)
+        if key in _memory_cache:
+            return _memory_cache[key]
+        path = self.path(*key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Could not read cached form {path} ({e}).")
+            return None
+        if not isinstance(entry, dict) or "form" not in entry or "typenames" not in entry:
+            return None
+        _memory_cache[key] = entry
+        return entry
+
+    def store(self, dataset, version, signature, base_form, typenames):
+        """
+        Write a base form and the branch types it was built from to the cache
+        (atomically, several jobs may share the directory).
+        """
+        key = (dataset, version, signature)
+        entry = {"typenames": typenames, "form": base_form}
+        _memory_cache[key] = entry
+        path = self.path(*key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def events(self, file, dataset, treepath="Events", version=None, metadata=None,
+               entry_start=None, entry_stop=None, preload=None, access_log=None,
+               decompression_executor=None):
+        """
+        NanoEvents of a file, built from the cached form of its dataset.
+        Equivalent to NanoEventsFactory.from_root(..., schemaclass=NanoAODSchema) in
+        virtual mode. The cached form is looked up by the branch names and types of
+        the file, and only used if the stored types match those of the file. The form
+        is extracted from the file and cached on a miss or mismatch.
+
+        Args:
+            :param file: File path or an open uproot directory
+            :param dataset: Dataset name, e.g. '<era>_<process>'
+            :param treepath: Name of the events tree
+            :param version: NanoAOD version (default: from the file path)
+            :param metadata: Metadata attached to the events
+            :param entry_start: First entry to read (default: 0)
+            :param entry_stop: Entry after the last one to read (default: all)
+            :param preload: Branch filter of the branches read eagerly, as in from_root
+            :param access_log: List where the accessed branches are recorded
+            :param decompression_executor: Executor of the eager reads
+        """
+        if isinstance(file, uproot.reading.ReadOnlyDirectory):
+            tree = file[treepath]
+            file_handle = file
+        else:
+            tree = uproot.open({file: treepath})
+            file_handle = tree.file
+        if version is None:
+            version = nanoaod_version(tree.file.file_path)
+
+        # The branch types are only listed once per file
+        tree_key = (str(tree.file.uuid), tree.object_path)
+        if tree_key not in _signatures:
+            typenames = tree.typenames()
+            _signatures[tree_key] = (branch_signature(typenames), typenames)
+        signature, typenames = _signatures[tree_key]
+        entry = self.load(dataset, version, signature)
+
+        entry_start = max(entry_start or 0, 0)
+        entry_stop = tree.num_entries if entry_stop is None \
+            else min(entry_stop, tree.num_entries)
+        partition_key = tree_key + (f"{entry_start}-{entry_stop}",)
+        preloaded_arrays = None
+        if preload is not None:
+            arrays = tree.arrays(filter_branch=preload, entry_start=entry_start,
+                                 entry_stop=entry_stop, ak_add_doc=True,
+                                 decompression_executor=decompression_executor, how=dict)
+            preloaded_arrays = {key: _OnlySliceableAs(value, slice(entry_start, entry_stop))
+                                for key, value in arrays.items()}
+        mapping = UprootSourceMapping(
+            TrivialUprootOpener({partition_key[0]: tree.file.file_path}, {}),
+            entry_start,
+            entry_stop,
+            cache={},
+            access_log=access_log,
+            file_handle=file_handle,
+            use_ak_forth=True,
+            virtual=True,
+            preloaded_arrays=preloaded_arrays,
+        )
+        mapping.preload_column_source(partition_key[0], partition_key[1], tree)
+
+        def build(base_form):
+            # the schema modifies the form in place
+            return NanoEventsFactory._from_mapping( # pylint: disable=protected-access
+                mapping,
+                partition_key,
+                copy.deepcopy(base_form),
+                None,
+                NanoAODSchema,
+                metadata,
+                mode="virtual",
+            ).events()
+
+        if entry is not None:
+            if entry["typenames"] == typenames:
+                return build(entry["form"])
+            print(f"WARNING: Cached form of {dataset} does not match the branch types of "
+                  f"{tree.file.file_path}. Rebuilding it.")
+
+        base_form = mapping._extract_base_form(tree) # pylint: disable=protected-access
+        self.store(dataset, version, signature, base_form, typenames)
+        return build(base_form)
+
+def from_main_config(main_config):
+    """
+    Create a FormCache from the form_cache_dir key of main.cfg.
+
+    Returns:
+        :return: FormCache, or None if form_cache_dir is empty or the installed
+                 coffea is not supported
+    """
+    cache_dir = main_config.get("form_cache_dir", "")
+    if cache_dir == "":
+        return None
+    if not is_supported():
+        print(f"WARNING: form_cache_dir is not supported with coffea {coffea.__version__}, "
+              "the forms are not cached.")
+        return None
+    return FormCache(cache_dir)
@@ -0,0 +1,134 @@
+"""
+Single-file container for the histograms of a selection job.
+Every histogram is stored as its own lz4-compressed pickle, followed by an index
+of offsets, so one histogram can be loaded without reading the rest of the file.
+
+Layout: MAGIC | record ... | index (lz4 JSON) | index offset (8 bytes) | MAGIC
+"""
+import argparse
+import json
+import struct
+import cloudpickle
+import lz4.frame
+from selection.selection_utils import cutflow_efficiencies
+
+MAGIC = b"HISTOS01"
+FOOTER = struct.Struct("<Q")
+EXTENSION = ".hists"
+
+def write_container(path, histograms):
+    """
+    Write histograms into a container.
+
+    Args:
+        :param path: Output file path
+        :param histograms: dict of name -> picklable object (hist.Hist, ...),
+            or an iterable of (name, object) pairs
+    """
+    items = histograms.items() if isinstance(histograms, dict) else histograms
+    index = {}
+    with open(path, "wb") as fout:
+        fout.write(MAGIC)
+        for name, histo in items:
+            record = lz4.frame.compress(cloudpickle.dumps(histo))
+            index[name] = [fout.tell(), len(record)]
+            fout.write(record)
+        index_offset = fout.tell()
+        fout.write(lz4.frame.compress(json.dumps(index).encode("utf-8")))
+        fout.write(FOOTER.pack(index_offset))
+        fout.write(MAGIC)
+
+class HistoContainer:
+    """Lazy reader of a histogram container, only the index is read on opening."""
+    def __init__(self, path):
+        """Open a container and read its index."""
+        self.path = path
+        with open(path, "rb") as fin:
+            if fin.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a histogram container.")
+            fin.seek(-(FOOTER.size + len(MAGIC)), 2)
+            index_end = fin.tell()
+            (index_offset,) = FOOTER.unpack(fin.read(FOOTER.size))
+            if fin.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is truncated.")
+            fin.seek(index_offset)
+            self._index = json.loads(lz4.frame.decompress(fin.read(index_end - index_offset)))
+
+    def keys(self):
+        """Names of the stored histograms."""
+        return list(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        """Load one histogram."""
+        offset, length = self._index[name]
+        with open(self.path, "rb") as fin:
+            fin.seek(offset)
+            return cloudpickle.loads(lz4.frame.decompress(fin.read(length)))
+
+    def load(self, names=None):
+        """Load several histograms (all by default) as a dict."""
+        names = self.keys() if names is None else names
+        return {name: self[name] for name in names}
+
+def merge_containers(paths, output):
+    """
+    Sum the histograms of several containers with the same names and write the result.
+    Histograms are loaded one name at a time, so only one set is kept in memory.
+    The cutflow efficiencies are not summed, they are computed again from the
+    summed cutflow and onecut histograms of every channel.
+    """
+    containers = [HistoContainer(path) for path in paths]
+    # dict as an ordered set, in the order of the first containers
+    names = {}
+    for container in containers:
+        names.update(dict.fromkeys(container.keys()))
+
+    def summed():
+        cutflows = {}
+        for name in names:
+            if "efficiency" in name:
+                continue
+            total = None
+            for container in containers:
+                if name in container:
+                    total = container[name] if total is None else total + container[name]
+            chan, _, key = name.rpartition("/")
+            if key.startswith(("cutflow_", "onecut_")):
+                cutflows.setdefault(chan, {})[key] = total
+            yield name, total
+        for chan, chan_cutflows in cutflows.items():
+            steps = [key[len("cutflow_"):] for key in chan_cutflows
+                     if key.startswith("cutflow_") and not key.startswith("cutflow_unweighted_")]
+            for step_name in steps:
+                for key, histo in cutflow_efficiencies(chan_cutflows, step_name).items():
+                    yield f"{chan}/{key}" if chan else key, histo
+
+    write_container(output, summed())
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Inspect and merge histogram containers")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    ls = subparsers.add_parser("ls", help="List the histograms of a container")
+    ls.add_argument("container", type=str)
+    merge = subparsers.add_parser("merge", help="Sum the histograms of several containers")
+    merge.add_argument("output", type=str)
+    merge.add_argument("inputs", type=str, nargs="+")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    args = argparser()
+    match args.action:
+        case "ls":
+            for name in HistoContainer(args.container).keys():
+                print(name)
+        case "merge":
+            merge_containers(args.inputs, args.output)
+            print(f"Merged {len(args.inputs)} containers into {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Operations on hist histograms computed on their storage views with numpy.
+The values and variances of all bins are processed at once, instead of going
+through an uncertainties uarray with a Python object per bin
+(common.utils.convert_hist_to_uarray). Histograms with Double or Int64
+storage are counts, their variances are the values (Poisson).
+"""
+import numpy as np
+import hist
+
+def _arrays(view):
+    """Arrays of a storage view that are summed when bins are merged."""
+    if view.dtype.names is None:
+        return [view]
+    if set(view.dtype.names) != {"value", "variance"}:
+        raise ValueError(f"Bins of a storage with fields {view.dtype.names} cannot be summed.")
+    return [view["value"], view["variance"]]
+
+def values_variances(histogram, poisson=False, flow=False):
+    """
+    Values and variances of the bins of a histogram.
+
+    Args:
+        :param histogram: hist histogram
+        :param poisson: Use the values as variances (counts)
+        :param flow: Include the flow bins
+        :return: (values, variances) arrays
+    """
+    values = histogram.values(flow=flow)
+    variances = values if poisson else histogram.variances(flow=flow)
+    if variances is None:
+        raise ValueError("Histogram has no variances (weighted fill of a Double storage), "
+                         "use poisson=True or a Weight storage.")
+    return values, variances
+
+def merge_flows(histogram, overflow=True, underflow=True):
+    """
+    Add the overflow and underflow of every axis to its last and first bins, in
+    place. The flow bins keep their content.
+
+    Args:
+        :param histogram: hist histogram with Weight, Double or Int64 storage
+        :param overflow: Merge the overflow bins
+        :param underflow: Merge the underflow bins
+        :return: The histogram
+    """
+    view = histogram.view(flow=True)
+    arrays = _arrays(view)
+    for dim, axis in enumerate(histogram.axes):
+        first = 1 if axis.traits.underflow else 0
+        last = first + len(axis) - 1
+        merges = []
+        if underflow and axis.traits.underflow:
+            merges.append((0, first))
+        if overflow and axis.traits.overflow:
+            merges.append((last + 1, last))
+        for source, target in merges:
+            source_index = (slice(None),) * dim + (source,)
+            target_index = (slice(None),) * dim + (target,)
+            for array in arrays:
+                array[target_index] += array[source_index]
+    return histogram
+
+def divide(numerator, denominator, errors="independent"):
+    """
+    Ratio of two (values, variances) pairs, of arrays or numbers.
+
+    Args:
+        :param numerator: (values, variances) of the numerator
+        :param denominator: (values, variances) of the denominator
+        :param errors: "independent" to add the relative uncertainties of the
+                       numerator and denominator in quadrature, "binomial" if the
+                       numerator is a subset of the denominator (an efficiency)
+        :return: (values, variances) of the ratio, nan where the denominator is 0
+    """
+    num_values, num_variances = (np.asarray(array, dtype=float) for array in numerator)
+    den_values, den_variances = (np.asarray(array, dtype=float) for array in denominator)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = num_values / den_values
+        if errors == "independent":
+            variances = num_variances / den_values**2 \
+                + num_values**2 * den_variances / den_values**4
+        elif errors == "binomial":
+            # Weighted binomial variance, eff*(1-eff)/N for counts
+            variances = ((1 - 2*ratio) * num_variances + ratio**2 * den_variances) \
+                / den_values**2
+        else:
+            raise ValueError(f"Errors {errors} not recognized. "
+                             "Available errors: ['independent', 'binomial']")
+    return ratio, variances
+
+def efficiency(histogram, reference, poisson=False, errors="independent"):
+    """
+    Efficiency of every bin of a histogram with respect to a reference.
+
+    Args:
+        :param histogram: hist histogram of the selected events
+        :param reference: (value, variance) of the reference bin, or a histogram
+                          with the same binning
+        :param poisson: Use the values as variances (counts)
+        :param errors: Error propagation, "independent" or "binomial" (see divide)
+        :return: hist histogram with Weight storage of the efficiencies
+    """
+    if isinstance(reference, hist.Hist):
+        reference = values_variances(reference, poisson=poisson)
+    values, variances = divide(values_variances(histogram, poisson=poisson), reference, errors)
+    result = hist.Hist(*histogram.axes, storage=hist.storage.Weight())
+    view = result.view()
+    view["value"] = values
+    view["variance"] = variances
+    return result
+
+def rebin(histogram, factor, axis=0):
+    """Histogram with factor consecutive bins of an axis merged (flow bins included)."""
+    return histogram[{axis: slice(None, None, hist.rebin(factor))}]
+
+def normalize(histogram, norm=1.0, flow=False):
+    """
+    Copy of a histogram scaled to a total of norm, the variances by the square
+    of the scale. An empty histogram is returned unscaled.
+    """
+    total = float(np.sum(histogram.values(flow=flow)))
+    if total == 0:
+        return histogram.copy()
+    return histogram * (norm / total)
+
+def sum_histograms(histograms):
+    """Sum of histograms with the same axes, the inputs are not modified."""
+    histograms = list(histograms)
+    if not histograms:
+        raise ValueError("No histograms to sum.")
+    total = histograms[0].copy()
+    for histogram in histograms[1:]:
+        total += histogram
+    return total
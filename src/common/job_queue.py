@@ -0,0 +1,195 @@
+"""
+Local SQLite queue of selection jobs for run_processor --serve.
+Jobs can be submitted from a command file made by make_selection.py, a file list
+or a manifest, and are claimed atomically by any number of workers on the node.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    input TEXT NOT NULL,
+    output TEXT NOT NULL DEFAULT '',
+    output_histos TEXT NOT NULL DEFAULT '',
+    metadata TEXT NOT NULL DEFAULT '',
+    entry_start INTEGER NOT NULL DEFAULT 0,
+    entry_stop INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    message TEXT,
+    submitted REAL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL
+)
+"""
+# Columns added after the first version of the schema, with their definition
+ADDED_COLUMNS = {
+    "entry_start": "INTEGER NOT NULL DEFAULT 0",
+    "entry_stop": "INTEGER",
+    "heartbeat": "REAL",
+}
+
+class JobQueue:
+    """Queue of file jobs stored in a SQLite database."""
+    def __init__(self, path):
+        """Open (and create if needed) the queue database."""
+        self.path = path
+        # autocommit mode, transactions are opened explicitly
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        for column, definition in ADDED_COLUMNS.items():
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def submit(self, input_file, output="", output_histos="", metadata="", entry_start=0,
+               entry_stop=None):
+        """Add a job (a whole file or an entry range of it) to the queue and return its id."""
+        cursor = self._conn.execute(
+            "INSERT INTO jobs (input, output, output_histos, metadata, entry_start, entry_stop, "
+            "submitted) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (input_file, output, output_histos, metadata, entry_start, entry_stop, time.time())
+        )
+        return cursor.lastrowid
+
+    def claim(self, worker, stale_timeout=0):
+        """
+        Atomically take the oldest pending job. Running jobs without a heartbeat for
+        stale_timeout seconds (0 to keep them) were left by a crashed worker and are
+        put back to pending first.
+
+        Returns:
+            :return: dict with the job columns, or None if no job is pending
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            if stale_timeout > 0:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'pending', worker = NULL, "
+                    "message = 'requeued: no heartbeat from ' || worker "
+                    "WHERE status = 'running' AND COALESCE(heartbeat, started) < ?",
+                    (now - stale_timeout,)
+                )
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = 'pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ?, heartbeat = ? "
+                "WHERE id = ?", (worker, now, now, row["id"])
+            )
+            self._conn.execute("COMMIT")
+        except sqlite3.Error:
+            self._conn.execute("ROLLBACK")
+            raise
+        return dict(row)
+
+    def beat(self, job_id):
+        """Record that the worker of a running job is still alive."""
+        self._conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+
+    def finish(self, job_id, status, message=""):
+        """Mark a job as done or failed."""
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, message = ?, finished = ? WHERE id = ?",
+            (status, message, time.time(), job_id)
+        )
+
+    def requeue(self, status="failed"):
+        """Put jobs with the given status back to pending, returns how many."""
+        cursor = self._conn.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL, message = NULL "
+            "WHERE status = ?", (status,)
+        )
+        return cursor.rowcount
+
+    def pending_metadata(self):
+        """Distinct metadata strings of the pending jobs."""
+        rows = self._conn.execute("SELECT DISTINCT metadata FROM jobs WHERE status = 'pending'")
+        return [row[0] for row in rows]
+
+    def counts(self):
+        """Number of jobs per status."""
+        rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {row[0]: row[1] for row in rows}
+
+    def close(self):
+        """Close the database connection."""
+        self._conn.close()
+
+def parse_command(command):
+    """
+    Extract the job of a run_processor command line written by make_selection.py.
+
+    Returns:
+        :return: dict with input, output, output_histos, metadata and entry range
+    """
+    parts = command.split("run_processor.py")[-1]
+    input_file = parts.split("'")[1]
+    job = {"input": input_file, "output": "", "output_histos": "", "metadata": ""}
+    for option in ["output", "output_histos"]:
+        if f"--{option} '" in parts:
+            job[option] = parts.split(f"--{option} '")[1].split("'")[0]
+    if "--metadata " in parts:
+        job["metadata"] = parts.split("--metadata ")[1].split()[0]
+    for option in ["entry_start", "entry_stop"]:
+        if f"--{option} " in parts:
+            job[option] = int(parts.split(f"--{option} ")[1].split()[0])
+    return job
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Manage the local queue of selection jobs")
+    parser.add_argument("queue", type=str, help="SQLite queue database")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    submit = subparsers.add_parser("submit", help="Submit jobs to the queue")
+    submit.add_argument("jobs", type=str,
+                        help="Command file (.sh), file list (.txt) or manifest (.json)")
+    submit.add_argument("--metadata", type=str, default="",
+                        help="Metadata of the jobs for file lists and manifests")
+    subparsers.add_parser("status", help="Print the number of jobs per status")
+    requeue = subparsers.add_parser("requeue", help="Put failed jobs back to pending")
+    requeue.add_argument("--status", type=str, default="failed",
+                         help="Status of the jobs to requeue (default: failed)")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    args = argparser()
+    queue = JobQueue(args.queue)
+    match args.action:
+        case "submit":
+            with open(args.jobs, "r", encoding="utf-8") as f:
+                if args.jobs.endswith(".json"):
+                    jobs = [dict({"metadata": args.metadata}, **job) for job in json.load(f)]
+                else:
+                    lines = [line.strip() for line in f
+                             if line.strip() and not line.strip().startswith("#")]
+                    if args.jobs.endswith(".sh"):
+                        jobs = [parse_command(line) for line in lines]
+                    else:
+                        jobs = [{"input": line, "metadata": args.metadata} for line in lines]
+            for job in jobs:
+                queue.submit(job["input"], job.get("output", ""),
+                             job.get("output_histos", ""), job.get("metadata", ""),
+                             job.get("entry_start", 0), job.get("entry_stop"))
+            print(f"Submitted {len(jobs)} jobs to {os.path.abspath(args.queue)}")
+        case "status":
+            for status, count in queue.counts().items():
+                print(f"{status}: {count}")
+        case "requeue":
+            print(f"Requeued {queue.requeue(args.status)} jobs")
+    queue.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Writers and readers for the per-channel step trees.
+Step snapshots can be stored as classic TTrees or as RNTuples.
+"""
+import fnmatch
+import math
+import awkward as ak
+import numpy as np
+import uproot
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+
+OUTPUT_FORMATS = ["ttree", "rntuple"]
+# Prefix of the input index of the collections of friend trees
+SOURCE_INDEX_PREFIX = "sourceIdx_"
+
+def cluster_size(array, rntuple_cfg):
+    """
+    Number of entries per RNTuple cluster for the given data.
+
+    Args:
+        :param array: Awkward record array to be written
+        :param rntuple_cfg: "rntuple" block of config/selection/output.yml
+        :return: Entries per cluster (at least 1)
+    """
+    entries = int(rntuple_cfg.get("cluster_entries", 100000))
+    target_bytes = int(rntuple_cfg.get("cluster_bytes", 0))
+    if target_bytes > 0 and len(array) > 0:
+        bytes_per_entry = max(array.nbytes / len(array), 1.0)
+        entries = min(entries, math.ceil(target_bytes / bytes_per_entry))
+    return max(entries, 1)
+
+def dtype_rule(name, rules):
+    """dtype of the first rule whose pattern matches name, or None."""
+    for rule in rules:
+        if fnmatch.fnmatchcase(name, rule["match"]):
+            return rule["dtype"]
+    return None
+
+def leaf_primitive(array):
+    """Primitive type name of the values of an array, e.g. 'float64'."""
+    leaf = ak.type(array)
+    while hasattr(leaf, "content"):
+        leaf = leaf.content
+    return getattr(leaf, "primitive", None)
+
+def _indexed_option(layout, **_kwargs):
+    """uproot only writes option types stored as IndexedOptionArray."""
+    if layout.is_option and not isinstance(layout, ak.contents.IndexedOptionArray):
+        return layout.to_IndexedOptionArray64()
+    return None
+
+def cast_column(array, dtype, mask=False, sentinel=-999):
+    """
+    Cast a column to dtype, masking the sentinel values as missing if mask is set.
+    Columns that already have the requested dtype are not copied. Integer columns
+    are not narrowed to a dtype that cannot hold their values.
+    """
+    primitive = leaf_primitive(array)
+    if mask and primitive is not None and primitive != "bool":
+        array = ak.transform(_indexed_option, ak.mask(array, array != sentinel))
+    if dtype is not None and primitive != str(np.dtype(dtype)):
+        if not fits_dtype(array, dtype):
+            raise ValueError(f"Values of a {primitive} column are outside of the range "
+                             f"of {np.dtype(dtype)}, use a wider dtype in its rule.")
+        array = ak.values_astype(array, dtype)
+    return array
+
+def fits_dtype(array, dtype):
+    """Check that the values of a numeric column are in the range of an integer dtype."""
+    if not np.issubdtype(np.dtype(dtype), np.integer) or leaf_primitive(array) == "bool":
+        return True
+    low, high = ak.min(array, axis=None), ak.max(array, axis=None)
+    if low is None:
+        return True
+    info = np.iinfo(dtype)
+    return info.min <= low and high <= info.max
+
+def apply_dtypes(branches, dtype_cfg, masks=True):
+    """
+    Cast the branches of a step snapshot following the dtypes block of
+    config/selection/tree_structure.yml. Patterns are matched against the branch
+    name, or "<branch>.<field>" for the fields of a collection.
+
+    Args:
+        :param branches: dict of branch name -> awkward array (output of make_snapshot)
+        :param dtype_cfg: "dtypes" block of tree_structure.yml
+        :param masks: Whether sentinel values are masked (not supported by TTrees)
+        :return: dict of branch name -> awkward array
+    """
+    if not dtype_cfg:
+        return branches
+    rules = dtype_cfg.get("rules", [])
+    masked = dtype_cfg.get("masked", []) if masks else []
+    sentinel = dtype_cfg.get("sentinel", -999)
+
+    def cast(name, array):
+        mask = any(fnmatch.fnmatchcase(name, pattern) for pattern in masked)
+        return cast_column(array, dtype_rule(name, rules), mask, sentinel)
+
+    casted = {}
+    for name, array in branches.items():
+        fields = ak.fields(array)
+        if fields:
+            casted[name] = ak.zip({field: cast(f"{name}.{field}", array[field])
+                                   for field in fields})
+        else:
+            casted[name] = cast(name, array)
+    return casted
+
+def write_tree(fout, key, branches, output_cfg, dtype_cfg=None):
+    """
+    Write a step snapshot into an open uproot file.
+
+    Args:
+        :param fout: uproot.WritableDirectory
+        :param key: Name of the tree/ntuple
+        :param branches: dict of branch name -> awkward array (output of make_snapshot)
+        :param output_cfg: Content of config/selection/output.yml ("Output" block)
+        :param dtype_cfg: "dtypes" block of config/selection/tree_structure.yml (optional)
+    """
+    output_format = output_cfg.get("format", "ttree")
+    # Missing values would be written as std::optional branches in TTrees,
+    # which ROOT cannot read, so the sentinels are kept there
+    branches = apply_dtypes(branches, dtype_cfg, masks=output_format == "rntuple")
+    match output_format:
+        case "ttree":
+            fout.mktree(key, branches)
+        case "rntuple":
+            # Collections ("Jet_selected.", "Tau.", ...) are kept as lists of records
+            array = ak.zip(branches, depth_limit=1)
+            step = cluster_size(array, output_cfg.get("rntuple", {}))
+            ntuple = fout.mkrntuple(key, array[:step])
+            for start in range(step, len(array), step):
+                ntuple.extend(array[start:start + step])
+        case _:
+            raise ValueError(f"Output format {output_format} not recognized. "
+                             f"Available formats: {OUTPUT_FORMATS}")
+
+def flatten_record_names(array):
+    """
+    Rename nested record fields to the TTree branch convention of uproot.mktree,
+    e.g. jets.pt -> jets_pt, so both formats expose the same columns.
+
+    Args:
+        :param array: Awkward record array read from an RNTuple
+        :return: dict of branch name -> awkward array
+    """
+    flat = {}
+    for field in array.fields:
+        column = array[field]
+        fields = ak.fields(column)
+        if column.ndim > 1:
+            flat["n" + field] = ak.num(column, axis=1)
+        if fields:
+            for subfield in fields:
+                flat[f"{field}_{subfield}"] = column[subfield]
+        else:
+            flat[field] = column
+    return flat
+
+def group_record_names(array):
+    """
+    Group TTree branches of jagged collections (njets, jets_pt, ...) back into
+    lists of records, as they are created by make_snapshot.
+
+    Args:
+        :param array: Awkward record array read from a TTree
+        :return: dict of branch name -> awkward array
+    """
+    branches = {}
+    collections = [field[1:] for field in array.fields if field.startswith("n")
+                   and any(f.startswith(field[1:] + "_") for f in array.fields)]
+    for collection in collections:
+        subfields = {field[len(collection) + 1:]: array[field] for field in array.fields
+                     if field.startswith(collection + "_")}
+        if subfields:
+            branches[collection] = ak.zip(subfields)
+    for field in array.fields:
+        if any(field == "n" + c or field.startswith(c + "_") for c in branches):
+            continue
+        branches[field] = array[field]
+    return branches
+
+def read_tree(path, key, branches=None, flat_names=True):
+    """
+    Read back a step snapshot written with write_tree, independently of its format.
+
+    Args:
+        :param path: Output ROOT file
+        :param key: Name of the tree/ntuple
+        :param branches: Optional list of branches (TTree convention) to read
+        :param flat_names: Whether RNTuple records are renamed to the TTree convention
+        :return: Awkward record array
+    """
+    with uproot.open(path) as fin:
+        obj = fin[key]
+        if isinstance(obj, uproot.behaviors.RNTuple.RNTuple):
+            fields = obj.keys(recursive=False)
+            if branches is not None:
+                # Only read the top-level fields holding the requested branches
+                fields = [field for field in fields
+                          if any(name == field or name.startswith(field + "_")
+                                 or name == "n" + field for name in branches)]
+            array = obj.arrays(fields)
+            if flat_names:
+                flat = flatten_record_names(array)
+                if branches is not None:
+                    flat = {name: flat[name] for name in branches}
+                array = ak.zip(flat, depth_limit=1)
+            return array
+        return obj.arrays(branches)
+
+def read_friend(path, key, source=None, treepath="Events", validate=True):
+    """
+    Join a friend tree (written with mode: "friend") back to its input NanoAOD.
+    The input events are read lazily, only the branches accessed are loaded.
+
+    Args:
+        :param path: Output ROOT file
+        :param key: Name of the friend tree/ntuple
+        :param source: Input NanoAOD file (default: the sourceFile stored with the tree)
+        :param treepath: Name of the events tree in the input file
+        :param validate: Check that the event numbers of both trees match
+        :return: NanoEvents of the selected entries with the friend columns as fields
+    """
+    with uproot.open(path) as fin:
+        obj = fin[key]
+        if source is None:
+            source = str(fin["sourceFile"])
+        is_rntuple = isinstance(obj, uproot.behaviors.RNTuple.RNTuple)
+    friend = read_tree(path, key, flat_names=False)
+    columns = {field: friend[field] for field in friend.fields} if is_rntuple \
+        else group_record_names(friend)
+
+    events = NanoEventsFactory.from_root(
+        {source: treepath},
+        schemaclass=NanoAODSchema,
+        metadata={}
+    ).events()
+    events = events[ak.to_numpy(columns["entryIndex"])]
+    if validate and not ak.all(events.event == columns["event"]):
+        raise ValueError(f"Events of {path}:{key} do not match the entries of {source}.")
+    for name, column in columns.items():
+        if name in ["run", "luminosityBlock", "event", "entryIndex"]:
+            continue
+        events[name] = join_source_collection(events, column)
+    return events
+
+def join_source_collection(events, column):
+    """
+    Objects of an input collection selected by the selector, with the fields it
+    added or modified, from a friend collection that stores their input index
+    (sourceIdx_<collection>, see selection_utils.make_snapshot). Other columns
+    are returned as they are.
+    """
+    index_fields = [field for field in ak.fields(column) if field.startswith(SOURCE_INDEX_PREFIX)
+                    and field[len(SOURCE_INDEX_PREFIX):] in events.fields]
+    if not index_fields:
+        return column
+    collection = events[index_fields[0][len(SOURCE_INDEX_PREFIX):]][column[index_fields[0]]]
+    for field in ak.fields(column):
+        if field != index_fields[0]:
+            collection = ak.with_field(collection, column[field], field)
+    return collection
@@ -0,0 +1,148 @@
+"""
+Local Parquet cache of the NanoAOD branches used by the selector.
+Files are converted with src/make_parquet_cache.py; the manifest of the cache
+records for every source file its Parquet partition, columns, Runs sums and
+the size and modification time of the source. run_processor and make_plotting
+read from the cache when the input file is in the manifest and its source is
+unchanged, and from ROOT otherwise.
+"""
+import json
+import os
+import time
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+from common.preprocess_cache import file_stamp
+
+MANIFEST = "manifest.json"
+
+class ParquetCache:
+    """Directory of Parquet partitions with their manifest."""
+    def __init__(self, cache_dir):
+        """Open the cache and read its manifest."""
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest_path = os.path.join(cache_dir, MANIFEST)
+        self.manifest = {"files": {}}
+        # Source files checked by this process, the storage is only asked once per file
+        self._current = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+
+    def lookup(self, url):
+        """Manifest entry of a source file, or None if it is not cached."""
+        entry = self.manifest["files"].get(url)
+        if entry is None or not os.path.exists(self.partition(entry)):
+            return None
+        return entry
+
+    def is_current(self, url, entry):
+        """
+        Whether the source file of an entry is unchanged: the size, modification time
+        or ETag reported by its storage match the stamp stored in the manifest. If the
+        storage reports none of them, the source is not checked here (it is only
+        checked by make_parquet_cache.py --verify, which reads its checksum).
+        """
+        if url not in self._current:
+            current = file_stamp(url)
+            if current is None:
+                self._current[url] = True
+                return True
+            # Entries written before the stamps were stored only have the size
+            stored = entry.get("stamp") or {"size": entry.get("size")}
+            keys = [key for key in current if key in stored]
+            self._current[url] = bool(keys) and all(stored[key] == current[key]
+                                                     for key in keys)
+        return self._current[url]
+
+    def partition(self, entry):
+        """Path of the Parquet partition of a manifest entry."""
+        return os.path.join(self.cache_dir, entry["parquet"])
+
+    def register(self, url, entry):
+        """Add or replace the entry of a source file and write the manifest."""
+        entry["created"] = time.time()
+        self.manifest["files"][url] = entry
+        self.save()
+
+    def remove(self, url):
+        """Drop a source file from the cache."""
+        entry = self.manifest["files"].pop(url, None)
+        if entry is not None and os.path.exists(self.partition(entry)):
+            os.remove(self.partition(entry))
+        self.save()
+
+    def save(self):
+        """Write the manifest (atomically)."""
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def input(self, url):
+        """
+        ParquetInput of a cached source file, or None if it is not cached or its
+        source changed since it was converted.
+        """
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        if not self.is_current(url, entry):
+            print(f"WARNING: {url} changed since it was cached, reading it from ROOT "
+                  "(make_parquet_cache.py --verify drops the stale entries).")
+            return None
+        return ParquetInput(self.partition(entry), entry)
+
+class ParquetInput:
+    """
+    Cached input file, with the interface of common.file_context.NanoAODFile.
+    """
+    def __init__(self, path, entry):
+        """Initialize from the partition path and its manifest entry."""
+        self.path = path
+        self.entry = entry
+
+    @property
+    def num_entries(self):
+        """Number of converted events."""
+        return self.entry["entries"]
+
+    def runs_sums(self, keys):
+        """Sums over runs of the requested Runs branches, stored in the manifest."""
+        return {key: self.entry["runs"][key] for key in keys if key in self.entry["runs"]}
+
+    def events(self, events_forms=None, dataset="", metadata=None, # pylint: disable=unused-argument
+               entry_start=None, entry_stop=None, preload=None, access_log=None,
+               decompression_executor=None):
+        """
+        NanoEvents read from the Parquet partition. The form cache and the eager
+        reads (preload) of the ROOT inputs are not needed for local Parquet files.
+        """
+        return NanoEventsFactory.from_parquet(
+            self.path,
+            entry_start=entry_start,
+            entry_stop=entry_stop,
+            access_log=access_log,
+            schemaclass=NanoAODSchema,
+            metadata=metadata
+        ).events()
+
+    def close(self):
+        """Nothing to close, Parquet files are opened by the events."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def from_main_config(main_config):
+    """
+    Create a ParquetCache from the parquet_cache_dir key of main.cfg.
+
+    Returns:
+        :return: ParquetCache, or None if parquet_cache_dir is empty
+    """
+    cache_dir = main_config.get("parquet_cache_dir", "")
+    if cache_dir == "":
+        return None
+    return ParquetCache(cache_dir)
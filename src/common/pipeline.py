@@ -0,0 +1,221 @@
+"""
+Pipelined processing of the chunks of an input file.
+A reader thread prepares the events of the next chunks while the selector
+processes the current one, and a writer thread drains the outputs of the
+processed chunks, so a job takes about max(I/O, compute) instead of the sum.
+The chunk size can be adapted to a memory budget from the measured resident memory.
+"""
+import os
+import queue
+import re
+import resource
+import threading
+
+_DONE = object()
+
+def chunk_ranges(entry_start, entry_stop, chunk_size):
+    """Entry ranges (start, stop) of chunk_size entries covering [entry_start, entry_stop)."""
+    if chunk_size <= 0:
+        return [(entry_start, entry_stop)]
+    return [(start, min(start + chunk_size, entry_stop))
+            for start in range(entry_start, entry_stop, chunk_size)]
+
+class ChunkPipeline:
+    """
+    Three-stage pipeline over chunk ranges:
+    read(index, chunk) in a reader thread, compute(index, chunk, data) in the
+    calling thread and write(index, output) in a writer thread. At most prefetch
+    chunks are read ahead of the one being computed.
+    """
+    def __init__(self, read, compute, write, prefetch=1):
+        """Initialize the pipeline with its three stages."""
+        self.read = read
+        self.compute = compute
+        self.write = write
+        self.prefetch = max(prefetch, 1)
+        self._stop = threading.Event()
+
+    def _put(self, stage_queue, item):
+        """Put an item on a bounded queue unless the pipeline is stopped."""
+        while not self._stop.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _reader(self, chunks, read_queue):
+        try:
+            for index, chunk in enumerate(chunks):
+                if self._stop.is_set() or not self._put(
+                        read_queue, (index, chunk, self.read(index, chunk), None)):
+                    return
+        except Exception as e: # pylint: disable=broad-exception-caught
+            self._put(read_queue, (None, None, None, e))
+            return
+        self._put(read_queue, _DONE)
+
+    def _writer(self, write_queue, results, errors):
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                return
+            index, output = item
+            try:
+                results[index] = self.write(index, output)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                errors.append(e)
+                self._stop.set()
+                return
+
+    def run(self, chunks):
+        """
+        Process all chunks.
+
+        Returns:
+            :return: list of the write outputs, in the order of the chunks
+        """
+        read_queue = queue.Queue(maxsize=self.prefetch)
+        write_queue = queue.Queue()
+        results, errors = {}, []
+        reader = threading.Thread(target=self._reader, args=(chunks, read_queue), daemon=True)
+        writer = threading.Thread(target=self._writer, args=(write_queue, results, errors),
+                                  daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                index, chunk, data, error = item
+                if error is not None:
+                    raise error
+                write_queue.put((index, self.compute(index, chunk, data)))
+        finally:
+            write_queue.put(_DONE)
+            writer.join()
+            self._stop.set()
+            reader.join()
+        if errors:
+            raise errors[0]
+        return [results[index] for index in sorted(results)]
+
+# Entries of the first chunk when the chunk size is adapted to a memory budget
+PROBE_CHUNK_SIZE = 10000
+# Fraction of the memory budget used for sizing the chunks
+RSS_SAFETY = 0.8
+# Weight of the previous chunks in the estimate of the memory per event
+RSS_DECAY = 0.5
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+def parse_size(size):
+    """Bytes of a memory size such as '4G', '512M' or '4GB'."""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)B?\s*", str(size).upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size: {size}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+def format_size(n_bytes):
+    """Memory size in GB for the status files."""
+    return f"{n_bytes / 1024**3:.2f}G"
+
+def current_rss():
+    """Resident memory of the process in bytes."""
+    with open("/proc/self/statm", "r", encoding="utf-8") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def peak_rss():
+    """Peak resident memory of the process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def available_cpus():
+    """
+    CPUs the process may use: its CPU affinity, limited by the CPU quota of its
+    cgroup (v2 cpu.max or v1 cpu.cfs_quota_us), as set by Slurm or containers.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r", encoding="utf-8") as f:
+            limit, period = f.read().split()[:2]
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r", encoding="utf-8") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r", encoding="utf-8") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, max(int(quota), 1))
+    return cpus
+
+class AdaptiveChunks:
+    """
+    Entry ranges sized to keep the resident memory under max_rss.
+    The first chunk has initial_size entries; the memory growth per event is
+    measured across every chunk (begin and record), averaged with a decaying
+    weight over the previous chunks, and the next chunks are sized to the memory
+    left under the budget. Memory pressure halves the chunk size (shrink).
+    Iterated lazily, so the sizes follow the measurements of the processed chunks.
+    """
+    def __init__(self, entry_start, entry_stop, max_rss, initial_size=PROBE_CHUNK_SIZE,
+                 min_size=100):
+        """Initialize the chunks of [entry_start, entry_stop) under max_rss bytes."""
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self.max_rss = max_rss
+        self.size = initial_size
+        self.min_size = min_size
+        self.baseline = current_rss()
+        self.rss_per_event = 0.0
+        self.sizes = []
+        self._start_rss = {}
+
+    def __iter__(self):
+        start = self.entry_start
+        while start < self.entry_stop:
+            stop = min(start + self.size, self.entry_stop)
+            self.sizes.append(stop - start)
+            yield start, stop
+            start = stop
+
+    def begin(self, chunk):
+        """Save the resident memory before processing a chunk."""
+        self._start_rss[chunk] = current_rss()
+
+    def record(self, chunk, rss):
+        """Update the chunk size from the resident memory after processing a chunk."""
+        start_rss = self._start_rss.pop(chunk, self.baseline)
+        if rss > self.max_rss:
+            self.shrink()
+            return
+        n_events = chunk[1] - chunk[0]
+        if n_events <= 0:
+            return
+        # Only the growth during this chunk, the outputs kept from the previous
+        # chunks are part of rss and reduce the memory left instead
+        per_event = max(rss - start_rss, 0) / n_events
+        if self.rss_per_event == 0:
+            self.rss_per_event = per_event
+        else:
+            self.rss_per_event = RSS_DECAY * self.rss_per_event + (1 - RSS_DECAY) * per_event
+        if self.rss_per_event > 0:
+            budget = (self.max_rss - rss) * RSS_SAFETY
+            # At most doubled per chunk, memory freed by earlier chunks is reused
+            # without growing the resident memory
+            self.size = max(min(int(budget / self.rss_per_event), 2 * self.size),
+                            self.min_size)
+
+    def shrink(self):
+        """Halve the chunk size after memory pressure."""
+        self.size = max(self.size // 2, self.min_size)
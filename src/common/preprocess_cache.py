@@ -0,0 +1,170 @@
+"""
+On-disk cache of the preprocessing metadata of input files.
+Before processing, the coffea Runner opens every file of the fileset for its
+number of entries, UUID and cluster boundaries, and the dask mode and the
+sharding of make_selection.py do the same for the entry ranges of their
+partitions. The metadata is stored per (file, tree) with the size and the
+modification time of the file, and reused while they are unchanged; a file
+that was rewritten since is preprocessed again.
+"""
+from collections.abc import MutableMapping
+import hashlib
+import json
+import os
+import fsspec
+import uproot
+from common.pipeline import chunk_ranges
+
+# Preprocessing keys of coffea.processor.FileMeta, the other keys are dataset metadata
+FILE_KEYS = ["numentries", "uuid", "clusters"]
+
+def file_stamp(path):
+    """
+    Size and modification time of a local or remote file, or None if the
+    storage does not report them (the entry is then only keyed by the path).
+    """
+    try:
+        if "://" not in path:
+            stat = os.stat(path)
+            return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+        fs, source = fsspec.core.url_to_fs(path)
+        info = fs.info(source)
+    except (OSError, ImportError, ValueError):
+        return None
+    stamp = {key: info[key] for key in ("size", "mtime", "LastModified", "ETag")
+             if info.get(key) is not None}
+    return {key: str(value) if key == "LastModified" else value
+            for key, value in stamp.items()} or None
+
+class PreprocessCache(MutableMapping):
+    """
+    Directory of file metadata stored as JSON, one file per input file and tree.
+    Usable as the metadata_cache of a coffea Runner: the keys are FileMeta of the
+    Runner (the dataset is not part of the key, files are shared between datasets)
+    or (path, treename) tuples.
+    """
+    def __init__(self, cache_dir):
+        """Initialize the preprocessing cache in cache_dir."""
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        # Entries validated by this process, the files are only stat'ed once
+        self._checked = {}
+
+    @staticmethod
+    def _key(key):
+        """(path, treename) of a FileMeta or of a tuple."""
+        if isinstance(key, tuple):
+            return key
+        return key.filename, key.treename
+
+    def path(self, filename, treename):
+        """Path of the cached metadata of a tree."""
+        digest = hashlib.sha1(f"{filename}\n{treename}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}_{os.path.basename(filename)}.json")
+
+    def lookup(self, filename, treename="Events"):
+        """
+        Cached metadata of a tree (numentries, uuid and clusters if known), or
+        None if missing or stale.
+        """
+        key = (filename, treename)
+        if key in self._checked:
+            return self._checked[key]
+        path = self.path(*key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Could not read cached metadata {path} ({e}).")
+            return None
+        if entry.get("file") != filename or entry.get("stamp") != file_stamp(filename):
+            print(f"Cached metadata of {filename} is stale, preprocessing it again.")
+            return None
+        metadata = dict(entry["metadata"], uuid=bytes.fromhex(entry["metadata"]["uuid"]))
+        self._checked[key] = metadata
+        return metadata
+
+    def store(self, filename, treename, metadata):
+        """Write the metadata of a tree (atomically, several jobs may share the directory)."""
+        metadata = {key: metadata[key] for key in FILE_KEYS if key in metadata}
+        self._checked[(filename, treename)] = metadata
+        stored = {"numentries": int(metadata["numentries"]),
+                  "uuid": bytes(metadata["uuid"]).hex()}
+        if "clusters" in metadata:
+            stored["clusters"] = [int(entry) for entry in metadata["clusters"]]
+        entry = {
+            "file": filename,
+            "tree": treename,
+            "stamp": file_stamp(filename),
+            "metadata": stored,
+        }
+        path = self.path(filename, treename)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def num_entries(self, filename, treename="Events"):
+        """Number of entries of a tree, read from the file and cached on a miss."""
+        metadata = self.lookup(filename, treename)
+        if metadata is None:
+            with uproot.open(filename) as f:
+                metadata = {"numentries": f[treename].num_entries, "uuid": f.file.fUUID}
+            self.store(filename, treename, metadata)
+        return metadata["numentries"]
+
+    def steps(self, filename, step_size, treename="Events", entry_start=0, entry_stop=None):
+        """Entry ranges of step_size entries of a tree, as in pipeline.chunk_ranges."""
+        num_entries = self.num_entries(filename, treename)
+        entry_stop = num_entries if entry_stop is None else min(entry_stop, num_entries)
+        return chunk_ranges(entry_start, entry_stop, step_size)
+
+    def __getitem__(self, key):
+        metadata = self.lookup(*self._key(key))
+        if metadata is None:
+            raise KeyError(key)
+        # The Runner replaces the metadata of its FileMeta, keep the dataset metadata
+        return dict(getattr(key, "metadata", None) or {}, **metadata)
+
+    def __setitem__(self, key, metadata):
+        self.store(*self._key(key), metadata)
+
+    def __delitem__(self, key):
+        key = self._key(key)
+        self._checked.pop(key, None)
+        path = self.path(*key)
+        if not os.path.exists(path):
+            raise KeyError(key)
+        os.remove(path)
+
+    def __contains__(self, key):
+        return self.lookup(*self._key(key)) is not None
+
+    def __iter__(self):
+        for name in sorted(os.listdir(self.cache_dir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, name), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            yield entry["file"], entry["tree"]
+
+    def __len__(self):
+        # The Runner only looks up the cache if it is not empty
+        return sum(1 for name in os.listdir(self.cache_dir) if name.endswith(".json"))
+
+def from_main_config(main_config):
+    """
+    Create a PreprocessCache from the preprocess_cache_dir key of main.cfg.
+
+    Returns:
+        :return: PreprocessCache, or None if preprocess_cache_dir is empty
+    """
+    cache_dir = main_config.get("preprocess_cache_dir", "")
+    if cache_dir == "":
+        return None
+    return PreprocessCache(cache_dir)
@@ -0,0 +1,92 @@
+"""
+Naming and hashing of the selection jobs, shared by make_selection.py and run_processor.py.
+Only the standard library is used, and the selector is hashed from its source files on
+disk without importing it, so the jobs can be generated without loading coffea.
+"""
+import ast
+import functools
+import glob
+import hashlib
+import os
+
+def shard_tag(job):
+    """Suffix of the status file of an entry-range shard, empty for whole files."""
+    if not job.get("entry_start") and job.get("entry_stop") is None:
+        return ""
+    entry_stop = job.get("entry_stop")
+    return f"_entries{job.get('entry_start') or 0}-{'end' if entry_stop is None else entry_stop}"
+
+def channel_file(tag, chan):
+    """Output file of a channel, without the .root extension."""
+    chan_file = tag.replace('<chan>/',f'{chan}/')
+    filename = chan + "_" + chan_file.split('/')[-1].replace('.root','')
+    return '/'.join(chan_file.split('/')[:-1]) + '/' + filename
+
+def module_paths(name, roots):
+    """Source files of a module (and of its packages) found in one of the roots."""
+    parts = name.split(".")
+    for root in roots:
+        paths = [os.path.join(root, *parts[:i], "__init__.py") for i in range(1, len(parts))]
+        base = os.path.join(root, *parts)
+        for path in [base + ".py", os.path.join(base, "__init__.py")]:
+            if os.path.isfile(path):
+                return [p for p in paths if os.path.isfile(p)] + [path]
+    return []
+
+def imported_files(path, roots):
+    """Framework source files imported by a Python file (modules in one of the roots)."""
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), filename=path)
+    files = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            # relative imports are resolved from the directory of the file
+            search = [os.path.dirname(path)] if node.level else roots
+            module = node.module or ""
+            files += module_paths(module, search) if module else []
+            # the imported names can be submodules of a package
+            names = [f"{module}.{alias.name}" if module else alias.name for alias in node.names]
+            for name in names:
+                files += module_paths(name, search)
+            continue
+        else:
+            continue
+        for name in names:
+            files += module_paths(name, roots)
+    return files
+
+def selector_path(fw_config):
+    """Source file of the selector of main.cfg."""
+    return os.path.join(fw_config["fw_dir"], "selectors", fw_config["selector"] + ".py")
+
+@functools.lru_cache(maxsize=None)
+def selection_hash(fw_dir, selector_file):
+    """
+    Hash of the selector code, with the framework modules it imports (recursively),
+    and of the selection configuration (config/selection and data/Corrections).
+    A checkpoint made with another hash is not reused.
+
+    Args:
+        :param fw_dir: Framework directory
+        :param selector_file: Source file of the selector
+        :return: Hex digest
+    """
+    roots = [os.path.join(fw_dir, "src"), os.path.join(fw_dir, "src", "selection"),
+             os.path.join(fw_dir, "selectors")]
+    files = set()
+    todo = [selector_file]
+    while todo:
+        path = os.path.abspath(todo.pop())
+        if path in files:
+            continue
+        files.add(path)
+        todo += imported_files(path, roots)
+    for pattern in [("config", "selection", "*.yml"), ("data", "Corrections", "*", "*.yml")]:
+        files.update(os.path.abspath(path) for path in glob.glob(os.path.join(fw_dir, *pattern)))
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
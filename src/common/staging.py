@@ -0,0 +1,263 @@
+"""
+Node-local staging of input files.
+Copies the next files of a job's list to a scratch directory in the background,
+so they are read locally instead of over XRootD. The directory can be shared by
+several jobs or --serve workers: the copies being read are pinned with a shared
+lock on a <copy>.inuse file and are not evicted by the other processes.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import fsspec
+try:
+    from XRootD.client import FileSystem as XRootDFileSystem
+    from XRootD.client.flags import QueryCode
+except ImportError:
+    XRootDFileSystem = QueryCode = None
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+def adler32(path):
+    """
+    Compute the adler32 checksum of a local file, as reported by DAS/XRootD.
+
+    Args:
+        :param path: Local file path
+        :return: Checksum as an 8 character hexadecimal string
+    """
+    value = 1
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            value = zlib.adler32(chunk, value)
+    return f"{value & 0xffffffff:08x}"
+
+def source_adler32(url):
+    """
+    adler32 checksum of a remote file reported by its XRootD server, without
+    reading the file. None for other protocols or if the server does not report it.
+    """
+    parts = urlsplit(url)
+    if XRootDFileSystem is None or parts.scheme not in ("root", "xroot"):
+        return None
+    status, response = XRootDFileSystem(f"{parts.scheme}://{parts.netloc}").query(
+        QueryCode.CHECKSUM, parts.path)
+    if not status.ok or response is None:
+        return None
+    # e.g. b"adler32 0a1b2c3d"
+    algorithm, _, value = response.decode("utf-8").strip("\x00 \n").partition(" ")
+    return value.lower() if algorithm == "adler32" else None
+
+class StagingCache:
+    """
+    LRU cache of input files on node-local scratch with asynchronous prefetch.
+
+    Every staged file is verified against the size and the adler32 checksum of
+    the source, given by the caller (e.g. from the job manifest) or reported by
+    its XRootD server. The source checksum is stored next to the copy, so a file
+    reused from a previous job is verified again before being served. Without a
+    source checksum only the size is compared with the source, and the checksum of
+    the copy made is stored to detect later corruption of the local copy.
+    """
+    def __init__(self, stage_dir, max_bytes, prefetch=2, workers=1):
+        """
+        Initialize the staging cache.
+
+        Args:
+            :param stage_dir: Local scratch directory
+            :param max_bytes: Maximum total size of the staged files
+            :param prefetch: Number of files staged ahead of the current one
+            :param workers: Number of parallel copies
+        """
+        self.stage_dir = stage_dir
+        self.max_bytes = max_bytes
+        self.prefetch_depth = prefetch
+        os.makedirs(stage_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._pending = {}
+        # File descriptors of the .inuse locks of the copies pinned by this process
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def local_path(self, url):
+        """Path of the staged copy of url."""
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.stage_dir, f"{digest}_{os.path.basename(url)}")
+
+    def stage(self, url, checksum=None):
+        """
+        Start staging url in the background (no-op if already staged or in flight).
+
+        Returns:
+            :return: Future resolving to the path to read (local copy or url on failure)
+        """
+        with self._lock:
+            if url not in self._pending:
+                self._pending[url] = self._executor.submit(self._copy, url, checksum)
+            return self._pending[url]
+
+    def prefetch(self, urls, checksums=None):
+        """
+        Stage the first prefetch_depth urls of the list in the background, with
+        their adler32 checksums from the dict checksums if known.
+        """
+        checksums = checksums or {}
+        for url in urls[:self.prefetch_depth]:
+            self.stage(url, checksums.get(url))
+
+    def get(self, url, checksum=None):
+        """
+        Path to read url from, waiting for its copy to finish.
+        Staged and prefetched files are protected from eviction, also by other
+        processes sharing the stage directory, until released.
+        """
+        return self.stage(url, checksum).result()
+
+    def release(self, url):
+        """Allow the staged copy of url to be evicted."""
+        with self._lock:
+            self._pending.pop(url, None)
+            self._unpin(url)
+
+    def close(self):
+        """Cancel pending prefetches, stop the background workers and release the pins."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for url in list(self._pins):
+                self._unpin(url)
+
+    def _pin(self, url):
+        """Take a shared lock on the .inuse file of the copy of url, returns its descriptor."""
+        fd = os.open(self.local_path(url) + ".inuse", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        with self._lock:
+            self._unpin(url)
+            self._pins[url] = fd
+        return fd
+
+    def _unpin(self, url):
+        """Release the lock of the copy of url (called with self._lock held)."""
+        fd = self._pins.pop(url, None)
+        if fd is not None:
+            os.close(fd)
+
+    def _is_valid(self, path, size, checksum):
+        """Check a staged copy against the expected size and stored checksum."""
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+        sidecar = path + ".adler32"
+        if not os.path.exists(sidecar):
+            return False
+        with open(sidecar, "r", encoding="utf-8") as f:
+            stored = f.read().strip()
+        if checksum is not None and stored != checksum.lower():
+            return False
+        return adler32(path) == stored
+
+    def _copy(self, url, checksum):
+        """Copy url to the stage directory, returns the path to read from."""
+        path = self.local_path(url)
+        # Pinned before the copy is checked, so no other process evicts it in between
+        fd = self._pin(url)
+        try:
+            fs, source = fsspec.core.url_to_fs(url)
+            size = fs.size(source)
+            if checksum is None:
+                checksum = source_adler32(url)
+            if self._is_valid(path, size, checksum):
+                os.utime(path)  # refresh LRU position
+                return path
+            # Only one process copies a file, the others wait and reuse its copy
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if self._is_valid(path, size, checksum):
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                os.utime(path)
+                return path
+            if not self._evict(size):
+                print(f"WARNING: {url} does not fit in the stage directory. Reading remotely.")
+                with self._lock:
+                    self._unpin(url)
+                return url
+
+            tmp_path = path + ".part"
+            value = 1
+            with fs.open(source, "rb") as fin, open(tmp_path, "wb") as fout:
+                while chunk := fin.read(CHUNK_SIZE):
+                    value = zlib.adler32(chunk, value)
+                    fout.write(chunk)
+            local_checksum = f"{value & 0xffffffff:08x}"
+
+            if os.path.getsize(tmp_path) != size:
+                raise IOError(f"Size mismatch after copy: {os.path.getsize(tmp_path)} != {size}")
+            if checksum is not None and local_checksum != checksum.lower():
+                raise IOError(f"Checksum mismatch after copy: {local_checksum} != {checksum}")
+            with open(path + ".adler32", "w", encoding="utf-8") as f:
+                f.write(local_checksum)
+            os.replace(tmp_path, path)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            print(f"Staged {url} -> {path}")
+            return path
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f"WARNING: Could not stage {url} ({e}). Reading remotely.")
+            for leftover in [path + ".part", path, path + ".adler32"]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            with self._lock:
+                self._unpin(url)
+            return url
+
+    def _evict(self, needed):
+        """
+        Remove least recently used copies until needed bytes fit in max_bytes.
+        Returns False if it is not possible.
+        """
+        if needed > self.max_bytes:
+            return False
+        with self._lock:
+            in_use = {self.local_path(url) for url in self._pending}
+        entries = []
+        for name in os.listdir(self.stage_dir):
+            entry = os.path.join(self.stage_dir, name)
+            if name.endswith((".adler32", ".inuse")) or not os.path.isfile(entry):
+                continue
+            entries.append((os.path.getmtime(entry), entry, os.path.getsize(entry)))
+        total = sum(size for _, _, size in entries)
+        for _, entry, size in sorted(entries):
+            if total + needed <= self.max_bytes:
+                break
+            if entry in in_use or entry.endswith(".part"):
+                continue
+            fd = os.open(entry + ".inuse", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                # Copies pinned by another process are skipped
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                for path in [entry, entry + ".adler32"]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            finally:
+                os.close(fd)
+            total -= size
+        return total + needed <= self.max_bytes
+
+def from_main_config(main_config):
+    """
+    Create a StagingCache from the staging keys of main.cfg.
+
+    Returns:
+        :return: StagingCache, or None if stage_dir is empty
+    """
+    stage_dir = main_config.get("stage_dir", "")
+    if stage_dir == "":
+        return None
+    return StagingCache(
+        stage_dir,
+        max_bytes=int(float(main_config.get("stage_size", "50")) * 1024**3),
+        prefetch=int(main_config.get("stage_prefetch", "2")),
+    )
@@ -0,0 +1,193 @@
+"""
+Reader of the per-channel step trees written by run_processor.
+The outputs are found from the tree directory layout of make_selection.py,
+<tree_dir>/<systematic>/<chan>/<chan>_<era>_<process>_<file>.root, and the
+requested branches are read in parallel across files. Every entry carries the
+normalization of its input file from the weightedEvents histograms, summed over
+the outputs of the entry-range shards of the file.
+"""
+import json
+import os
+import re
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import awkward as ak
+import numpy as np
+import uproot
+from common.output_formats import read_tree
+
+OutputFile = namedtuple("OutputFile", ["era", "process", "channel", "path"])
+# Suffix of the outputs of the entry-range shards of an input file (selection_jobs.shard_tag)
+SHARD_SUFFIX = re.compile(r"_entries\d+-(\d+|end)\.root$")
+
+def tree_dir(main_config, era, systematic="Nominal"):
+    """Directory of the step trees of an era and systematic."""
+    base = main_config.get("minitree_dir") or main_config["tree_dir"]
+    return os.path.join(base.replace("<era>", era), systematic)
+
+def dataset_eras(fw_dir):
+    """Eras of the datasets configuration used by make_selection.py."""
+    with open(fw_dir + "/config/ntuples/datasets/Nominal.json", "r", encoding="utf-8") as f:
+        return list(json.load(f))
+
+def dataset_processes(fw_dir, era):
+    """Processes of an era in the datasets configuration used by make_selection.py."""
+    with open(fw_dir + "/config/ntuples/datasets/Nominal.json", "r", encoding="utf-8") as f:
+        return list(json.load(f).get(era, {}))
+
+def match_process(name, era, processes):
+    """
+    Process of an output file name "<era>_<process>_<file>", the longest matching
+    one if several processes share a prefix. None if no process matches.
+    """
+    matches = [process for process in processes if name.startswith(f"{era}_{process}_")]
+    return max(matches, key=len) if matches else None
+
+def discover(main_config, eras, channels, processes=None, systematic="Nominal"):
+    """
+    Output files of the given eras and channels.
+
+    Args:
+        :param main_config: Parsed main.cfg
+        :param eras: List of eras
+        :param channels: List of channels
+        :param processes: List of processes (default: all processes of the era)
+        :param systematic: Systematic directory
+        :return: list of OutputFile
+    """
+    files = []
+    for era in eras:
+        era_processes = processes if processes is not None \
+            else dataset_processes(main_config["fw_dir"], era)
+        for chan in channels:
+            chan_dir = os.path.join(tree_dir(main_config, era, systematic), chan)
+            if not os.path.isdir(chan_dir):
+                continue
+            for filename in sorted(os.listdir(chan_dir)):
+                if not filename.startswith(f"{chan}_") or not filename.endswith(".root"):
+                    continue
+                process = match_process(filename[len(chan) + 1:], era, era_processes)
+                if process is not None:
+                    files.append(OutputFile(era, process, chan, os.path.join(chan_dir, filename)))
+    return files
+
+def file_normalization(fin, key="genEventSumw"):
+    """Sum of a weightedEvents histogram of an open output file, None if it is not stored."""
+    if key not in fin:
+        return None
+    return float(fin[key].values().sum())
+
+def shard_normalizations(files, key="genEventSumw"):
+    """
+    Normalization of the input file of every shard output. The Runs sums of a
+    file are only stored by its shard starting at entry 0, so they are summed
+    over the outputs of all its shards.
+
+    Returns:
+        :return: dict of output path to normalization, for the shard outputs
+    """
+    shards = {}
+    for output_file in files:
+        if SHARD_SUFFIX.search(output_file.path):
+            source = SHARD_SUFFIX.sub(".root", output_file.path)
+            shards.setdefault(source, []).append(output_file.path)
+    norms = {}
+    for paths in shards.values():
+        total = None
+        for path in paths:
+            with uproot.open(path) as fin:
+                norm = file_normalization(fin, key)
+            if norm is not None:
+                total = (total or 0.0) + norm
+        norms.update(dict.fromkeys(paths, total))
+    return norms
+
+def read_output(output_file, step, branches=None, norm_key="genEventSumw", norm=None):
+    """
+    Branches of a step tree of one output file, with the normalization of the
+    file (or norm, for shards of a file) as the norm_key field. None if the file
+    has no such tree.
+    """
+    with uproot.open(output_file.path) as fin:
+        if step not in fin:
+            return None
+        if norm is None:
+            norm = file_normalization(fin, norm_key)
+    array = read_tree(output_file.path, step, branches)
+    if norm is not None:
+        array = ak.with_field(array, np.full(len(array), norm), norm_key)
+    return array
+
+class TreeReader:
+    """Parallel reader of the step trees of selected eras, processes and channels."""
+    def __init__(self, main_config, eras, channels, processes=None, systematic="Nominal",
+                 workers=8, norm_key="genEventSumw"):
+        """
+        Find the output files.
+
+        Args:
+            :param main_config: Parsed main.cfg
+            :param eras: List of eras
+            :param channels: List of channels
+            :param processes: List of processes (default: all processes of the era)
+            :param systematic: Systematic directory
+            :param workers: Number of files read at the same time
+            :param norm_key: weightedEvents histogram attached as normalization
+        """
+        self.files = discover(main_config, eras, channels, processes, systematic)
+        self.workers = workers
+        self.norm_key = norm_key
+
+    def select(self, era=None, process=None, channel=None):
+        """Output files matching the given era, process and channel."""
+        return [output_file for output_file in self.files
+                if (era is None or output_file.era == era)
+                and (process is None or output_file.process == process)
+                and (channel is None or output_file.channel == channel)]
+
+    def iterate(self, step, branches=None, **selection):
+        """
+        Lazily read a step tree file by file. At most workers files are read ahead.
+
+        Yields:
+            (OutputFile, awkward array) for every file with the tree
+        """
+        files = self.select(**selection)
+        norms = shard_normalizations(files, self.norm_key)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for output_file in files:
+                pending.append((output_file, executor.submit(
+                    read_output, output_file, step, branches, self.norm_key,
+                    norms.get(output_file.path))))
+                if len(pending) >= self.workers:
+                    output_file, future = pending.popleft()
+                    array = future.result()
+                    if array is not None:
+                        yield output_file, array
+            while pending:
+                output_file, future = pending.popleft()
+                array = future.result()
+                if array is not None:
+                    yield output_file, array
+
+    def read(self, step, branches=None, **selection):
+        """Read a step tree of all the selected files into one awkward array."""
+        arrays = [array for _, array in self.iterate(step, branches, **selection)]
+        if not arrays:
+            return None
+        return ak.concatenate(arrays)
+
+    def normalization(self, **selection):
+        """
+        Sum of the norm_key histograms per (era, process, channel), for the
+        normalization of the concatenated arrays.
+        """
+        sums = {}
+        for output_file in self.select(**selection):
+            with uproot.open(output_file.path) as fin:
+                norm = file_normalization(fin, self.norm_key)
+            if norm is not None:
+                key = (output_file.era, output_file.process, output_file.channel)
+                sums[key] = sums.get(key, 0.0) + norm
+        return sums
@@ -2,7 +2,7 @@
     BTV b-tagging corrections 
 """
 import numpy as np
-import correctionlib
+from corrections.loader import correction_set
 import awkward as ak
 import yaml
 from selection.selection_utils import add_to_obj
@@ -50,12 +50,12 @@ def btagging(events, jets_field, tagger, working_point, cfg, correction_type="sh
     }
 
     # Load correction set
-    btv_corr = correctionlib.CorrectionSet.from_file(btv_cfg["file"])
+    btv_corr = correction_set(btv_cfg["file"])
     btag_wp = btv_corr[f"{tagger}_wp_values"].evaluate(working_point)
 
     if "preliminary" in btv_cfg and btv_cfg["preliminary"]:
         btv_cfg["file"] = btv_cfg["file"].replace(".json.gz", "_preliminary.json.gz")
-        btv_corr = correctionlib.CorrectionSet.from_file(btv_cfg["file"])
+        btv_corr = correction_set(btv_cfg["file"])
 
     btag_shape = btv_corr[f"{tagger}_{correction_type}"]
 
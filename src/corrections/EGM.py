@@ -1,7 +1,7 @@
 """ # pylint: disable=invalid-name
     Module for applying EGM corrections.
 """
-import correctionlib
+from corrections.loader import correction_set
 import yaml
 import numpy as np
 from selection.selection_utils import add_to_obj
@@ -28,7 +28,7 @@ def electron_sf(obj, working_point, cfg):
         egm_cfg = yaml.safe_load(f)["electron"][cfg["era"]]
 
     # Load correction set
-    egm_corr = correctionlib.CorrectionSet.from_file(egm_cfg["file"])
+    egm_corr = correction_set(egm_cfg["file"])
     elec_sf = egm_corr[egm_cfg["correction_name"]]
 
     # obj['SCeta'] = obj.deltaEtaSC + obj.eta
@@ -83,7 +83,7 @@ def electron_corr(events, cfg):
         egm_cfg = yaml.safe_load(f)["electronSS_EtDependent"][cfg["era"]]
 
     # Load correction set
-    egm_corr = correctionlib.CorrectionSet.from_file(egm_cfg["file"])
+    egm_corr = correction_set(egm_cfg["file"])
     elec_scale = egm_corr.compound["Scale"]
     elec_smear = egm_corr["SmearAndSyst"]
 
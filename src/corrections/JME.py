@@ -1,7 +1,7 @@
 """
     Module for applying corrections to jets, based on JME recommendations
 """
-import correctionlib
+from corrections.loader import correction_set
 import yaml
 import awkward as ak
 
@@ -25,7 +25,7 @@ def veto_map(obj, correction_type, cfg):
         jme_cfg = yaml.safe_load(f)["jetvetomaps"][cfg["era"]]
 
     # Load correction set
-    jme_corr = correctionlib.CorrectionSet.from_file(jme_cfg["file"])
+    jme_corr = correction_set(jme_cfg["file"])
     jet_veto_map = jme_corr[jme_cfg["correction_name"]]
 
     # Evaluate veto map for each jet
@@ -59,7 +59,7 @@ def jet_id(obj, corr_type, cfg):
         jme_cfg = yaml.safe_load(f)["jetid"][cfg["era"]]
 
     # Load correction set
-    jme_corr = correctionlib.CorrectionSet.from_file(jme_cfg["file"])
+    jme_corr = correction_set(jme_cfg["file"])
     jet_id_corr = jme_corr[corr_type]
 
     # Evaluate jet ID for each jet
@@ -84,7 +84,7 @@ def jet_jerc(events, obj, cfg):
     with open(cfg["data_dir"]+"/Corrections/JME/jet_jerc.yml", 'r', encoding='utf-8') as f:
         jme_cfg = yaml.safe_load(f)["jet_jerc"][cfg["era"]]
 
-    jme_corr = correctionlib.CorrectionSet.from_file(jme_cfg["file"])
+    jme_corr = correction_set(jme_cfg["file"])
     raw_pt = obj.pt * (1 - obj.rawFactor)
     raw_mass = obj.mass * (1 - obj.rawFactor)
 
@@ -1,7 +1,7 @@
 """
     Module for applying corrections from LUM recommendations
 """
-import correctionlib
+from corrections.loader import correction_set
 import yaml
 import awkward as ak
 
@@ -29,7 +29,7 @@ def pileup_weights(events, cfg):
         lum_cfg = yaml.safe_load(f)["puWeights"][cfg["era"]]
 
     # Load correction set
-    lum_corr = correctionlib.CorrectionSet.from_file(lum_cfg["file"])
+    lum_corr = correction_set(lum_cfg["file"])
     pu_weight = lum_corr[lum_cfg["correction_name"]]
 
     # Evaluate pileup weights for each event
@@ -1,7 +1,7 @@
 """
     Module for applying EGM corrections.
 """
-import correctionlib
+from corrections.loader import correction_set
 import yaml
 from external.MuonScaRe import pt_resol, pt_scale
 from selection.selection_utils import add_to_obj
@@ -32,7 +32,7 @@ def muon_sf(obj, sf_name, cfg, pt_field="corr_pt"):
         muo_cfg = yaml.safe_load(f)["muon_Z"][cfg["era"]]
 
     # Load correction set
-    muo_corr = correctionlib.CorrectionSet.from_file(muo_cfg["file"])
+    muo_corr = correction_set(muo_cfg["file"])
     muon_sf_ = muo_corr[sf_name]
 
     if "ID" in sf_name and "Iso" not in sf_name:
@@ -70,7 +70,7 @@ def muon_corr(events, cfg):
         muo_cfg = yaml.safe_load(f)["muon_scalesmearing"][cfg["era"]]
 
     # Load correction set
-    muo_corr = correctionlib.CorrectionSet.from_file(muo_cfg["file"])
+    muo_corr = correction_set(muo_cfg["file"])
     pt = events.Muon.pt
     eta = events.Muon.eta
     phi = events.Muon.phi
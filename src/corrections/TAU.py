@@ -1,7 +1,7 @@
 """
     Module for applying corrections to taus, based on TAU recommendations.
 """
-import correctionlib
+from corrections.loader import correction_set
 import yaml
 from selection.selection_utils import add_to_obj, update_collection
 
@@ -31,7 +31,7 @@ def tau_sf_corr(events, working_points: dict, cfg: dict, dependency="pt"):
         tau_cfg = yaml.safe_load(f)["tau"][cfg["era"]]
 
     # Load correction set
-    tau_corr = correctionlib.CorrectionSet.from_file(tau_cfg["file"])
+    tau_corr = correction_set(tau_cfg["file"])
 
     print("Applying tau ID scale factors...")
     tau = events.Tau
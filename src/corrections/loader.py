@@ -0,0 +1,45 @@
+"""
+    Cached loading of correctionlib files shared by the POG modules.
+"""
+import functools
+import glob
+import correctionlib
+import yaml
+
+@functools.lru_cache(maxsize=None)
+def correction_set(path):
+    """
+    Load a correctionlib CorrectionSet, parsing each file once per process.
+    Parameters:
+    path: str
+        Path to the correctionlib JSON (or .json.gz) file
+    Returns:
+    correctionlib.CorrectionSet
+    """
+    return correctionlib.CorrectionSet.from_file(path)
+
+def preload_corrections(data_dir, eras):
+    """
+    Load the correction files of the given eras listed in data/Corrections/*/*.yml,
+    so they are parsed once before starting the workers.
+    Parameters:
+    data_dir: str
+        Path to the data directory
+    eras: iterable of str
+        Eras to preload
+    """
+    for config_file in sorted(glob.glob(data_dir + "/Corrections/*/*.yml")):
+        with open(config_file, 'r', encoding='utf-8') as f:
+            pog_cfg = yaml.safe_load(f)
+        for corrections in pog_cfg.values():
+            for era in eras:
+                if not isinstance(corrections, dict) or era not in corrections:
+                    continue
+                path = corrections[era].get("file", "") \
+                    if isinstance(corrections[era], dict) else ""
+                if not path.endswith((".json", ".json.gz")):
+                    continue
+                try:
+                    correction_set(path)
+                except (OSError, ValueError) as e:
+                    print(f"WARNING: Could not preload {path}: {e}")
@@ -0,0 +1,201 @@
+"""
+    Convert the NanoAOD branches used by the selector to the local Parquet cache
+"""
+import argparse
+import fnmatch
+import hashlib
+import os
+import zlib
+import yaml
+import awkward as ak
+import fsspec
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+import common.utils as utils
+import common.parquet_cache as parquet_cache
+import common.preprocess_cache as preprocess_cache
+from common.file_context import NanoAODFile
+from common.staging import CHUNK_SIZE
+from plotting.hist_processor import HistProcessor
+from selection.accumulators import materialize_output
+from run_processor import file_cfg, load_cfg, load_processor, parse_metadata
+
+# Always kept, used to index the events and the friend trees
+INDEX_BRANCHES = ["run", "luminosityBlock", "event"]
+# Fields of the candidate collections
+KINEMATIC_FIELDS = ["pt", "eta", "phi", "mass", "charge"]
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Cache the used NanoAOD branches as Parquet")
+    parser.add_argument("input", type=str, nargs="?", default="",
+                        help="Input NanoAOD file or file list (.txt)")
+    parser.add_argument("--metadata", type=str, default="",
+                        help="Metadata of the files, e.g. era:2024,process:DYto2L,isData:False,...")
+    parser.add_argument("--cache_dir", type=str, default="",
+                        help="Cache directory (default: parquet_cache_dir of main.cfg)")
+    parser.add_argument("--plot_config", type=str, default="",
+                        help="Plotting configuration whose columns are cached as well")
+    parser.add_argument("--columns", type=str, default="",
+                        help="Comma-separated extra branches or patterns, e.g. Tau_*")
+    parser.add_argument("--probe_entries", type=int, default=5000,
+                        help="Entries of the first file read to find the used branches")
+    parser.add_argument("--step_size", type=int, default=100000,
+                        help="Entries per Parquet row group (default: 100000)")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check the cached files against their sources and drop stale ones")
+    return parser.parse_args()
+
+def probe_columns(selector_class, cfg, url, n_entries, plot_cfg=None):
+    """
+    Branches of the Events tree read by the selector (and the plotting processor)
+    on the first n_entries of a file, found from the column accesses of the events.
+    """
+    access_log = []
+    tree_cfg = file_cfg(cfg, {"input": url, "output": "", "output_histos": ""})
+    with NanoAODFile(url) as input_file:
+        tree_cfg["input_file"] = input_file
+        events = NanoEventsFactory.from_root(
+            input_file.file,
+            treepath="Events",
+            entry_stop=n_entries,
+            schemaclass=NanoAODSchema,
+            metadata={"dataset": "probe", "isMC": cfg.get("isData", "False") == "False"},
+            access_log=access_log
+        ).events()
+        # The step trees are virtual until they are written
+        materialize_output(selector_class(tree_cfg).process(events))
+        if plot_cfg is not None:
+            HistProcessor(None, plot_cfg, "_").process(events)
+    return sorted({access.branch for access in access_log} | set(INDEX_BRANCHES))
+
+def complete_columns(tree, columns):
+    """
+    Branches of the tree matching columns, with the counters of the jagged ones and
+    the kinematic fields of their collections, which NanoAODSchema needs to build
+    the candidate behaviors.
+    """
+    keys = tree.keys()
+    branches = {key for key in keys if any(fnmatch.fnmatch(key, col) for col in columns)}
+    for branch in list(branches):
+        count_branch = tree[branch].count_branch
+        if count_branch is None:
+            continue
+        branches.add(count_branch.name)
+        collection = count_branch.name[1:]
+        branches.update(f"{collection}_{field}" for field in KINEMATIC_FIELDS
+                        if f"{collection}_{field}" in keys)
+    return sorted(branches)
+
+def source_checksum(url):
+    """Size and adler32 checksum of a (remote) file."""
+    fs, source = fsspec.core.url_to_fs(url)
+    value = 1
+    with fs.open(source, "rb") as fin:
+        while chunk := fin.read(CHUNK_SIZE):
+            value = zlib.adler32(chunk, value)
+    return fs.size(source), f"{value & 0xffffffff:08x}"
+
+def source_stamp(url):
+    """
+    Size and modification time (or ETag) of a source file reported by its storage,
+    without reading it. Only if the storage reports neither is the file read for
+    its adler32 checksum.
+    """
+    stamp = preprocess_cache.file_stamp(url)
+    if stamp is None:
+        size, checksum = source_checksum(url)
+        stamp = {"size": size, "adler32": checksum}
+    return stamp
+
+def partition_name(url):
+    """Name of the Parquet partition of a source file."""
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return f"{digest}_{os.path.basename(url).replace('.root', '')}.parquet"
+
+def convert_file(url, columns, cache, step_size):
+    """Write the used branches of a NanoAOD file to the cache and register it."""
+    with NanoAODFile(url) as input_file:
+        events = input_file.file["Events"]
+        branches = complete_columns(events, columns + INDEX_BRANCHES)
+        runs = input_file.file["Runs"]
+        # Only the flat Runs branches can be summed
+        counters = {runs[key].count_branch.name for key in runs.keys()
+                    if runs[key].count_branch is not None}
+        runs_keys = [key for key in runs.keys() if runs[key].count_branch is None
+                     and key not in counters and key != "run"]
+        entry = {
+            "parquet": partition_name(url),
+            "uuid": str(input_file.file.file.uuid),
+            "entries": events.num_entries,
+            "columns": branches,
+            "runs": input_file.runs_sums(runs_keys),
+        }
+        path = cache.partition(entry)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        chunks = (ak.zip(arrays, depth_limit=1)
+                  for arrays in events.iterate(branches, step_size=step_size, how=dict))
+        ak.to_parquet_row_groups(chunks, tmp_path, extensionarray=False)
+    entry["stamp"] = source_stamp(url)
+    os.replace(tmp_path, path)
+    cache.register(url, entry)
+    return entry
+
+def verify(cache):
+    """Drop the cached files whose source changed or that cannot be read."""
+    for url, entry in list(cache.manifest["files"].items()):
+        try:
+            if "stamp" in entry:
+                valid = source_stamp(url) == entry["stamp"]
+            else:
+                # Entries written before the stamps were stored
+                valid = source_checksum(url) == (entry["size"], entry["adler32"])
+            valid = valid and cache.lookup(url) is not None
+        except OSError as e:
+            print(f"WARNING: Could not read {url} ({e}).")
+            valid = False
+        if not valid:
+            print(f"Removing stale cache entry of {url}")
+            cache.remove(url)
+
+def main():
+    """Main function"""
+    args = argparser()
+    fw_config = utils.parse_main_config()
+    if args.cache_dir == "":
+        cache = parquet_cache.from_main_config(fw_config)
+        if cache is None:
+            raise ValueError("No --cache_dir given and parquet_cache_dir is empty in main.cfg.")
+    else:
+        cache = parquet_cache.ParquetCache(args.cache_dir)
+
+    if args.verify:
+        verify(cache)
+        return
+    if args.input == "":
+        raise ValueError("An input file is required unless running with --verify.")
+
+    if args.input.endswith(".txt"):
+        with open(args.input, "r", encoding="utf-8") as f:
+            inputs = [line.strip() for line in f
+                      if line.strip() and not line.strip().startswith("#")]
+    else:
+        inputs = [args.input]
+
+    plot_cfg = None
+    if args.plot_config != "":
+        with open(args.plot_config, "r", encoding="utf-8") as f:
+            plot_cfg = yaml.safe_load(f)
+    cfg = load_cfg(fw_config["fw_dir"], argparse.Namespace(
+        metadata=parse_metadata(args.metadata), output_format=""))
+    print("Finding the branches used by the selector...")
+    columns = probe_columns(load_processor(fw_config), cfg, inputs[0], args.probe_entries,
+                            plot_cfg)
+    columns += [col for col in args.columns.split(",") if col]
+    print(f"Caching {len(columns)} branches: {columns}")
+
+    for url in inputs:
+        entry = convert_file(url, columns, cache, args.step_size)
+        print(f"Cached {url} -> {cache.partition(entry)} ({entry['entries']} events)")
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ import argparse
 import json
 import yaml
 import common.utils
-from plotting.plot_nanoaod import make_plotting as make_plotting_nanoaod
+from plotting.plot_nanoaod import EXECUTORS, make_plotting as make_plotting_nanoaod
 # from plotting.plot_trees import make_plotting as make_plotting_trees
 # from plotting.plot_stacks import make_plotting as make_plotting_stacks
 
@@ -21,16 +21,30 @@ def parse_args():
     parser.add_argument("--sample", type=str, default="", help="Sample to plot (for not stacks).")
     parser.add_argument("--debug", action="store_true",
                         help="Whether to run in debug mode (only one file).")
+    parser.add_argument("--executor", type=str, default=None, choices=EXECUTORS,
+                        help="Executor of the histograms (default: plot_executor of main.cfg)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of workers (default: plot_workers of main.cfg, "
+                             "0 for the available CPUs)")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Entries per chunk (default: plot_chunksize of main.cfg)")
+    parser.add_argument("--maxchunks", type=int, default=None,
+                        help="Maximum number of chunks per dataset, for tests "
+                             "(default: plot_maxchunks of main.cfg, 0 for all)")
+    parser.add_argument("--retries", type=int, default=None,
+                        help="Retries of a failed chunk (default: plot_retries of main.cfg)")
     return parser.parse_args()
 
-def main(config_file=None, eras="", do_sub_era=False, file_type="nanoaod", sample="") -> None:
+def main(config_file=None, eras="", do_sub_era=False, file_type="nanoaod", sample="",
+         executor=None, workers=None, chunksize=None, maxchunks=None, retries=None) -> None:
     """Main function to run the plotting processor."""
     if config_file is None:
         args = parse_args()
     else:
         args = argparse.Namespace(config_file=config_file, eras=eras,
                                 do_sub_era=do_sub_era, file_type=file_type, sample=sample,
-                                debug=False)
+                                debug=False, executor=executor, workers=workers,
+                                chunksize=chunksize, maxchunks=maxchunks, retries=retries)
 
     with open(args.config_file, "r", encoding="utf-8") as f:
         args.cfg = yaml.safe_load(f)
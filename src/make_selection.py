@@ -5,7 +5,11 @@ import os
 import argparse
 import yaml
 import json
+import uproot
 import common.utils as utils
+import common.preprocess_cache as preprocess_cache
+from common.selection_jobs import channel_file, selection_hash, selector_path, shard_tag
+from common.checkpoint import read_state
 
 
 def argparser():
@@ -19,9 +23,75 @@ def argparser():
                         help="Channels to be processed, comma-separated (default: ee,emu,mumu)")
     parser.add_argument("--signal_only", action="store_true",
                         help="Process only signal samples (default: False)")
+    parser.add_argument("--skim_dir", type=str, default="",
+                        help="Run on the skims of make_skim.py in this directory, "
+                             "<era> is replaced by the era (default: empty)")
+    parser.add_argument("--shard_events", type=int, default=None,
+                        help="Split files with more events into entry-range jobs "
+                             "(default: shard_events of main.cfg, 0 for one job per file)")
     args = parser.parse_args()
     return args
 
+def entry_ranges(n_events, shard_events):
+    """
+    Entry ranges (entry_start, entry_stop) of the jobs of a file with n_events.
+    The last range is open (entry_stop None), so no entry is lost if n_events
+    is not exact.
+    """
+    if shard_events <= 0 or n_events <= shard_events:
+        return [(0, None)]
+    n_shards = -(-n_events // shard_events)
+    step = -(-n_events // n_shards)
+    starts = list(range(0, n_events, step))
+    return [(start, stop) for start, stop in zip(starts, starts[1:] + [None])]
+
+def file_events(path, filename, nevents, from_file=False, file_metadata=None):
+    """
+    Number of events of an input file, from the datasets configuration (nevents,
+    keyed by file basename) or, for skims and files not listed there, from the file
+    itself (through the preprocessing cache file_metadata if given).
+    """
+    if not from_file and os.path.basename(filename) in nevents:
+        return nevents[os.path.basename(filename)]
+    if file_metadata is not None:
+        return file_metadata.num_entries(path)
+    with uproot.open(path) as f:
+        return f["Events"].num_entries
+
+def minitree_output(minitree_dir, filename, shard):
+    """Output tree tag of a job, with <chan> replaced by the channels."""
+    return os.path.join(minitree_dir + "/<chan>",
+                        filename.replace("_ntuples", "").replace(".root", "") + shard_tag(shard))
+
+def outputs_exist(output_minitree, channels):
+    """
+    Whether the channel files of a job exist and are not empty. The files are not
+    opened, jobs with a checkpoint are checked from their checkpoint instead.
+    """
+    for chan in channels:
+        path = channel_file(output_minitree, chan) + ".root"
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return False
+    return True
+
+def completed(status_dir, status_files, checkpoint_name, selection, output_minitree, channels):
+    """
+    Whether a job is completed: its checkpoint reports a completed selection with
+    the current selection hash, or, without a checkpoint (outputs of runs made
+    before the checkpoints or without them), its output files exist.
+    Jobs with processed chunks are reported, they resume from their checkpoint.
+    """
+    state = read_state(os.path.join(status_dir, checkpoint_name)) \
+        if checkpoint_name in status_files else None
+    if state is None:
+        return outputs_exist(output_minitree, channels)
+    if state.get("selection") != selection:
+        print(f"{checkpoint_name}: selection code or configuration changed, processing again")
+        return False
+    if not state["completed"] and state["chunks"]:
+        print(f"{checkpoint_name}: resuming from entry {state['next_entry']}")
+    return state["completed"]
+
 def main():
     """Main function"""
     args = argparser()
@@ -32,6 +102,12 @@ def main():
     fw_config, processes, _ = utils.initial_loading()
 
     channels = args.channels.split(",") if args.channels else ["ee", "emu", "mumu"]
+    shard_events = args.shard_events if args.shard_events is not None \
+        else int(fw_config.get("shard_events") or 0)
+    # Reuse the number of events of the files if preprocess_cache_dir is set in main.cfg
+    file_metadata = preprocess_cache.from_main_config(fw_config)
+    # Checkpoints of another selector code or configuration are processed again
+    selection = selection_hash(fw_config["fw_dir"], selector_path(fw_config))
 
     with open(fw_config["fw_dir"]+"/config/ntuples/datasets/Nominal.json",
               "r", encoding='utf-8') as f:
@@ -61,7 +137,8 @@ def main():
                 continue
             files = info["files"]
             sizes = info["sizes"]
-            nevents = info["nevents"]
+            nevents = {os.path.basename(name): int(n_events)
+                       for name, n_events in zip(files, info["nevents"])}
             minitree_dir = fw_config["minitree_dir"].replace("<era>",era)
             control_hist_dir = fw_config["control_hist_dir"].replace("<era>",era)
             status_dir = fw_config["fw_dir"]+"/selection_status/"
@@ -82,16 +159,28 @@ def main():
             if not os.path.exists(control_hist_dir):
                 os.makedirs(control_hist_dir)
 
+            ntuple_dir = args.skim_dir.replace("<era>", era) if args.skim_dir \
+                else fw_config["ntuple_dir"].replace("<era>", era)
             filenames = os.listdir(ntuple_dir)
             for filename in filenames:
                 if filename.endswith(".root") and f"{process}_" in filename and era in filename:
-                    if filename.replace(".root", "_status.out") in status_files:
-                        with open(f"{status_dir}/{filename.replace('.root', '_status.out')}",
-                                "r", encoding='utf-8') as status_file:
-                            status_lines = status_file.read()
-                            if "SELECTION COMPLETED" in status_lines:
-                                print(f"File {filename} already processed. Skipping...")
-                                continue
+                    input_path = os.path.join(ntuple_dir, filename)
+                    ranges = [(0, None)]
+                    if shard_events > 0:
+                        ranges = entry_ranges(
+                            file_events(input_path, filename, nevents,
+                                        from_file=bool(args.skim_dir),
+                                        file_metadata=file_metadata),
+                            shard_events)
+                    shards = [{"entry_start": start, "entry_stop": stop}
+                              for start, stop in ranges]
+                    shards = [shard for shard in shards if not completed(
+                        status_dir, status_files,
+                        filename.replace(".root", f"{shard_tag(shard)}_checkpoint"),
+                        selection, minitree_output(minitree_dir, filename, shard), channels)]
+                    if not shards:
+                        print(f"File {filename} already processed. Skipping...")
+                        continue
 
                     for chan in channels:
                         if not os.path.exists(minitree_dir+f"/{chan}"):
@@ -101,24 +190,28 @@ def main():
 
                     if filename in processed_files:
                         raise ValueError(f"File matches twice {filename}")
-                    output_minitree = os.path.join(
-                        minitree_dir+"/<chan>",
-                        filename.replace("_ntuples","").replace(".root","")
-                        )
-                    output_histos = os.path.join(
-                        control_hist_dir+"/<chan>",
-                        filename.replace("_ntuples","_histo").replace(".root","")
-                        )
-                    command_file += "python src/selection/run_processor.py "
-                    command_file += f"'{os.path.join(ntuple_dir,filename)}' "
-                    command_file += "--output "
-                    command_file += f"'{output_minitree}' "
-                    command_file += "--output_histos "
-                    command_file += f"'{output_histos}' "
-                    command_file += "--metadata "
-                    for key, value in metadata.items():
-                        command_file += f"{key}:{value},"
-                    command_file = command_file[:-1] + " \n"
+                    for shard in shards:
+                        # Shards are written next to each other, <file>_entries<start>-<stop>
+                        output_minitree = minitree_output(minitree_dir, filename, shard)
+                        output_histos = os.path.join(
+                            control_hist_dir+"/<chan>",
+                            filename.replace("_ntuples","_histo").replace(".root","")
+                            + shard_tag(shard)
+                            )
+                        command_file += "python src/selection/run_processor.py "
+                        command_file += f"'{input_path}' "
+                        command_file += "--output "
+                        command_file += f"'{output_minitree}' "
+                        command_file += "--output_histos "
+                        command_file += f"'{output_histos}' "
+                        if shard_tag(shard):
+                            command_file += f"--entry_start {shard['entry_start']} "
+                            if shard["entry_stop"] is not None:
+                                command_file += f"--entry_stop {shard['entry_stop']} "
+                        command_file += "--metadata "
+                        for key, value in metadata.items():
+                            command_file += f"{key}:{value},"
+                        command_file = command_file[:-1] + " \n"
                     processed_files.append(filename)
 
     command_file_path = f"{fw_config['fw_dir']}/selection_commands_{args.era}.sh" if args.era\
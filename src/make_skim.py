@@ -0,0 +1,177 @@
+"""
+    Loose skim of NanoAOD files before the selection
+"""
+import os
+import argparse
+import yaml
+import numpy as np
+import awkward as ak
+import uproot
+import common.utils as utils
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Make loose skims of NanoAOD files")
+    parser.add_argument("input", type=str,
+                        help="Input NanoAOD file or file list (.txt)")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="Directory of the skimmed files (local or depot)")
+    parser.add_argument("--metadata", type=str, default="",
+                        help="Metadata, e.g. era:2024,process:DYto2L (default: empty)")
+    parser.add_argument("--config", type=str, default="config/selection/skim.yml",
+                        help="Skim configuration (default: config/selection/skim.yml)")
+    args = parser.parse_args()
+    return args
+
+def load_skim_cfg(fw_dir, config, era):
+    """Skim configuration with the trigger paths of its HLT groups for the era."""
+    with open(os.path.join(fw_dir, config), "r", encoding="utf-8") as f:
+        skim_cfg = yaml.safe_load(f)["Skim"]
+    with open(fw_dir + "/config/selection/HLT.yml", "r", encoding="utf-8") as f:
+        _file = yaml.safe_load(f)
+        try:
+            hlt = _file["HLT"][era]
+        except KeyError:
+            hlt = _file["HLT"][era[:4]]
+    skim_cfg["triggers"] = sorted({path for grp in skim_cfg["hlt_groups"] if grp in hlt
+                                   for path in hlt[grp]["triggers"]})
+    return skim_cfg
+
+def filter_branches(skim_cfg, keys):
+    """Branches of the Events tree needed to compute the skim mask."""
+    branches = [f"HLT_{path}" for path in skim_cfg["triggers"]]
+    branches += [f"Flag_{flag}" for flag in skim_cfg["flags"]]
+    branches += [f"{obj}_pt" for obj in skim_cfg["lepton_pt"]]
+    return [branch for branch in branches if branch in keys]
+
+def skim_mask(arrays, skim_cfg):
+    """Loose event filter: MET filters, any trigger of the groups and lepton multiplicity."""
+    n_events = len(arrays[next(iter(arrays))]) if arrays else 0
+    mask = np.ones(n_events, dtype=bool)
+    for flag in skim_cfg["flags"]:
+        if f"Flag_{flag}" in arrays:
+            mask &= ak.to_numpy(arrays[f"Flag_{flag}"])
+    triggers = [f"HLT_{path}" for path in skim_cfg["triggers"] if f"HLT_{path}" in arrays]
+    if triggers:
+        fired = np.zeros(n_events, dtype=bool)
+        for trigger in triggers:
+            fired |= ak.to_numpy(arrays[trigger])
+        mask &= fired
+    n_leptons = np.zeros(n_events, dtype=np.int64)
+    for obj, pt in skim_cfg["lepton_pt"].items():
+        if f"{obj}_pt" in arrays:
+            n_leptons += ak.to_numpy(ak.sum(arrays[f"{obj}_pt"] >= pt, axis=1))
+    mask &= n_leptons >= skim_cfg["min_leptons"]
+    return mask
+
+def nanoaod_layout(tree):
+    """
+    Group the branches of a NanoAOD tree by counter, so that they are written back
+    with the same names: {collection: [fields]} for jagged collections
+    (Jet_pt -> Jet/pt, with the nJet counter) and {branch: None} for flat branches.
+    """
+    layout = {}
+    counters = set()
+    for name, branch in tree.items():
+        count_branch = branch.count_branch
+        if count_branch is None:
+            layout.setdefault(name, None)
+            continue
+        collection = count_branch.name[1:]
+        counters.add(count_branch.name)
+        field = name[len(collection) + 1:] if name != collection else ""
+        layout.setdefault(collection, []).append(field)
+    for counter in counters:
+        layout.pop(counter, None)
+    return layout
+
+def to_nanoaod(arrays, layout):
+    """Arrays read with uproot as a dict of flat branches and collection records."""
+    data = {}
+    for name, fields in layout.items():
+        if fields is None:
+            data[name] = arrays[name]
+        elif fields == [""]:
+            data[name] = arrays[name]
+        else:
+            data[name] = ak.zip({field: arrays[f"{name}_{field}"] for field in fields})
+    return data
+
+def write_nanoaod(fout, name, data, tree=None):
+    """Create (tree is None) or extend a tree with NanoAOD branch names."""
+    if tree is None:
+        tree = fout.mktree(
+            name,
+            {key: ak.type(value).content for key, value in data.items()},
+            field_name=lambda outer, inner: f"{outer}_{inner}",
+            counter_name=lambda counter: f"n{counter}",
+        )
+    tree.extend(data)
+    return tree
+
+def skim_file(input_file, output_file, skim_cfg):
+    """
+    Skim one NanoAOD file.
+
+    Returns:
+        :return: (entries read, entries kept)
+    """
+    n_read, n_kept = 0, 0
+    with uproot.open(input_file) as fin, uproot.recreate(output_file) as fout:
+        events = fin["Events"]
+        layout = nanoaod_layout(events)
+        mask_branches = filter_branches(skim_cfg, events.keys())
+        out_tree = None
+        for start in range(0, max(events.num_entries, 1), skim_cfg["step_size"]):
+            stop = min(start + skim_cfg["step_size"], events.num_entries)
+            arrays = events.arrays(mask_branches, entry_start=start, entry_stop=stop, how=dict)
+            mask = skim_mask(arrays, skim_cfg)
+            n_read += stop - start
+            n_kept += int(np.sum(mask))
+            if not np.any(mask) and out_tree is not None:
+                continue
+            arrays = events.arrays(entry_start=start, entry_stop=stop, how=dict)
+            data = to_nanoaod({key: value[mask] for key, value in arrays.items()}, layout)
+            out_tree = write_nanoaod(fout, "Events", data, out_tree)
+
+        # Normalization trees are copied unchanged
+        for name in skim_cfg["copy_trees"]:
+            if name not in fin:
+                continue
+            tree = fin[name]
+            write_nanoaod(fout, name, to_nanoaod(tree.arrays(how=dict), nanoaod_layout(tree)))
+    return n_read, n_kept
+
+def main():
+    """Main function"""
+    args = argparser()
+    metadata = args.metadata.split(",") if args.metadata else []
+    metadata = {item.split(":")[0]: item.split(":")[1] for item in metadata}
+    fw_config = utils.parse_main_config()
+    skim_cfg = load_skim_cfg(fw_config["fw_dir"], args.config, metadata.get("era", ""))
+
+    if args.input.endswith(".txt"):
+        with open(args.input, "r", encoding="utf-8") as f:
+            inputs = [line.strip() for line in f
+                      if line.strip() and not line.strip().startswith("#")]
+    else:
+        inputs = [args.input]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    total_read, total_kept = 0, 0
+    for input_file in inputs:
+        # Named as make_selection.py expects: <era>_<process>_<file>
+        filename = input_file.split("/")[-1]
+        if "process" in metadata:
+            filename = f"{metadata.get('era', '')}_{metadata['process']}_{filename}"
+        output_file = os.path.join(args.output_dir, filename)
+        n_read, n_kept = skim_file(input_file, output_file, skim_cfg)
+        total_read += n_read
+        total_kept += n_kept
+        print(f"Skimmed {input_file} -> {output_file}: {n_kept}/{n_read} events kept")
+    if total_read > 0:
+        print(f"Skim reduction factor: {total_read/max(total_kept, 1):.1f} "
+              f"({total_kept}/{total_read} events kept)")
+
+if __name__ == "__main__":
+    main()
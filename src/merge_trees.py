@@ -0,0 +1,211 @@
+"""
+    Merge the per-file channel trees of each era, process and channel
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import yaml
+import hist
+import numpy as np
+import uproot
+import common.utils as utils
+from common.event_index import EventIndex, KEY_BRANCHES, EXTENSION as INDEX_EXTENSION
+from common.output_formats import cluster_size, group_record_names
+from common.tree_reader import dataset_eras, discover, tree_dir
+from selection.selection_utils import cutflow_efficiencies
+
+def argparser():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Merge the step trees per era, process and channel")
+    parser.add_argument("--eras", type=str, default="",
+                        help="Comma-separated eras "
+                             "(default: all eras of the datasets configuration)")
+    parser.add_argument("--channels", type=str, default="ee,emu,mumu",
+                        help="Channels to be merged, comma-separated (default: ee,emu,mumu)")
+    parser.add_argument("--processes", type=str, default="",
+                        help="Comma-separated processes (default: all processes of the era)")
+    parser.add_argument("--systematic", type=str, default="Nominal",
+                        help="Systematic directory (default: Nominal)")
+    parser.add_argument("--output_dir", type=str, default="",
+                        help="Directory of the merged files, <era> is replaced by the era "
+                             "(default: <tree_dir>/<systematic>_merged)")
+    parser.add_argument("--target_size", type=float, default=2.0,
+                        help="Target size of the merged files in GB (default: 2)")
+    parser.add_argument("--step_size", type=int, default=200000,
+                        help="Entries read and written at once (default: 200000)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of files merged in parallel (default: 4)")
+    parser.add_argument("--remove_inputs", action="store_true",
+                        help="Remove the input files once they are merged")
+    return parser.parse_args()
+
+def batches(paths, target_bytes):
+    """Split files into consecutive batches of about target_bytes."""
+    groups, current, size = [], [], 0
+    for path in paths:
+        file_size = os.path.getsize(path)
+        if current and size + file_size > target_bytes:
+            groups.append(current)
+            current, size = [], 0
+        current.append(path)
+        size += file_size
+    if current:
+        groups.append(current)
+    return groups
+
+def is_tree(obj):
+    """Whether an object of an output file is a step tree (TTree or RNTuple)."""
+    return isinstance(obj, (uproot.behaviors.TTree.TTree, uproot.behaviors.RNTuple.RNTuple))
+
+def tree_schema(obj):
+    """Branch names and types of a step tree, to check that trees can be concatenated."""
+    if isinstance(obj, uproot.behaviors.RNTuple.RNTuple):
+        return str(obj.arrays(entry_stop=0).type.content)
+    return sorted(obj.typenames().items())
+
+def scan_inputs(paths):
+    """
+    Names of the step trees and histograms of the inputs, checking that the
+    trees have the same schema in every file.
+
+    Returns:
+        :return: (dict of tree name -> schema, list of histogram names)
+    """
+    schemas, histograms = {}, []
+    for path in paths:
+        with uproot.open(path) as fin:
+            if "sourceFile" in fin:
+                raise ValueError(f"{path} holds friend trees, which are joined per input file "
+                                 "and cannot be merged.")
+            for key, obj in fin.items(cycle=False):
+                if is_tree(obj):
+                    schema = tree_schema(obj)
+                    if schemas.setdefault(key, schema) != schema:
+                        raise ValueError(f"Branches of {key} in {path} differ from the "
+                                         "other files of the batch.")
+                elif key not in histograms:
+                    histograms.append(key)
+    return schemas, histograms
+
+def merge_batch(paths, output, step_size, output_cfg=None):
+    """
+    Concatenate the step trees of paths into output, reading and writing
+    step_size entries at a time, and sum their histograms.
+
+    Returns:
+        :return: (output, dict of tree name -> entries)
+    """
+    schemas, histogram_names = scan_inputs(paths)
+    entries = {}
+    index_trees = []
+    tmp_output = f"{output}.{os.getpid()}.tmp"
+    with uproot.recreate(tmp_output) as fout:
+        for key in schemas:
+            out_tree = None
+            ids = {}
+            for path in paths:
+                with uproot.open(path) as fin:
+                    if key not in fin:
+                        continue
+                    obj = fin[key]
+                    is_rntuple = isinstance(obj, uproot.behaviors.RNTuple.RNTuple)
+                    for start in range(0, obj.num_entries, step_size):
+                        chunk = obj.arrays(entry_start=start, entry_stop=start + step_size)
+                        for name in {name for names in KEY_BRANCHES for name in names}:
+                            if name in chunk.fields:
+                                ids.setdefault(name, []).append(np.asarray(chunk[name]))
+                        if is_rntuple:
+                            if out_tree is None:
+                                step = cluster_size(chunk, (output_cfg or {}).get("rntuple", {}))
+                                out_tree = fout.mkrntuple(key, chunk[:step])
+                                chunk = chunk[step:]
+                            for part in range(0, len(chunk), step):
+                                out_tree.extend(chunk[part:part + step])
+                        else:
+                            branches = group_record_names(chunk)
+                            if out_tree is None:
+                                out_tree = fout.mktree(key, branches)
+                            else:
+                                out_tree.extend(branches)
+            entries[key] = out_tree.num_entries if out_tree is not None else 0
+            index_trees.append((output, key, {name: np.concatenate(parts)
+                                              for name, parts in ids.items()}))
+
+        # weightedEvents, cutflow and onecut histograms are summed,
+        # the efficiencies are computed again from the summed cutflows
+        summed = {}
+        for name in histogram_names:
+            if "efficiency" in name:
+                continue
+            for path in paths:
+                with uproot.open(path) as fin:
+                    if name not in fin:
+                        continue
+                    histo = fin[name].to_hist()
+                if "unweighted" in name:
+                    # Unweighted cutflows are counts, TH1D are read back with Weight storage
+                    counts = hist.Hist(*histo.axes, storage=hist.storage.Double())
+                    counts.view(flow=True)[...] = histo.values(flow=True)
+                    histo = counts
+                summed[name] = summed[name] + histo if name in summed else histo
+        steps = [name[len("cutflow_"):] for name in summed
+                 if name.startswith("cutflow_") and not name.startswith("cutflow_unweighted_")]
+        for step_name in steps:
+            summed.update(cutflow_efficiencies(summed, step_name))
+        for name, histo in summed.items():
+            fout[name] = histo
+    os.replace(tmp_output, output)
+
+    EventIndex.from_trees(index_trees).save(output.replace(".root", INDEX_EXTENSION))
+    return output, entries
+
+def main():
+    """Main function"""
+    args = argparser()
+    fw_config = utils.parse_main_config()
+    eras = args.eras.split(",") if args.eras else dataset_eras(fw_config["fw_dir"])
+    channels = args.channels.split(",")
+    processes = args.processes.split(",") if args.processes else None
+    target_bytes = args.target_size * 1024**3
+
+    files = discover(fw_config, eras, channels, processes, args.systematic)
+    groups = {}
+    for output_file in files:
+        groups.setdefault((output_file.era, output_file.process, output_file.channel),
+                          []).append(output_file.path)
+
+    tasks = []
+    for (era, process, chan), paths in sorted(groups.items()):
+        output_dir = args.output_dir.replace("<era>", era) if args.output_dir \
+            else tree_dir(fw_config, era, args.systematic) + "_merged"
+        os.makedirs(os.path.join(output_dir, chan), exist_ok=True)
+        for i, batch in enumerate(batches(sorted(paths), target_bytes)):
+            output = os.path.join(output_dir, chan, f"{chan}_{era}_{process}_merged{i}.root")
+            tasks.append((batch, output))
+    print(f"Merging {len(files)} files into {len(tasks)} files...")
+    with open(fw_config["fw_dir"] + "/config/selection/output.yml", "r", encoding="utf-8") as f:
+        output_cfg = yaml.safe_load(f)["Output"]
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(merge_batch, batch, output, args.step_size,
+                                   output_cfg): (batch, output)
+                   for batch, output in tasks}
+        for future in as_completed(futures):
+            batch, output = futures[future]
+            try:
+                _, entries = future.result()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                print(f"ERROR: Merging into {output} failed: {e}")
+                failed.append(output)
+                continue
+            print(f"Merged {len(batch)} files into {output}: {entries}")
+            if args.remove_inputs:
+                for path in batch:
+                    os.remove(path)
+    if failed:
+        raise RuntimeError(f"Merging failed for {len(failed)}/{len(tasks)} files: {failed}")
+
+if __name__ == "__main__":
+    main()
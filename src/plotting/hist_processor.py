@@ -3,12 +3,36 @@ Coffea processor for multiple histogram making.
 For plotting purposes.
 """
 import hist
+import hist.dask
 from coffea import processor
 import awkward as ak
-from uncertainties import ufloat
-import common.utils
+from common.histo_ops import merge_flows
 from common.variables import get_variable
 
+def weight_signature(histo_config):
+    """Weights and rejected weights of a histogram, the key of its weight product."""
+    return (tuple(histo_config['weights']), tuple(histo_config.get('reject_weights', ())))
+
+def fill_plan(step_histos, weighted=True):
+    """
+    Group the histograms of a step by the variable they are filled with,
+    (field, subIdx), then by their weight signature, so that every variable is
+    extracted and every weight product is computed once per chunk.
+
+    Args:
+        :param step_histos: Histogram configurations of the step
+        :param weighted: Whether the histograms are filled with weights (MC)
+        :return: dict of (field, subIdx) to dict of weight signature (None if
+                 not weighted) to the names of the histograms to fill
+    """
+    plan = {}
+    for histo, histo_config in step_histos.items():
+        signature = weight_signature(histo_config) if weighted else None
+        for field in histo_config['field'].split(","):
+            variable = (field, histo_config.get("subIdx", None))
+            plan.setdefault(variable, {}).setdefault(signature, []).append(histo)
+    return plan
+
 class HistProcessor(processor.ProcessorABC):
     """Processor to create histograms from events."""
     def __init__(self, args, step_histos, step, mode="virtual"):
@@ -20,86 +44,97 @@ class HistProcessor(processor.ProcessorABC):
         self.step = step
 
     def process(self, events):
-        """Process the events and fill histograms."""
-        histos = {}
-        for histo, histo_config in self.step_histos.items():
-            hist_axis = None
-            match histo_config['axis_type']:
-                case 'Regular':
-                    if 'inputs' in histo_config:
-                        hist_axis = hist.axis.Regular(
-                            *histo_config["inputs"],
-                            name=histo_config['field'], label=histo_config['label']
-                        )
-                    else:
-                        hist_axis = hist.axis.Regular(
-                            histo_config["nbins"], histo_config["xmin"], histo_config["xmax"],
-                            name=histo_config['field'], label=histo_config['label']
-                        )
-                case _:
-                    raise ValueError(f"Axis type {histo_config['axis_type']} not recognized.")
-
-            hh_subproc = hist.Hist(hist_axis, storage=hist.storage.Weight())
-            weight_arr = self.get(events,histo_config['weights'][0])
-            if len(histo_config['weights']) > 1:
-                for w in histo_config['weights'][1:]:
-                    new_weight = self.get(events,w)
-                    if new_weight.layout.minmax_depth != (1,1):
-                        new_weight = ak.prod(new_weight, axis=1)
-                    weight_arr = weight_arr * new_weight
-            if "reject_weights" in histo_config:
-                for rw in histo_config['reject_weights']:
-                    reject_weight = self.get(events,rw)
-                    if reject_weight.layout.minmax_depth != (1,1):
-                        reject_weight = ak.prod(reject_weight, axis=1)
-                    weight_arr = weight_arr / reject_weight
+        """
+        Process the events and fill histograms. The histograms sharing a variable
+        and weights are filled from the same flattened arrays (see fill_plan).
+        """
+        histos = {histo: self.make_histogram(histo_config)
+                  for histo, histo_config in self.step_histos.items()}
+        weighted = events.metadata["isMC"]
+        weight_products = {}
+        for (field, sub_idx), signatures in fill_plan(self.step_histos, weighted).items():
+            var = self.get(events, field, sub_idx=sub_idx)
+            jagged = var.layout.minmax_depth != (1,1)
+            flat_var = ak.flatten(var) if jagged else var
+            nan_mask = ak.is_none(flat_var)
+            flat_var = flat_var[~nan_mask]
+            for signature, names in signatures.items():
+                if signature is None:
+                    for histo in names:
+                        histos[histo].fill(flat_var)
+                    continue
+                if signature not in weight_products:
+                    weight_products[signature] = self.weight_product(events, *signature)
+                weight_arr = weight_products[signature]
+                if jagged:
+                    weight_arr = ak.flatten(weight_arr*ak.ones_like(var, dtype=float))
+                weight_arr = weight_arr[~nan_mask]
+                for histo in names:
+                    histos[histo].fill(flat_var, weight=weight_arr)
 
-            fields = histo_config['field'].split(",")
-            for field in fields:
-                var = self.get(events,field,sub_idx=histo_config.get("subIdx", None))
+        if self._mode != "dask":
+            for histo, hh_subproc in histos.items():
+                histos[histo] = self.merge_flows(hh_subproc, self.step_histos[histo])
+        dataset = events.metadata["dataset"]
+        return {dataset: histos}
 
-                if events.metadata["isMC"]:
-                    if var.layout.minmax_depth != (1,1):
-                        new_weights = weight_arr*ak.ones_like(var, dtype=float)
-                        var = ak.flatten(var)
-                        weight_arr = ak.flatten(new_weights)
-                    nan_mask = ak.is_none(var)
-                    var = var[~nan_mask]
-                    weight_arr = weight_arr[~nan_mask]
-                    hh_subproc.fill(var, weight=weight_arr)
+    def make_histogram(self, histo_config):
+        """Empty weighted histogram of a configuration."""
+        hist_axis = None
+        match histo_config['axis_type']:
+            case 'Regular':
+                if 'inputs' in histo_config:
+                    hist_axis = hist.axis.Regular(
+                        *histo_config["inputs"],
+                        name=histo_config['field'], label=histo_config['label']
+                    )
                 else:
-                    if var.layout.minmax_depth != (1,1):
-                        var = ak.flatten(var)
-                    nan_mask = ak.is_none(var)
-                    var = var[~nan_mask]
-                    hh_subproc.fill(var)
+                    hist_axis = hist.axis.Regular(
+                        histo_config["nbins"], histo_config["xmin"], histo_config["xmax"],
+                        name=histo_config['field'], label=histo_config['label']
+                    )
+            case _:
+                raise ValueError(f"Axis type {histo_config['axis_type']} not recognized.")
 
-            if 'merge_overflow' in histo_config and not histo_config['merge_overflow']:
-                pass
-            else:
-                overflow = hh_subproc[hist.overflow]
-                if overflow.value != 0:
-                    hh_uarray = common.utils.convert_hist_to_uarray(hh_subproc)
-                    overflow = ufloat(overflow.value, overflow.variance**0.5)
-                    hh_uarray[-1] = hh_uarray[-1] + overflow
-                    hh_subproc = common.utils.convert_uarray_to_hist(hh_subproc, hh_uarray)
+        # In dask mode the histograms are filled when the task graph is computed
+        Hist = hist.dask.Hist if self._mode == "dask" else hist.Hist
+        return Hist(hist_axis, storage=hist.storage.Weight())
 
-            if 'merge_underflow' in histo_config and not histo_config['merge_underflow']:
-                pass
-            else:
-                underflow = hh_subproc[hist.underflow]
-                if underflow.value != 0:
-                    hh_uarray = common.utils.convert_hist_to_uarray(hh_subproc)
-                    underflow = ufloat(underflow.value, underflow.variance**0.5)
-                    hh_uarray[0] = hh_uarray[0] + underflow
-                    hh_subproc = common.utils.convert_uarray_to_hist(hh_subproc, hh_uarray)
+    def weight_product(self, events, weights, reject_weights=()):
+        """
+        Per-event weight: the product of the weights, divided by the rejected
+        weights. Per-object weights after the first one are multiplied per event.
+        """
+        weight_arr = self.get(events,weights[0])
+        for w in weights[1:]:
+            new_weight = self.get(events,w)
+            if new_weight.layout.minmax_depth != (1,1):
+                new_weight = ak.prod(new_weight, axis=1)
+            weight_arr = weight_arr * new_weight
+        for rw in reject_weights:
+            reject_weight = self.get(events,rw)
+            if reject_weight.layout.minmax_depth != (1,1):
+                reject_weight = ak.prod(reject_weight, axis=1)
+            weight_arr = weight_arr / reject_weight
+        return weight_arr
 
-            histos[histo] = hh_subproc
-        dataset = events.metadata["dataset"]
-        return {dataset: histos}
+    def merge_flows(self, hh_subproc, histo_config):
+        """Merge the overflow and underflow into the last and first bins, unless disabled."""
+        return merge_flows(hh_subproc,
+                           overflow=histo_config.get('merge_overflow', True),
+                           underflow=histo_config.get('merge_underflow', True))
 
     def postprocess(self, accumulator):
-        """Postprocess the histograms. Not used in this case."""
+        """
+        Merge the flow bins of the computed histograms in dask mode, where they
+        cannot be merged while the task graph is built.
+        """
+        if self._mode != "dask":
+            return accumulator
+        for histos in accumulator.values():
+            for histo, hh_subproc in histos.items():
+                histos[histo] = self.merge_flows(hh_subproc, self.step_histos[histo])
+        return accumulator
 
     def get(self, events, field, sub_idx=None):
         """Get a field from the events, handling nested fields."""
@@ -4,13 +4,23 @@ Not used for Stack Plots, but for individual sample histograms
 """
 import json
 import os
+import time
+import dask
+import dask_awkward as dak
+import uproot
 from coffea import processor
 from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
 import matplotlib.pyplot as plt
 import mplhep as hep
+import common.dask_cluster as dask_cluster
+import common.parquet_cache as parquet_cache
+import common.preprocess_cache as preprocess_cache
+from common.pipeline import available_cpus, chunk_ranges
 from plotting.hist_processor import HistProcessor
 from plotting.plots_constants import COLOR_PALETTE_6
 
+EXECUTORS = ["futures", "iterative", "dask"]
+
 style = hep.style.CMS
 style["font.size"] = 20
 plt.style.use(style)
@@ -41,6 +51,206 @@ def make_plot(histogram, era, config, output_path, args, data=False):
     plt.savefig(output_path)
     plt.close(fig)
 
+def split_cached(fileset, parquet_inputs):
+    """
+    Move the files converted to the Parquet cache out of the fileset.
+
+    Returns:
+        :return: dict of dataset -> list of (source file, ParquetInput)
+    """
+    cached = {}
+    for dataset in list(fileset):
+        for filename in list(fileset[dataset]["files"]):
+            cached_input = parquet_inputs.input(filename)
+            if cached_input is None:
+                continue
+            cached.setdefault(dataset, []).append((filename, cached_input))
+            del fileset[dataset]["files"][filename]
+        if not fileset[dataset]["files"]:
+            del fileset[dataset]
+    return cached
+
+def cached_chunks(cached, fileset_metadata, chunksize, maxchunks=None):
+    """
+    Chunks of chunksize entries of the cached files, as the Runner splits the
+    ROOT files, with at most maxchunks chunks per dataset.
+
+    Returns:
+        :return: list of (source file, ParquetInput, metadata, entry_start, entry_stop)
+    """
+    chunks = []
+    for dataset, inputs in cached.items():
+        metadata = dict(fileset_metadata[dataset], dataset=dataset)
+        dataset_chunks = [(filename, cached_input, metadata, entry_start, entry_stop)
+                          for filename, cached_input in inputs
+                          for entry_start, entry_stop in chunk_ranges(
+                              0, cached_input.num_entries, chunksize)]
+        chunks += dataset_chunks[:maxchunks]
+    return chunks
+
+class CachedChunk:
+    """
+    Histograms of a chunk of a cached file, reading the NanoAOD file when a branch
+    is missing from the cache. Picklable, to be run by the executors.
+    """
+    def __init__(self, proc):
+        """Initialize with the histogram processor."""
+        self.proc = proc
+
+    def __call__(self, chunk):
+        filename, cached_input, metadata, entry_start, entry_stop = chunk
+        try:
+            return self.proc.process(cached_input.events(
+                metadata=metadata, entry_start=entry_start, entry_stop=entry_stop))
+        except (AttributeError, ValueError) as e:
+            print(f"WARNING: Parquet cache of {filename} incomplete ({e}). "
+                  "Reading the NanoAOD file.")
+            return self.proc.process(NanoEventsFactory.from_root(
+                {filename: "Events"},
+                entry_start=entry_start,
+                entry_stop=entry_stop,
+                schemaclass=NanoAODSchema,
+                metadata=metadata
+            ).events())
+
+def process_cached(cached, fileset_metadata, proc, cfg):
+    """
+    Run the histogram processor on the chunks of the cached files with the
+    executor of the NanoAOD files (the tasks are sent to the running dask client
+    in dask mode), and postprocess the histograms as the Runner does.
+    """
+    chunks = cached_chunks(cached, fileset_metadata, cfg["chunksize"], cfg["maxchunks"])
+    print(f"Processing {len(chunks)} chunks of the Parquet cache...")
+    if cfg["executor"] == "dask":
+        out = processor.accumulate(dask.compute(
+            *[dask.delayed(CachedChunk(proc))(chunk) for chunk in chunks],
+            retries=cfg["retries"]))
+    else:
+        out, _ = make_executor(cfg)(chunks, CachedChunk(proc), {})
+    return proc.postprocess(out)
+
+def executor_cfg(args, main_config):
+    """
+    Executor of the NanoAOD histograms and its chunking, from the command line or
+    the plot_* keys of main.cfg. Without a number of workers, one worker is used
+    per CPU available to the job (cgroup quota and affinity).
+    """
+    executor = getattr(args, "executor", None) or main_config.get("plot_executor") or "futures"
+    if executor not in EXECUTORS:
+        raise ValueError(f"Executor {executor} not recognized. Available executors: {EXECUTORS}")
+    workers = getattr(args, "workers", None)
+    if workers is None:
+        workers = int(main_config.get("plot_workers") or 0)
+    chunksize = getattr(args, "chunksize", None)
+    if chunksize is None:
+        chunksize = int(main_config.get("plot_chunksize") or 100000)
+    maxchunks = getattr(args, "maxchunks", None)
+    if maxchunks is None:
+        maxchunks = int(main_config.get("plot_maxchunks") or 0)
+    retries = getattr(args, "retries", None)
+    if retries is None:
+        retries = int(main_config.get("plot_retries") or 0)
+    return {
+        "executor": executor,
+        "workers": workers or available_cpus(),
+        "chunksize": chunksize,
+        "maxchunks": maxchunks or None,
+        "retries": retries,
+    }
+
+def make_executor(cfg):
+    """coffea executor of the futures or iterative executor configuration."""
+    if cfg["executor"] == "iterative":
+        return processor.IterativeExecutor(retries=cfg["retries"])
+    return processor.FuturesExecutor(workers=cfg["workers"], compression=None,
+                                     retries=cfg["retries"])
+
+def make_runner(cfg, file_metadata=None):
+    """
+    coffea Runner of the futures or iterative executor, saving the metrics of the
+    chunks. The files found in the preprocessing cache file_metadata are not
+    preprocessed again.
+    """
+    return processor.Runner(
+        executor=make_executor(cfg),
+        schema=NanoAODSchema,
+        chunksize=cfg["chunksize"],
+        maxchunks=cfg["maxchunks"],
+        savemetrics=True,
+        metadata_cache=file_metadata,
+    )
+
+def dask_files(files, partition_size, maxchunks=None, file_metadata=None):
+    """
+    Files of a dataset with the entry ranges of their partitions of partition_size
+    entries, in the format of uproot.dask. At most maxchunks partitions are kept.
+    The numbers of entries are taken from the preprocessing cache file_metadata if given.
+    """
+    steps = {}
+    n_steps = 0
+    for filename, treepath in files.items():
+        if maxchunks is not None and n_steps >= maxchunks:
+            break
+        if file_metadata is not None:
+            file_steps = file_metadata.steps(filename, partition_size, treepath)
+        else:
+            with uproot.open(filename) as f:
+                file_steps = chunk_ranges(0, f[treepath].num_entries, partition_size)
+        if maxchunks is not None:
+            file_steps = file_steps[:maxchunks - n_steps]
+        n_steps += len(file_steps)
+        steps[filename] = {"object_path": treepath,
+                           "steps": [list(step) for step in file_steps]}
+    return steps
+
+def process_dask(fileset, proc, cfg, file_metadata=None):
+    """
+    Build the histogram task graph of every dataset and compute them together on
+    the dask cluster, reading only the branches the histograms use.
+
+    Returns:
+        :return: (histograms, metrics in the format of the coffea Runner)
+    """
+    graphs = {}
+    metrics = {"entries": 0, "chunks": 0}
+    for dataset, info in fileset.items():
+        files = dask_files(info["files"], cfg["chunksize"], cfg["maxchunks"], file_metadata)
+        for file_steps in files.values():
+            metrics["chunks"] += len(file_steps["steps"])
+            metrics["entries"] += sum(stop - start for start, stop in file_steps["steps"])
+        events = NanoEventsFactory.from_root(
+            files,
+            schemaclass=NanoAODSchema,
+            metadata=dict(info["metadata"], dataset=dataset),
+            mode="dask",
+        ).events()
+        graphs.update(proc.process(events))
+    metrics["columns"] = sorted({column for columns in dak.necessary_columns(
+        *[histo for histos in graphs.values() for histo in histos.values()]).values()
+                                 for column in columns})
+    print(f"Computing the histograms of {len(graphs)} datasets...")
+    tic = time.time()
+    (out,) = dask.compute(graphs, retries=cfg["retries"])
+    metrics["processtime"] = time.time() - tic
+    return proc.postprocess(out), metrics
+
+def write_metrics(path, cfg, metrics, wall_time, n_cached=0):
+    """Write the executor settings and the metrics of a run as a JSON report."""
+    report = {
+        "executor": cfg,
+        "wall_time": wall_time,
+        "cached_files": n_cached,
+        "metrics": {key: sorted(value) if isinstance(value, (list, set)) else value
+                    for key, value in metrics.items()},
+    }
+    if report["metrics"].get("processtime") and report["metrics"].get("entries"):
+        report["events_per_second"] = report["metrics"]["entries"] \
+            / report["metrics"]["processtime"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"Saved metrics report: {path}")
+
 def make_plotting(args):
     """Make histograms from NanoAOD files."""
 
@@ -80,15 +290,50 @@ def make_plotting(args):
         print(out)
         raise NotImplementedError("Debug mode, stopping after processing one file.")
 
-    futures_run = processor.Runner(
-        executor=processor.FuturesExecutor(workers=16, compression=None),
-        schema=NanoAODSchema,
-        savemetrics=True,
-    )
-    out, _ = futures_run(
-        fileset,
-        processor_instance=HistProcessor(args, args.cfg, "_", mode="virtual"),
-    )
+    # Files converted with make_parquet_cache.py are read from parquet_cache_dir,
+    # the coffea Runner does not preprocess Parquet so they are processed here
+    fileset_metadata = {dataset: fileset[dataset]["metadata"] for dataset in fileset}
+    cached = {}
+    parquet_inputs = parquet_cache.from_main_config(args.main_config)
+    if parquet_inputs is not None:
+        cached = split_cached(fileset, parquet_inputs)
+        print(f"Reading {sum(len(inputs) for inputs in cached.values())} files "
+              "from the Parquet cache")
+
+    # Reuse the entries and UUIDs of the files if preprocess_cache_dir is set in main.cfg
+    file_metadata = preprocess_cache.from_main_config(args.main_config)
+    cfg = executor_cfg(args, args.main_config)
+    print(f"Executor: {cfg['executor']} with {cfg['workers']} workers, "
+          f"chunks of {cfg['chunksize']} entries")
+    out = {}
+    metrics = {}
+    tic = time.time()
+    cached_proc = HistProcessor(args, args.cfg, "_", mode="virtual")
+    if (fileset or cached) and cfg["executor"] == "dask":
+        # On the scheduler of main.cfg, or on a local cluster of the workers
+        dask_cfg = dask_cluster.dask_cfg(args.main_config,
+                                         args.main_config.get("dask_scheduler") or "local")
+        with dask_cluster.start_client(dict(dask_cfg, workers=cfg["workers"])):
+            if fileset:
+                out, metrics = process_dask(
+                    fileset, HistProcessor(args, args.cfg, "_", mode="dask"), cfg,
+                    file_metadata)
+            if cached:
+                out = processor.accumulate(
+                    [process_cached(cached, fileset_metadata, cached_proc, cfg)], out)
+    else:
+        if fileset:
+            out, metrics = make_runner(cfg, file_metadata)(
+                fileset,
+                processor_instance=HistProcessor(args, args.cfg, "_", mode="virtual"),
+            )
+        if cached:
+            out = processor.accumulate(
+                [process_cached(cached, fileset_metadata, cached_proc, cfg)], out)
+    write_metrics(f"{args.main_config['plot_dir']}/nanoaod/metrics/"
+                  f"{time.strftime('%Y%m%d-%H%M%S')}.json",
+                  cfg, metrics, time.time() - tic,
+                  sum(len(inputs) for inputs in cached.values()))
     # We assume that args.cfg is a dict with the histogram configurations,
     # step is left as "_" since it's not relevant for plotting at the nanoaod level.
     for sample in out:
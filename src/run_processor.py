@@ -6,12 +6,47 @@ import importlib
 import sys
 import pathlib
 import argparse
+import gc
+import inspect
 import json
+import multiprocessing
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import uproot
-from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
-from coffea.util import save
+import awkward as ak
+import dask
+import dask_awkward as dak
 import common.utils as utils
+import common.staging as staging
+import common.form_cache as form_cache
+import common.parquet_cache as parquet_cache
+import common.pipeline as pipeline
+import common.dask_cluster as dask_cluster
+import common.preprocess_cache as preprocess_cache
+import selection.preselection_cache as preselection_cache
+from common.checkpoint import Checkpoint, checkpoint_dir
+from common.selection_jobs import channel_file, selection_hash, shard_tag
+from common.file_context import NanoAODFile
+from common.job_queue import JobQueue
+from common.histo_container import EXTENSION, write_container
+from common.event_index import EventIndex, KEY_BRANCHES, EXTENSION as INDEX_EXTENSION
+from corrections.loader import preload_corrections
+from common.output_formats import OUTPUT_FORMATS, apply_dtypes, write_tree
+from selection.accumulators import TreeColumns, materialize_output, merge_outputs
+
+# Branches read by the selector per (selector class, dataset), so the next files of the
+# process (file lists, --merge, --serve) are preloaded from their first chunk
+_read_columns = {}
+
+def parse_metadata(metadata):
+    """Metadata dict from comma-separated key:value pairs."""
+    if isinstance(metadata, dict):
+        return dict(metadata)
+    items = metadata.split(",") if metadata else []
+    return {item.split(":")[0]: item.split(":")[1] for item in items}
 
 def load_cfg(fw_dir, args):
     """Load configuration for the processor."""
@@ -20,7 +55,9 @@ def load_cfg(fw_dir, args):
     cfg["fw_dir"] = fw_dir
     # Load tree configuration
     with open(fw_dir+"/config/selection/tree_structure.yml", "r", encoding="utf-8") as f:
-        cfg["structure"] = yaml.safe_load(f)["tree"]
+        _file = yaml.safe_load(f)
+        cfg["structure"] = _file["tree"]
+        cfg["dtypes"] = _file.get("dtypes", {})
 
     with open(fw_dir+"/config/selection/weights.yml", "r", encoding="utf-8") as f:
         cfg["weights"] = yaml.safe_load(f)["Weights"]
@@ -31,13 +68,82 @@ def load_cfg(fw_dir, args):
             cfg["HLT"] = _file["HLT"][cfg["era"]]
         except KeyError:
             cfg["HLT"] = _file["HLT"][cfg["era"][:4]]
-    cfg["tag"] = args.output if args.output != "" else args.input.replace(".root", "")
-    cfg["hist_tag"] = args.output_histos if args.output_histos != "" \
-            else args.input.replace(".root", "")
-    cfg['file'] = args.input
 
+    with open(fw_dir+"/config/selection/output.yml", "r", encoding="utf-8") as f:
+        cfg["output"] = yaml.safe_load(f)["Output"]
+    if args.output_format != "":
+        cfg["output"]["format"] = args.output_format
+
+    return cfg
+
+def pipeline_cfg(args, fw_config):
+    """Chunking of the input files and memory budget, from the command line or main.cfg."""
+    chunk_size = getattr(args, "chunk_size", None)
+    max_rss = getattr(args, "max_rss", None)
+    if max_rss is None:
+        max_rss = fw_config.get("max_rss", "")
+    return {
+        "chunk_size": chunk_size if chunk_size is not None
+                      else int(fw_config.get("chunk_size") or 0),
+        "max_rss": pipeline.parse_size(max_rss) if max_rss else 0,
+        "prefetch": getattr(args, "prefetch", 1),
+        "decompression_workers": getattr(args, "decompression_workers", 4),
+    }
+
+def file_cfg(cfg, job):
+    """Per-file copy of the processor configuration."""
+    cfg = dict(cfg)
+    cfg["tag"] = job["output"] if job["output"] != "" else job["input"].replace(".root", "")
+    cfg["hist_tag"] = job["output_histos"] if job["output_histos"] != "" \
+            else job["input"].replace(".root", "")
+    cfg['file'] = job["input"]
+    cfg["source_file"] = job["input"]
+    if job.get("entry_start"):
+        cfg["entry_start"] = int(job["entry_start"])
+    if job.get("entry_stop") is not None:
+        cfg["entry_stop"] = int(job["entry_stop"])
+    if job.get("adler32"):
+        cfg["adler32"] = job["adler32"]
     return cfg
 
+def load_jobs(args):
+    """
+    List of files to process, each as a dict with input, output, output_histos and
+    the entry range (entry_start, entry_stop).
+
+    The input can be a NanoAOD file, a text file with one NanoAOD file per line or
+    a JSON manifest with a list of {"input", "output", "output_histos"} entries,
+    with optional "entry_start", "entry_stop" and "adler32" (checksum of the input,
+    to verify its staged copy).
+    For file lists, --output and --output_histos are the directories where the
+    per-file tags are created.
+    """
+    if args.input.endswith(".json"):
+        with open(args.input, "r", encoding="utf-8") as f:
+            jobs = json.load(f)
+        return [{"input": job["input"],
+                 "output": job.get("output", ""),
+                 "output_histos": job.get("output_histos", ""),
+                 "entry_start": job.get("entry_start", 0),
+                 "entry_stop": job.get("entry_stop"),
+                 "adler32": job.get("adler32")} for job in jobs]
+    if args.input.endswith(".txt"):
+        with open(args.input, "r", encoding="utf-8") as f:
+            inputs = [line.strip() for line in f
+                      if line.strip() and not line.strip().startswith("#")]
+        jobs = []
+        for input_file in inputs:
+            name = input_file.split("/")[-1].replace(".root", "")
+            jobs.append({
+                "input": input_file,
+                "output": os.path.join(args.output, name) if args.output != "" else "",
+                "output_histos": os.path.join(args.output_histos, name + "_histo")
+                                 if args.output_histos != "" else "",
+            })
+        return jobs
+    return [{"input": args.input, "output": args.output, "output_histos": args.output_histos,
+             "entry_start": args.entry_start, "entry_stop": args.entry_stop}]
+
 def load_processor(fw_config):
     """Dynamically load the user processor."""
     selector_script = fw_config["fw_dir"]+"/selectors/"+fw_config["selector"]+".py"
@@ -51,140 +157,665 @@ def load_processor(fw_config):
 
     return module.Selector
 
+def status_path(fw_dir, input_file, shard=""):
+    """Path of the status file of an input file (or of a shard of it) in selection_status."""
+    if not os.path.exists(fw_dir + "/selection_status"):
+        os.makedirs(fw_dir + "/selection_status")
+    return fw_dir + "/selection_status/" + \
+        input_file.split("/")[-1].replace(".root", f"{shard}_status.out")
+
+def open_status_file(fw_dir, input_file, shard=""):
+    """Open the status file of an input file (or of a shard of it) in selection_status."""
+    status_file = open(status_path(fw_dir, input_file, shard), "w", # pylint: disable=consider-using-with
+                       encoding="utf-8")
+    status_file.write(f"Processing file: {input_file}\n")
+    if shard:
+        status_file.write(f"Entry range: {shard[len('_entries'):]}\n")
+    return status_file
+
+def job_checkpoint(fw_dir, job, selector_class):
+    """Checkpoint of a job, next to its status file."""
+    return Checkpoint(checkpoint_dir(fw_dir, job["input"], shard_tag(job)), job["input"],
+                      int(job.get("entry_start") or 0), job.get("entry_stop"),
+                      selection_hash(fw_dir, inspect.getsourcefile(selector_class)))
+
+def open_input(tree_cfg, stage_cache=None):
+    """
+    Input of a file: its Parquet cache if the file was converted, otherwise the
+    NanoAOD file (staged if configured).
+    """
+    parquet_inputs = tree_cfg.get("parquet_cache")
+    if parquet_inputs is not None:
+        cached = parquet_inputs.input(tree_cfg["source_file"])
+        if cached is not None:
+            tree_cfg["status_file"].write(f"Reading from Parquet cache: {cached.path}\n")
+            return cached
+    if stage_cache is not None:
+        tree_cfg["file"] = stage_cache.get(tree_cfg["file"], tree_cfg.get("adler32"))
+        tree_cfg["status_file"].write(f"Reading from: {tree_cfg['file']}\n")
+    return NanoAODFile(tree_cfg["file"])
+
+def process_chunks(selector_class, tree_cfg, events_forms=None):
+    """
+    Run the selector chunk by chunk, reading the next chunks while the current
+    one is processed and materializing the outputs of the processed ones in the
+    background. The branches accessed on the first chunk are read eagerly, in
+    parallel, for the next ones; the first chunk is a short probe so the reads of
+    the next ones wait little for it. Once a file of the dataset was processed, its
+    branches are preloaded from the first chunk and no read waits.
+    With a max_rss budget, the chunks are sized from the memory measured after
+    each chunk, and a chunk running out of memory is retried in two halves.
+    The processed chunks are stored in the checkpoint of the job, and a rerun
+    continues from the first unfinished entry.
+    """
+    pipeline_cfg = tree_cfg["pipeline"]
+    input_file = tree_cfg["input_file"]
+    dataset = f"{tree_cfg.get('era', '')}_{tree_cfg.get('process', '')}"
+    entry_start = tree_cfg.get("entry_start", 0)
+    # An explicit entry_stop of 0 is an empty range, not the end of the file
+    entry_stop = input_file.num_entries if tree_cfg.get("entry_stop") is None \
+        else min(tree_cfg["entry_stop"], input_file.num_entries)
+    # A shard past the end of the file (the file has fewer entries than when the
+    # jobs were made) gets the output of an empty range
+    entry_start = min(entry_start, entry_stop)
+    checkpoint = tree_cfg.get("checkpoint")
+    previous = []
+    if checkpoint is not None and checkpoint.next_entry > entry_start:
+        print(f"Resuming from entry {checkpoint.next_entry}...")
+        tree_cfg["status_file"].write(f"Resuming from entry {checkpoint.next_entry}\n")
+        previous = checkpoint.outputs()
+        entry_start = checkpoint.next_entry
+    if pipeline_cfg["max_rss"] > 0:
+        chunks = pipeline.AdaptiveChunks(entry_start, entry_stop, pipeline_cfg["max_rss"],
+                                         pipeline_cfg["chunk_size"] or pipeline.PROBE_CHUNK_SIZE)
+        print(f"Processing {entry_stop - entry_start} events in chunks under "
+              f"{pipeline.format_size(pipeline_cfg['max_rss'])}...")
+    else:
+        chunks = pipeline.chunk_ranges(entry_start, entry_stop, pipeline_cfg["chunk_size"])
+        probe = min(pipeline.PROBE_CHUNK_SIZE, pipeline_cfg["chunk_size"])
+        if (selector_class, dataset) not in _read_columns and len(chunks) > 1 \
+                and chunks[0][1] - chunks[0][0] > probe:
+            chunks = [(entry_start, entry_start + probe)] + \
+                pipeline.chunk_ranges(entry_start + probe, entry_stop, pipeline_cfg["chunk_size"])
+        print(f"Processing {entry_stop - entry_start} events in {len(chunks)} chunks...")
+    if entry_start == entry_stop and not previous:
+        chunks = [(entry_start, entry_stop)]
+
+    # One selector for all the chunks, process() starts every chunk from a clean state
+    selector = selector_class(tree_cfg)
+    access_log = []
+    columns = set(_read_columns.get((selector_class, dataset), ()))
+    columns_ready = threading.Event()
+    if columns:
+        columns_ready.set()
+    retried = []
+    with ThreadPoolExecutor(max_workers=pipeline_cfg["decompression_workers"]) as executor:
+        def read(index, chunk):
+            # The entry range of the chunk, as in the metadata of a coffea Runner chunk
+            metadata = {"filename": tree_cfg["source_file"], "entrystart": chunk[0],
+                        "entrystop": chunk[1]}
+            if index == 0 and not columns_ready.is_set():
+                return input_file.events(events_forms, dataset, metadata=metadata,
+                                         entry_start=chunk[0], entry_stop=chunk[1],
+                                         access_log=access_log)
+            # Only the reads started during the first chunk wait for its branches
+            columns_ready.wait()
+            return input_file.events(events_forms, dataset, metadata=metadata,
+                                     entry_start=chunk[0], entry_stop=chunk[1],
+                                     access_log=access_log if index == 0 else None,
+                                     preload=lambda branch: branch.name in columns,
+                                     decompression_executor=executor)
+
+        def process_range(index, chunk, events):
+            print(f"Processing entries {chunk[0]}-{chunk[1]}...")
+            try:
+                output = selector.process(events)
+            except MemoryError:
+                if not isinstance(chunks, pipeline.AdaptiveChunks) or \
+                        chunk[1] - chunk[0] <= chunks.min_size:
+                    raise
+                events = None
+                gc.collect()
+                chunks.shrink()
+                retried.append(chunk)
+                middle = (chunk[0] + chunk[1]) // 2
+                print(f"WARNING: Out of memory on entries {chunk[0]}-{chunk[1]}, "
+                      "retrying in two halves.")
+                return merge_outputs([process_range(index, half, read(index, half))
+                                      for half in [(chunk[0], middle), (middle, chunk[1])]])
+            if index == 0:
+                # Complete the access log before the next chunks are preloaded
+                output = materialize_output(output)
+                columns.update(access.branch for access in access_log)
+                _read_columns[(selector_class, dataset)] = set(columns)
+            return output
+
+        def compute(index, chunk, events):
+            if isinstance(chunks, pipeline.AdaptiveChunks):
+                chunks.begin(chunk)
+            try:
+                return chunk, process_range(index, chunk, events)
+            finally:
+                columns_ready.set()
+
+        def write(_, processed):
+            chunk, output = processed
+            output = materialize_output(output)
+            if isinstance(chunks, pipeline.AdaptiveChunks):
+                chunks.record(chunk, pipeline.current_rss())
+            if checkpoint is not None:
+                checkpoint.save_chunk(chunk, output)
+            return output
+
+        outputs = previous + pipeline.ChunkPipeline(
+            read, compute, write, prefetch=pipeline_cfg["prefetch"]).run(chunks)
+
+    if isinstance(chunks, pipeline.AdaptiveChunks):
+        tree_cfg["status_file"].write(
+            f"Chunk sizes: {','.join(str(size) for size in chunks.sizes)}\n")
+        for chunk in retried:
+            tree_cfg["status_file"].write(
+                f"Out of memory, retried in halves: {chunk[0]}-{chunk[1]}\n")
+    return merge_outputs(outputs)
+
+def run_selector(selector_class, tree_cfg, events_forms=None):
+    """Run the selector on the opened input file, in chunks if configured."""
+    pipeline_cfg = tree_cfg.get("pipeline", {})
+    if pipeline_cfg.get("chunk_size", 0) > 0 or pipeline_cfg.get("max_rss", 0) > 0:
+        return process_chunks(selector_class, tree_cfg, events_forms)
+    dataset = f"{tree_cfg.get('era', '')}_{tree_cfg.get('process', '')}"
+    entry_start = tree_cfg.get("entry_start")
+    if entry_start:
+        # A shard past the end of the file gets the output of an empty range
+        entry_start = min(entry_start, tree_cfg["input_file"].num_entries)
+    events = tree_cfg["input_file"].events(events_forms, dataset, metadata={},
+                                           entry_start=entry_start,
+                                           entry_stop=tree_cfg.get("entry_stop"))
+    selector = selector_class(tree_cfg)
+    print("Processing events...")
+    return selector.postprocess(selector.process(events))
+
+def process_file(selector_class, tree_cfg, stage_cache=None, events_forms=None):
+    """Run the selector on one input file and return its output."""
+    # One handle for the Runs sums and the Events tree
+    tree_cfg["input_file"] = open_input(tree_cfg, stage_cache)
+    try:
+        return run_selector(selector_class, tree_cfg, events_forms)
+    except (AttributeError, ak.errors.FieldNotFoundError) as e:
+        if not isinstance(tree_cfg["input_file"], parquet_cache.ParquetInput):
+            raise
+        # A branch the selector needs was not cached
+        print(f"WARNING: Parquet cache incomplete ({e}). Reading the NanoAOD file.")
+        tree_cfg["status_file"].write("Parquet cache incomplete, reading the NanoAOD file\n")
+        tree_cfg["parquet_cache"] = None
+        return process_file(selector_class, tree_cfg, stage_cache, events_forms)
+
+def dask_trees(trees, tree_cfg):
+    """
+    Delayed writes of the step trees of a dask output with uproot.dask_write, every
+    partition into <chan>_<tag>_<tree>-part<N>.root next to the channel file, and
+    the event identifiers of every partition for the event index.
+
+    Returns:
+        :return: (list of delayed writes, list of (file, tree, dict of identifiers))
+    """
+    writes, indexed_trees = [], []
+    for chan, chan_trees in trees.items():
+        chan_dir, chan_name = os.path.split(channel_file(tree_cfg["tag"], chan))
+        for key, columns in chan_trees.items():
+            if not columns:
+                print(f"WARNING: Branch {key} is empty. Skipping...")
+                continue
+            # uproot.dask_write writes TTrees, the sentinels are kept
+            array = ak.zip(apply_dtypes(dict(columns), tree_cfg["dtypes"], masks=False),
+                           depth_limit=1)
+            prefix = f"{chan_name}_{key}"
+            writes.append(uproot.dask_write(array, chan_dir, compute=False, prefix=prefix,
+                                            tree_name=key))
+            ids = {name: array[name] for names in KEY_BRANCHES for name in names
+                   if name in array.fields}
+            for i in range(array.npartitions):
+                indexed_trees.append((os.path.join(chan_dir, f"{prefix}-part{i}.root"), key,
+                                      {name: column.partitions[i] for name, column in ids.items()}))
+    return writes, indexed_trees
+
+def run_dask(selector_class, tree_cfg):
+    """
+    Dask mode: build the task graph of the selector over partitions of the input,
+    then compute the cutflows, histograms and event identifiers and write the step
+    trees in one pass on the dask cluster. Only the columns the outputs depend on
+    are read from the input.
+
+    Returns:
+        :return: (output without the step trees, list of indexed partitions)
+    """
+    input_file = NanoAODFile(tree_cfg["file"])
+    file_metadata = tree_cfg.get("file_metadata")
+    if file_metadata is not None:
+        # The entry ranges come from the preprocessing cache, the file is not opened here
+        steps = file_metadata.steps(tree_cfg["file"], tree_cfg["dask"]["partition_size"],
+                                    entry_start=tree_cfg.get("entry_start", 0),
+                                    entry_stop=tree_cfg.get("entry_stop"))
+    else:
+        with input_file:
+            entry_stop = input_file.num_entries if tree_cfg.get("entry_stop") is None \
+                else min(tree_cfg["entry_stop"], input_file.num_entries)
+            steps = pipeline.chunk_ranges(tree_cfg.get("entry_start", 0), entry_stop,
+                                          tree_cfg["dask"]["partition_size"])
+    events = input_file.dask_events(steps, metadata={})
+    print(f"Building the task graph of {events.npartitions} partitions...")
+    selector = selector_class(tree_cfg, mode="dask")
+    output = selector.process(events)
+
+    trees = {chan: {key: value for key, value in chan_trees.items()
+                    if isinstance(value, TreeColumns)}
+             for chan, chan_trees in output.get("tree", {}).items()}
+    if "tree" in output:
+        output["tree"] = {chan: {key: value for key, value in chan_trees.items()
+                                 if not isinstance(value, TreeColumns)}
+                          for chan, chan_trees in output["tree"].items()}
+    writes, indexed_trees = dask_trees(trees, tree_cfg)
+    tree_cfg["status_file"].write(f"Dask partitions: {events.npartitions}\n")
+    arrays = [column for chan_trees in trees.values() for columns in chan_trees.values()
+              for column in columns.values()]
+    if arrays:
+        columns = dak.necessary_columns(*arrays)
+        tree_cfg["status_file"].write(f"Columns read for the step trees: "
+                                      f"{sum(len(names) for names in columns.values())}\n")
+
+    print("Computing the outputs...")
+    output, _, indexed_trees = dask.compute(output, writes, indexed_trees)
+    return selector.postprocess(output), indexed_trees
+
+def run_file_job(selector_class, base_cfg, job, fw_dir, stage_cache=None, merge_into="",
+                 events_forms=None):
+    """
+    Process one input file and write its status file.
+    The output is saved, unless merge_into is given; then it is returned with the
+    input file, which the caller closes once the merged output is written, and
+    the status is completed then.
+    """
+    tree_cfg = file_cfg(base_cfg, job)
+    tree_cfg["status_file"] = open_status_file(fw_dir, job["input"], shard_tag(job))
+    tree_cfg["checkpoint"] = job_checkpoint(fw_dir, job, selector_class)
+    try:
+        indexed_trees = []
+        if tree_cfg.get("dask") is not None:
+            # The step trees are written by the dask workers
+            output, indexed_trees = run_dask(selector_class, tree_cfg)
+        else:
+            output = process_file(selector_class, tree_cfg, stage_cache, events_forms)
+        tree_cfg["status_file"].write(f"Peak RSS: {pipeline.format_size(pipeline.peak_rss())}\n")
+        if merge_into:
+            tree_cfg["status_file"].write(f"Merging into: {merge_into}\n")
+            return output, tree_cfg.pop("input_file")
+        save_outputs(output, tree_cfg, indexed_trees)
+        tree_cfg["status_file"].write("SELECTION COMPLETED\n")
+        tree_cfg["checkpoint"].finish()
+        return None
+    except Exception as e:
+        # Print exception in status file
+        tree_cfg["status_file"].write("FAILED:\n")
+        tree_cfg["status_file"].write(str(e) + "\n")
+        raise e
+    finally:
+        tree_cfg["status_file"].close()
+        # The input file of a merged output is returned to the caller, merged
+        # outputs may still read from it until they are written
+        if "input_file" in tree_cfg:
+            tree_cfg["input_file"].close()
+        if stage_cache is not None:
+            stage_cache.release(job["input"])
+
+def save_trees(output, tree_cfg, indexed_trees=()):
+    """
+    Store the output trees per channel, and the index of their events together
+    with the indexed_trees written elsewhere (partitions of the dask mode).
+    """
+    indexed_trees = list(indexed_trees)
+    # The channels are a set, they are sorted so the files are always written in
+    # the same order
+    for chan in sorted(output["channels"]):
+        chan_file = channel_file(tree_cfg['tag'], chan)
+        with uproot.recreate(f"{chan_file}.root") as fout:
+            print(f"Saving final tree {chan}...")
+
+            if tree_cfg["output"].get("mode", "snapshot") == "friend":
+                # Input file the friend trees are joined to
+                fout["sourceFile"] = tree_cfg["source_file"]
+
+            if output["weightedEvents"] is not None:
+                for key, histo in output["weightedEvents"].items():
+                    print(f"Saving weightedEvents histogram: {key}")
+                    fout[key] = histo
+
+            for key, array in output["tree"][chan].items():
+                print(f"Saving branch: {key}")
+                if "cutflow" in key or "onecut" in key:
+                    fout[key] = array
+                    continue
+                if not array:
+                    print(f"WARNING: Branch {key} is empty. Skipping...")
+                    continue
+                try:
+                    # fout[key] = array
+                    write_tree(fout, key, dict(array), tree_cfg["output"], tree_cfg["dtypes"])
+                    indexed_trees.append((f"{chan_file}.root", key, array))
+                except Exception as e:
+                    print(f"ERROR: Could not save branch {key}. Error: {e}")
+                    print(array)
+                    raise e
+
+            for key, array in output["tree"].items():
+                if key in output["channels"]:
+                    continue
+                print(f"Saving branch: {key}")
+                if not array:
+                    print(f"WARNING: Branch {key} is empty. Skipping...")
+                    continue
+
+                try:
+                    fout[key] = array
+                except Exception as e:
+                    print(f"ERROR: Could not save branch {key}. Error: {e}")
+                    print(array)
+                    raise e
+
+        print(f"Saved final tree: {chan_file}.root")
+        tree_cfg["status_file"].write(
+            f"Saved final tree for channel {chan}: {chan_file}.root\n")
+
+    index_file = tree_cfg['tag'].replace('<chan>/', '') + INDEX_EXTENSION
+    index = EventIndex.from_trees(indexed_trees)
+    index.save(index_file)
+    tree_cfg["status_file"].write(f"Saved event index ({len(index)} entries): {index_file}\n")
+
+def save_histograms(output, tree_cfg):
+    """
+    Store the output histograms of the job in a single container, with the
+    channel wise histograms named "<chan>/<histogram>". The cutflows and the
+    weightedEvents histograms are stored as well.
+    """
+    histograms = {}
+    for histo_name, histo in output["histograms"].items():
+        if histo_name in output["channels"]:
+            for chan_histo_name, chan_histo in histo.items():
+                histograms[f"{histo_name}/{chan_histo_name}"] = chan_histo
+        else:
+            histograms[histo_name] = histo
+    for chan in sorted(output["channels"]):
+        for key, value in output.get("tree", {}).get(chan, {}).items():
+            if "cutflow" in key or "onecut" in key:
+                histograms[f"{chan}/{key}"] = value
+    for key, histo in (output["weightedEvents"] or {}).items():
+        histograms[f"weightedEvents/{key}"] = histo
+
+    histo_file = tree_cfg['hist_tag'].replace('<chan>/', '') + EXTENSION
+    print(f"Saving {len(histograms)} histograms...")
+    write_container(histo_file, histograms)
+    tree_cfg["status_file"].write(f"Saved {len(histograms)} histograms: {histo_file}\n")
+
+def save_outputs(output, tree_cfg, indexed_trees=()):
+    """Store trees and histograms of an output."""
+    if "tree" in output:
+        save_trees(output, tree_cfg, indexed_trees)
+    if "histograms" in output:
+        save_histograms(output, tree_cfg)
+
+def heartbeat(queue_path, job_id, interval, stop):
+    """Update the heartbeat of a running job every interval seconds until stop is set."""
+    queue = JobQueue(queue_path)
+    while not stop.wait(interval):
+        queue.beat(job_id)
+    queue.close()
+
+def worker_loop(worker, selector_class, fw_config, args):
+    """
+    Process jobs from the queue until it stays empty for args.idle_timeout seconds.
+    The heartbeat of the running job is updated by a thread, jobs of crashed workers
+    are requeued after args.stale_timeout seconds without one.
+    """
+    queue = JobQueue(args.serve)
+    stage_cache = staging.from_main_config(fw_config)
+    events_forms = form_cache.from_main_config(fw_config)
+    file_metadata = preprocess_cache.from_main_config(fw_config)
+    idle_since = time.time()
+    while True:
+        job = queue.claim(worker, args.stale_timeout)
+        if job is None:
+            if time.time() - idle_since >= args.idle_timeout:
+                print(f"[{worker}] Queue empty, exiting.")
+                break
+            time.sleep(args.poll)
+            continue
+        print(f"[{worker}] Processing job {job['id']}: {job['input']}")
+        job_args = argparse.Namespace(metadata=parse_metadata(job["metadata"]),
+                                      output_format=args.output_format)
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, daemon=True,
+                                args=(args.serve, job["id"], args.stale_timeout / 10 or 60, stop))
+        beat.start()
+        try:
+            base_cfg = load_cfg(fw_config["fw_dir"], job_args)
+            base_cfg["preselection_cache"] = preselection_cache.from_main_config(fw_config)
+            base_cfg["parquet_cache"] = parquet_cache.from_main_config(fw_config)
+            base_cfg["file_metadata"] = file_metadata
+            base_cfg["pipeline"] = pipeline_cfg(args, fw_config)
+            run_file_job(selector_class, base_cfg, job, fw_config["fw_dir"], stage_cache,
+                         events_forms=events_forms)
+            queue.finish(job["id"], "done")
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f"[{worker}] ERROR: Job {job['id']} failed: {e}")
+            queue.finish(job["id"], "failed", str(e))
+        finally:
+            stop.set()
+            beat.join()
+        idle_since = time.time()
+    if stage_cache is not None:
+        stage_cache.close()
+    queue.close()
+
+def serve(args, fw_config):
+    """
+    Warm worker mode. The selector and corrections are loaded once and the workers
+    are forked from this state. No input is opened before forking, so the parent has
+    no threads or file handles to share; each worker compiles the numba kernels on
+    its first job.
+    """
+    print("Loading processor...")
+    selector_class = load_processor(fw_config)
+
+    queue = JobQueue(args.serve)
+    eras = {parse_metadata(metadata).get("era", "") for metadata in queue.pending_metadata()}
+    queue.close()
+    preload_corrections(fw_config["fw_dir"] + "/data", eras)
+
+    hostname = socket.gethostname()
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=worker_loop,
+                        args=(f"{hostname}:{i}", selector_class, fw_config, args))
+        for i in range(1, args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    worker_loop(f"{hostname}:0", selector_class, fw_config, args)
+    for worker in workers:
+        worker.join()
 
 def parse_args():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Make tree in a slurm job (selection)")
-    parser.add_argument("input", type=str, help="Input NanoAOD file")
+    parser.add_argument("input", type=str, nargs="?", default="",
+                        help="Input NanoAOD file, file list (.txt) or manifest (.json)")
     parser.add_argument("--output", type=str, help="Output tree tag", default="")
     parser.add_argument("--output_histos", type=str, help="Output histograms tag", default="")
     parser.add_argument("--metadata", type=str, default="", help="Metadata file (default: empty)")
+    parser.add_argument("--output_format", type=str, default="", choices=[""] + OUTPUT_FORMATS,
+                        help="Format of the output trees (default: from output.yml)")
+    parser.add_argument("--entry_start", "--entry-start", type=int, default=0,
+                        help="First entry of the input file to process (default: 0)")
+    parser.add_argument("--entry_stop", "--entry-stop", type=int, default=None,
+                        help="Entry after the last one to process (default: end of file)")
+    parser.add_argument("--chunk_size", type=int, default=None,
+                        help="Entries processed at once, the next chunk is read while the "
+                             "current one is processed (default: chunk_size of main.cfg, "
+                             "0 for the whole file)")
+    parser.add_argument("--max_rss", "--max-rss", type=str, default=None,
+                        help="Memory budget, e.g. 4G; the chunk size is adapted to it "
+                             "(default: max_rss of main.cfg, empty for fixed chunks)")
+    parser.add_argument("--prefetch", type=int, default=1,
+                        help="Chunks read ahead of the processed one (default: 1)")
+    parser.add_argument("--decompression_workers", type=int, default=4,
+                        help="Threads decompressing the branches of a chunk (default: 4)")
+    parser.add_argument("--dask_scheduler", "--dask-scheduler", type=str, default=None,
+                        help="Run in dask mode on this scheduler, 'local' for a local "
+                             "cluster or the address of a scheduler (default: "
+                             "dask_scheduler of main.cfg, empty for no dask)")
+    parser.add_argument("--merge", action="store_true",
+                        help="Merge the outputs of all input files into --output/--output_histos")
+    parser.add_argument("--serve", type=str, default="",
+                        help="Run as a warm worker taking jobs from this SQLite queue")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes in --serve mode (default: 1)")
+    parser.add_argument("--poll", type=float, default=10.0,
+                        help="Seconds between queue polls in --serve mode (default: 10)")
+    parser.add_argument("--idle_timeout", type=float, default=0.0,
+                        help="Seconds an empty queue is polled before exiting (default: 0)")
+    parser.add_argument("--stale_timeout", type=float, default=600.0,
+                        help="Seconds without heartbeat after which a running job is "
+                             "requeued in --serve mode, 0 to never requeue (default: 600)")
     return parser.parse_args()
 
-def main(input_file=None, output="", output_histos="", metadata=None) -> None:
+def main(input_file=None, output="", output_histos="", metadata=None,
+         output_format="", merge=False, entry_start=0, entry_stop=None,
+         chunk_size=None, max_rss=None, dask_scheduler=None) -> None:
     """Main function to run the user processor.
-    
+
     Args:
-        input_file: Input NanoAOD file path (required if not using command line args)
-        output: Output tree tag
-        output_histos: Output histograms tag
+        input_file: Input NanoAOD file path, file list (.txt) or manifest (.json)
+            (required if not using command line args)
+        output: Output tree tag (directory for file lists)
+        output_histos: Output histograms tag (directory for file lists)
         metadata: Metadata dict or string (comma-separated key:value pairs)
+        output_format: Format of the output trees, "ttree" or "rntuple"
+        merge: Whether the outputs of all input files are merged
+        entry_start: First entry of the input file to process
+        entry_stop: Entry after the last one to process (None for the end of the file)
+        chunk_size: Entries processed at once (None for chunk_size of main.cfg)
+        max_rss: Memory budget such as "4G" (None for max_rss of main.cfg)
+        dask_scheduler: Scheduler of the dask mode, "local" or an address
+            (None for dask_scheduler of main.cfg)
     """
     if input_file is None:
         args = parse_args()
     else:
-        args = argparse.Namespace(input=input_file, output=output, output_histos=output_histos, metadata=metadata)
-
-    args.metadata = args.metadata.split(",") if args.metadata else []
+        args = argparse.Namespace(input=input_file, output=output, output_histos=output_histos,
+                                  metadata=metadata, output_format=output_format, merge=merge,
+                                  entry_start=entry_start, entry_stop=entry_stop, serve="",
+                                  chunk_size=chunk_size, max_rss=max_rss,
+                                  dask_scheduler=dask_scheduler)
 
-    args.metadata = {item.split(":")[0]: item.split(":")[1]
-                    for item in args.metadata} if args.metadata != [] else {}
     fw_config = utils.parse_main_config()
+    if args.serve != "":
+        serve(args, fw_config)
+        return
+    if args.input == "":
+        raise ValueError("An input file is required unless running with --serve.")
+    if (args.entry_start or args.entry_stop is not None) and \
+            args.input.endswith((".txt", ".json")):
+        raise ValueError("--entry_start/--entry_stop apply to a single input file, "
+                         "give the entry ranges of a manifest in its entries.")
 
-    tree_cfg = load_cfg(fw_config["fw_dir"], args)
+    args.metadata = parse_metadata(args.metadata)
+    base_cfg = load_cfg(fw_config["fw_dir"], args)
+    jobs = load_jobs(args)
+    if args.merge and (args.output == "" or args.output_histos == ""):
+        raise ValueError("--merge requires --output and --output_histos.")
+    if args.merge and base_cfg["output"].get("mode", "snapshot") == "friend":
+        raise ValueError("Friend trees are written per input file, --merge is not supported.")
+    # Run the selector as a dask task graph if a scheduler is configured
+    base_cfg["dask"] = dask_cluster.dask_cfg(fw_config, args.dask_scheduler)
+    if base_cfg["dask"] is not None:
+        if args.merge:
+            raise ValueError("The dask mode writes the step trees per partition, --merge is "
+                             "not supported; merge them with merge_trees.py.")
+        if base_cfg["output"].get("mode", "snapshot") == "friend" or \
+                base_cfg["output"].get("format", "ttree") != "ttree":
+            raise ValueError("The dask mode writes snapshot TTrees only.")
 
-    status_path = fw_config["fw_dir"] + "/selection_status/" + \
-        args.input.split("/")[-1].replace(".root", "_status.out")
-    if not os.path.exists(fw_config["fw_dir"] + "/selection_status"):
-        os.makedirs(fw_config["fw_dir"] + "/selection_status")
-    tree_cfg["status_file"] = open(status_path, "w", encoding="utf-8")
-    tree_cfg["status_file"].write(f"Processing file: {args.input}\n")
+    # Read from a node-local copy if staging is configured in main.cfg,
+    # the dask workers read the input files themselves
+    stage_cache = staging.from_main_config(fw_config) if base_cfg["dask"] is None else None
+    # Reuse the NanoEvents form per dataset if form_cache_dir is set in main.cfg
+    events_forms = form_cache.from_main_config(fw_config)
+    # Reuse the pre_selection outputs if preselection_cache_dir is set in main.cfg
+    base_cfg["preselection_cache"] = preselection_cache.from_main_config(fw_config)
+    # Read the converted files from parquet_cache_dir of main.cfg
+    base_cfg["parquet_cache"] = parquet_cache.from_main_config(fw_config)
+    # Reuse the entries of the input files if preprocess_cache_dir is set in main.cfg
+    base_cfg["file_metadata"] = preprocess_cache.from_main_config(fw_config)
+    # Process the files in chunks, reading ahead, if chunk_size or max_rss is set
+    base_cfg["pipeline"] = pipeline_cfg(args, fw_config)
 
+    # Load user processor (once for all files)
+    print("Loading processor...")
+    selector_class = load_processor(fw_config)
+
+    client = dask_cluster.start_client(base_cfg["dask"]) if base_cfg["dask"] is not None \
+        else None
+    outputs = []
+    # Input files of the merged outputs, open until the outputs are written
+    merged_inputs = []
+    failed = []
     try:
-        # Load user processor
-        print("Loading processor...")
-        selector_class = load_processor(fw_config)
-
-        events = NanoEventsFactory.from_root(
-            {args.input: "Events"},
-            schemaclass=NanoAODSchema,
-            metadata={}
-        ).events()
-
-        selector = selector_class(tree_cfg)
-        output = selector.process(events)
-        print("Processing events...")
-
-        # print(output)
-        # store outputs per channel
-        for chan in output["channels"]:
-            chan_file = tree_cfg['tag'].replace('<chan>/',f'{chan}/')
-            filename = chan + "_" + chan_file.split('/')[-1].replace('.root','')
-            chan_file = '/'.join(chan_file.split('/')[:-1]) + '/' + filename
-            with uproot.recreate(f"{chan_file}.root") as fout:
-                print(f"Saving final tree {chan}...")
-
-                if output["weightedEvents"] is not None:
-                    for key, histo in output["weightedEvents"].items():
-                        print(f"Saving weightedEvents histogram: {key}")
-                        fout[key] = histo
-
-                for key, array in output["tree"][chan].items():
-                    print(f"Saving branch: {key}")
-                    if "cutflow" in key or "onecut" in key:
-                        fout[key] = array
-                        continue
-                    if not array:
-                        print(f"WARNING: Branch {key} is empty. Skipping...")
-                        continue
-                    try:
-                        # fout[key] = array
-                        fout.mktree(key, array)
-                    except Exception as e:
-                        print(f"ERROR: Could not save branch {key}. Error: {e}")
-                        print(array)
-                        raise e
-
-                for key, array in output["tree"].items():
-                    if key in output["channels"]:
-                        continue
-                    print(f"Saving branch: {key}")
-                    if not array:
-                        print(f"WARNING: Branch {key} is empty. Skipping...")
-                        continue
-
-                    try:
-                        fout[key] = array
-                    except Exception as e:
-                        print(f"ERROR: Could not save branch {key}. Error: {e}")
-                        print(array)
-                        raise e
-
-            print(f"Saved final tree: {chan_file}.root")
-            tree_cfg["status_file"].write(
-                f"Saved final tree for channel {chan}: {chan_file}.root\n")
+        for idx, job in enumerate(jobs):
+            if stage_cache is not None:
+                stage_cache.prefetch([next_job["input"] for next_job in jobs[idx+1:]],
+                                     {next_job["input"]: next_job.get("adler32")
+                                      for next_job in jobs[idx+1:]})
+            try:
+                output = run_file_job(selector_class, base_cfg, job, fw_config["fw_dir"],
+                                      stage_cache, merge_into=args.output if args.merge else "",
+                                      events_forms=events_forms)
+                if args.merge:
+                    output, merged_input = output
+                    merged_inputs.append(merged_input)
+                    outputs.append(output)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                if len(jobs) == 1:
+                    raise e
+                print(f"ERROR: Processing of {job['input']} failed: {e}")
+                failed.append(job["input"])
 
-        if "histograms" in output:
-            # Saving not channel wise histograms
-            for histo_name, histo in output["histograms"].items():
-                if histo_name in output["channels"]:
+        if args.merge and outputs:
+            merged_cfg = file_cfg(base_cfg, {"input": jobs[0]["input"], "output": args.output,
+                                             "output_histos": args.output_histos})
+            merged_cfg["status_file"] = open_status_file(
+                fw_config["fw_dir"], args.output.replace("<chan>/", "") + ".root")
+            merged_cfg["status_file"].write(
+                "Merged files:\n" + "".join(f"{job['input']}\n" for job in jobs
+                                            if job["input"] not in failed))
+            save_outputs(merge_outputs(outputs), merged_cfg)
+            merged_cfg["status_file"].write("SELECTION COMPLETED\n")
+            merged_cfg["status_file"].close()
+            for job in jobs:
+                if job["input"] in failed:
                     continue
-                print(f"Saving histogram: {histo_name}")
-                histo_file = tree_cfg['hist_tag'].replace('<chan>/', '')
-                save(histo, f"{histo_file}_{histo_name}.coffea")
-                tree_cfg["status_file"].write(
-                    f"Saved histogram {histo_name}: {histo_file}_{histo_name}.coffea\n")
-
-            # Saving channel wise histograms
-            for chan in output["channels"]:
-                histo_file = tree_cfg['hist_tag'].replace('<chan>/', f'{chan}/')
-                filename = chan + "_" + histo_file.split('/')[-1]
-                histo_file = '/'.join(histo_file.split('/')[:-1]) + '/' + filename
-                for histo_name, histo in output["histograms"][chan].items():
-                    print(f"Saving histogram for channel {chan}: {histo_name}")
-                    save(histo, f"{histo_file}_{histo_name}.coffea")
-                    tree_cfg["status_file"].write(
-                        f"Saved histogram for channel {chan}: {histo_file}_{histo_name}.coffea\n")
-
-        tree_cfg["status_file"].write("SELECTION COMPLETED\n")
-        tree_cfg["status_file"].close()
+                with open(status_path(fw_config["fw_dir"], job["input"], shard_tag(job)), "a",
+                          encoding="utf-8") as status_file:
+                    status_file.write("SELECTION COMPLETED\n")
+                job_checkpoint(fw_config["fw_dir"], job, selector_class).finish()
+    finally:
+        for merged_input in merged_inputs:
+            merged_input.close()
+        if stage_cache is not None:
+            stage_cache.close()
+        if client is not None:
+            client.close()
 
-    except Exception as e:
-        # Print exception in status file
-        tree_cfg["status_file"].write("FAILED:\n")
-        tree_cfg["status_file"].write(str(e) + "\n")
-        tree_cfg["status_file"].close()
-        raise e
+    if failed:
+        raise RuntimeError(f"Processing failed for {len(failed)}/{len(jobs)} files: {failed}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,112 @@
+"""
+Mergeable outputs of the selection processors.
+The output of SelectionProcessor.process is an accumulator in the sense of
+coffea.processor.accumulate: step trees are TreeColumns, cutflows and
+weightedEvents are hist histograms and the channels are a set (sorted wherever they
+are iterated, the order of a set depends on the hash seed). The outputs of
+chunks processed by run_processor or by a coffea Runner executor are merged
+with merge_outputs, in any order, into the output of the whole file.
+"""
+from collections.abc import Mapping
+import awkward as ak
+from coffea.processor import accumulate
+from selection.selection_utils import cutflow_efficiencies
+
+class TreeColumns(Mapping):
+    """
+    Branches of a step tree (branch name -> awkward array) of one or more chunks.
+    Adding two TreeColumns concatenates their branches; the chunks are ordered by
+    their key, (file, first entry), so the result does not depend on the order in
+    which the chunk outputs are merged.
+    """
+    def __init__(self, branches=None, key=()):
+        """Initialize the tree of a chunk from the output of make_snapshot."""
+        self._parts = [(key, dict(branches))] if branches else []
+        self._merged = None
+
+    def _branches(self):
+        """Branches of all parts, concatenated on first access."""
+        if self._merged is None:
+            parts = [branches for _, branches in sorted(self._parts, key=lambda part: part[0])]
+            if not parts:
+                self._merged = {}
+            elif len(parts) == 1:
+                self._merged = parts[0]
+            else:
+                self._merged = {name: ak.concatenate([part[name] for part in parts])
+                                for name in parts[0]}
+        return self._merged
+
+    def __getitem__(self, name):
+        return self._branches()[name]
+
+    def __iter__(self):
+        return iter(self._branches())
+
+    def __len__(self):
+        return len(self._branches())
+
+    def __add__(self, other):
+        merged = TreeColumns()
+        merged._parts = self._parts + other._parts # pylint: disable=protected-access
+        return merged
+
+    def __iadd__(self, other):
+        self._parts = self._parts + other._parts # pylint: disable=protected-access
+        self._merged = None
+        return self
+
+    def __repr__(self):
+        return f"TreeColumns({len(self._parts)} chunks, branches={list(self)})"
+
+    def materialize(self):
+        """
+        Copy of the tree with its virtual arrays read into memory. The behaviors of
+        the events are dropped, the outputs of Runner workers are sent back pickled.
+        """
+        materialized = TreeColumns()
+        materialized._parts = [ # pylint: disable=protected-access
+            (key, {name: ak.Array(ak.materialize(array).layout)
+                   for name, array in branches.items()})
+            for key, branches in self._parts]
+        return materialized
+
+def materialize_output(output):
+    """Read the virtual arrays of the step trees of an output into memory."""
+    for chan_trees in output.get("tree", {}).values():
+        for key, value in chan_trees.items():
+            if isinstance(value, TreeColumns):
+                chan_trees[key] = value.materialize()
+    return output
+
+def is_efficiency(key):
+    """Whether an entry of a channel tree is an efficiency histogram, which cannot be summed."""
+    return "efficiency" in key
+
+def without_efficiencies(output):
+    """Shallow copy of an output without the efficiency histograms of the channel trees."""
+    if "tree" not in output:
+        return output
+    output = dict(output)
+    output["tree"] = {chan: {key: value for key, value in chan_tree.items()
+                             if not is_efficiency(key)}
+                      for chan, chan_tree in output["tree"].items()}
+    return output
+
+def add_efficiencies(output):
+    """Compute the efficiency histograms of every cutflow of the channel trees."""
+    for chan_tree in output.get("tree", {}).values():
+        steps = [key[len("cutflow_"):] for key in chan_tree
+                 if key.startswith("cutflow_") and not key.startswith("cutflow_unweighted_")
+                 and not is_efficiency(key)]
+        for step_name in steps:
+            chan_tree.update(cutflow_efficiencies(chan_tree, step_name))
+    return output
+
+def merge_outputs(outputs):
+    """
+    Merge the outputs of several chunks or files processed with the same selector.
+    Step trees are concatenated, cutflows and weightedEvents are summed and
+    the cutflow efficiencies are recomputed from the summed cutflows.
+    """
+    return add_efficiencies(accumulate(without_efficiencies(output) for output in outputs))
@@ -0,0 +1,172 @@
+"""
+Local cache of the pre_selection outputs of a selector.
+The columns added or modified by pre_selection, and the masks of the attributes
+the selector declares in preselection_state (channels, ...), are stored as Parquet
+per input file and entry range. Later runs with the same pre_selection code and
+configuration load them instead of running pre_selection. The Parquet columns do not
+keep the NanoEvents cross-references of the collections, so selectors only opt in
+if event_selection does not rely on them for the collections pre_selection modifies.
+"""
+import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+import types
+import awkward as ak
+
+# Per-file entries of the processor configuration that do not affect pre_selection
+VOLATILE_KEYS = ["tag", "hist_tag", "file", "adler32", "status_file", "input_file", "source_file",
+                 "preselection_cache", "parquet_cache", "file_metadata", "pipeline", "checkpoint",
+                 "dask",
+                 "nEntriesBeforeSelection", "structure", "dtypes", "output"]
+# Prefix of the columns holding the masks of the preselection_state attributes
+STATE_PREFIX = "__state__"
+
+def source_files(func, fw_dir):
+    """
+    Source files of a function and of the framework modules and functions it refers to.
+    """
+    files = {inspect.getsourcefile(func)}
+    for value in func.__globals__.values():
+        if isinstance(value, types.ModuleType):
+            path = getattr(value, "__file__", None)
+        elif inspect.isfunction(value) or inspect.isclass(value):
+            module = sys.modules.get(value.__module__)
+            path = getattr(module, "__file__", None)
+        else:
+            continue
+        if path is not None and os.path.abspath(path).startswith(os.path.abspath(fw_dir)):
+            files.add(path)
+    return sorted(files)
+
+def code_hash(processor):
+    """Hash of the pre_selection methods of the processor class and the modules they use."""
+    digest = hashlib.sha256()
+    for cls in type(processor).__mro__:
+        if "pre_selection" not in vars(cls):
+            continue
+        func = vars(cls)["pre_selection"]
+        digest.update(inspect.getsource(func).encode("utf-8"))
+        for path in source_files(func, processor.cfg.get("fw_dir", "")):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def config_hash(cfg):
+    """
+    Hash of the configuration entries that can be used by pre_selection, and of
+    the correction configurations in data/Corrections.
+    """
+    digest = hashlib.sha256()
+    for key, value in sorted(cfg.items()):
+        if key in VOLATILE_KEYS:
+            continue
+        try:
+            digest.update(json.dumps({key: value}, sort_keys=True).encode("utf-8"))
+        except TypeError:
+            # objects (file handles, caches, ...) are not part of the configuration
+            continue
+    corrections = os.path.join(cfg.get("data_dir", ""), "Corrections", "*", "*.yml")
+    for path in sorted(glob.glob(corrections)):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class PreselectionCache:
+    """Directory of cached pre_selection outputs."""
+    def __init__(self, cache_dir):
+        """Initialize the cache in cache_dir."""
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, processor, n_events):
+        """
+        Cache key of a pre_selection run: input file, entry range, code and config hashes.
+        """
+        cfg = processor.cfg
+        # (file, first entry) of the processed chunk
+        source_file, entry_start = processor.chunk_key
+        items = {
+            "file": source_file,
+            "entry_start": entry_start,
+            "entry_stop": None if cfg.get("entry_stop") is None else int(cfg["entry_stop"]),
+            "n_events": n_events,
+            "state": list(processor.preselection_state),
+            "code": code_hash(processor),
+            "config": config_hash(cfg),
+        }
+        return hashlib.sha256(json.dumps(items, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        """Path of the cached columns of a key."""
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def load(self, key):
+        """
+        Cached pre_selection output of a key.
+
+        Returns:
+            :return: (columns, state) or None if not cached, state is a dict of
+                     attribute name -> dict of masks
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            array = ak.from_parquet(path)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            print(f"WARNING: Could not read pre_selection cache {path} ({e}).")
+            return None
+        columns, state = {}, {}
+        for field in array.fields:
+            if field.startswith(STATE_PREFIX):
+                attribute, _, name = field[len(STATE_PREFIX):].partition(":")
+                state.setdefault(attribute, {})[name] = array[field]
+            else:
+                columns[field] = array[field]
+        return columns, state
+
+    def store(self, key, columns, state):
+        """
+        Write the pre_selection output of a key (atomically). state is a dict of
+        attribute name -> dict of per-event masks.
+        """
+        array = dict(columns)
+        for attribute, masks in state.items():
+            if not isinstance(masks, dict):
+                raise TypeError(f"preselection_state attribute {attribute} must be a dict "
+                                f"of per-event masks, got {type(masks).__name__}.")
+            array.update({f"{STATE_PREFIX}{attribute}:{name}": mask
+                          for name, mask in masks.items()})
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        ak.to_parquet(ak.zip(array, depth_limit=1), tmp_path)
+        os.replace(tmp_path, path)
+
+def changed_fields(before, events):
+    """
+    Top-level fields of events that are new or differ from the forms in before.
+    Fields read from the input keep the form keys of their branches, so any
+    modified field has a different form.
+    """
+    fields = []
+    for field in events.fields:
+        form = events[field].layout.form
+        if field not in before or not form.is_equal_to(before[field], all_parameters=True,
+                                                       form_key=True):
+            fields.append(field)
+    return fields
+
+def from_main_config(main_config):
+    """
+    Create a PreselectionCache from the preselection_cache_dir key of main.cfg.
+
+    Returns:
+        :return: PreselectionCache, or None if preselection_cache_dir is empty
+    """
+    cache_dir = main_config.get("preselection_cache_dir", "")
+    if cache_dir == "":
+        return None
+    return PreselectionCache(cache_dir)
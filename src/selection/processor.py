@@ -1,17 +1,17 @@
 """
     Basic processor module for coffea framework.
 """
-import uproot
 import numpy as np
 import hist
 import awkward as ak
 import copy
-from uncertainties import ufloat
 from coffea import processor
 from coffea.analysis_tools import PackedSelection, Weights
-from selection.selection_utils import apply_golden_json, detector_defects_mask,\
-    make_weights_fields, make_snapshot
-from common.utils import convert_hist_to_uarray, convert_uarray_to_hist
+from common.file_context import NanoAODFile
+from selection.accumulators import TreeColumns, add_efficiencies, materialize_output
+from selection.preselection_cache import changed_fields
+from selection.selection_utils import add_source_index, apply_golden_json,\
+    detector_defects_mask, make_weights_fields, make_snapshot, source_fields
 
 class step:
     """
@@ -42,40 +42,83 @@ class step:
 
 class SelectionProcessor(processor.ProcessorABC):
     """Processor template for event selection and tree creation."""
+    # Runs branches summed into the weightedEvents histograms
+    runs_keys = ["genEventCount", "genEventSumw", "genEventSumw2"]
+    # Attributes set by pre_selection, as dicts of per-event masks, that the
+    # pre_selection cache stores with its columns. None: the selector does not use
+    # the cache (see cached_pre_selection)
+    preselection_state = None
+
     def __init__(self, selection_cfg, mode="eager"):
         """Initialize the selection processor with configuration."""
         assert mode in ["eager", "virtual", "dask"]
         self._mode = mode
-        self.cfg = selection_cfg
-        self.tree = {}
-        self.histograms = {}
+        self._cfg = selection_cfg
         self.initialize_non_ntuple()
         self.step_tag = ""
+        self.output_mode = "tree"
+        self._make_selection_histograms = True
+        self.ban_weights = []
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the per-chunk state (selection, channels, snapshots and the copy
+        of the configuration), so process can be called on any sequence of chunks.
+        """
+        self.cfg = dict(self._cfg)
+        self.tree = {}
+        self.histograms = {}
         self.channels = {}
         self.gen_channels = {}
         self.selector = PackedSelection()
         self.steps = {}
-        self.output_mode = "tree"
-        self._make_selection_histograms = True
-        self.ban_weights = []
+        # Fields of the input file, set in friend output mode
+        self.friend_of = None
+        # Ordering key of the snapshots of the chunk, (file, first entry)
+        self.chunk_key = ()
+        self.weighted_events = None
 
     def initialize_non_ntuple(self):
         """Initialize any non-ntuple data needed for processing"""
         self.mappings = {}
-        with uproot.open(self.cfg['file']) as f:
-            # for key in f["Mapping"].keys():
-            #     self.mappings[key] = f["Mapping"][key].array()
-
-            if self.cfg['isData'] == "False":
-                self.weighted_events = {}
-                for key in f["Runs"].keys():
-                    value = ak.sum(f["Runs"][key].array())
-                    self.weighted_events[key] = hist.Hist(hist.axis.Variable([0,1],
-                                                name="weightedEvents", label="weightedEvents"),
-                                                storage=hist.storage.Weight())
-                    self.weighted_events[key].fill([0.5], weight=[value])
+        # for key in f["Mapping"].keys():
+        #     self.mappings[key] = f["Mapping"][key].array()
+
+    def chunk_range(self, events):
+        """
+        Input file and first entry of the events, from the configuration of
+        run_processor or from the chunk metadata of a coffea Runner.
+        """
+        metadata = events.metadata or {}
+        if "entrystart" in metadata:
+            return metadata["filename"], int(metadata["entrystart"])
+        return self.cfg.get("source_file", self.cfg.get("file", "")), \
+            int(self.cfg.get("entry_start", 0))
+
+    def initialize_weighted_events(self, events):
+        """weightedEvents histograms of the Runs sums, counted by the chunk starting at entry 0."""
+        if self.cfg['isData'] != "False":
+            return {}
+        filename, entry_start = self.chunk_range(events)
+        if entry_start > 0:
+            # Entry-range shards and chunks: the Runs sums are counted by the first one only
+            sums = dict.fromkeys(self.runs_keys, 0.0)
+        else:
+            # Reuse the handle of the events file if run_processor opened it
+            input_file = self.cfg.get("input_file")
+            if input_file is None:
+                with NanoAODFile(filename) as f:
+                    sums = f.runs_sums(self.runs_keys)
             else:
-                self.weighted_events = None
+                sums = input_file.runs_sums(self.runs_keys)
+        weighted_events = {}
+        for key, value in sums.items():
+            weighted_events[key] = hist.Hist(hist.axis.Variable([0,1],
+                                    name="weightedEvents", label="weightedEvents"),
+                                    storage=hist.storage.Weight())
+            weighted_events[key].fill([0.5], weight=[value])
+        return weighted_events
     
     # def getWeightedEvents(self, events):
     #     """Obtains total weighted events manually"""
@@ -104,10 +147,11 @@ class SelectionProcessor(processor.ProcessorABC):
             for gen_channel, chan_mask in self.gen_channels.items():
                 if gen_channel not in self.tree:
                     self.tree[gen_channel] = {}
-                self.tree[gen_channel][self.step_tag+"step0"] = make_snapshot(
+                self.tree[gen_channel][self.step_tag+"step0"] = TreeColumns(make_snapshot(
                     events[chan_mask],
-                    self.cfg['structure'], empty_reco=True
-                )
+                    self.cfg['structure'], empty_reco=True,
+                    friend_of=self.friend_of
+                ), self.chunk_key)
 
     def make_snapshot(self, events, step_label, step_name="",
                     save_cutflow=False, cutflow_weight="eventWeight"):
@@ -117,12 +161,14 @@ class SelectionProcessor(processor.ProcessorABC):
                 self.tree[chan] = {}
             print(self.steps[step_label].mask_labels[chan])
             selected_events = events[self.selector.all(*self.steps[step_label].mask_labels[chan])]
-            self.tree[chan][self.step_tag + step_name] = make_snapshot(
+            self.tree[chan][self.step_tag + step_name] = TreeColumns(make_snapshot(
                 selected_events,
-                self.cfg['structure']
-            )
+                self.cfg['structure'],
+                friend_of=self.friend_of
+            ), self.chunk_key)
         if save_cutflow:
-            cf_weight = Weights(len(events))
+            # The number of events of a dask collection is not known before computing
+            cf_weight = Weights(None if self._mode == "dask" else len(events))
             cf_weight.add(cutflow_weight, events[cutflow_weight])
             for chan in self.channels:
                 cutflow_obj = self.selector.cutflow(*self.steps[step_label].mask_labels[chan],
@@ -130,39 +176,16 @@ class SelectionProcessor(processor.ProcessorABC):
                 onecut, cutflow, labels = cutflow_obj.yieldhist()
                 print(cutflow, labels)
                 print(cutflow.axes)
-                self.tree[chan]["cutflow_" + step_name] = copy.deepcopy(cutflow)
-                self.tree[chan]["onecut_" + step_name] = copy.deepcopy(onecut)
-                cutflow_eff = convert_uarray_to_hist(
-                    cutflow, convert_hist_to_uarray(cutflow) / ufloat(cutflow[0].value,
-                                                                    cutflow[0].variance**0.5)
-                )
-                onecut_eff = convert_uarray_to_hist(
-                    onecut, convert_hist_to_uarray(onecut) / ufloat(cutflow[0].value,
-                                                                    cutflow[0].variance**0.5)
-                )
-
-                self.tree[chan]["cutflow_efficiency_" + step_name] = cutflow_eff
-                self.tree[chan]["onecut_efficiency_" + step_name] = onecut_eff
+                self.tree[chan]["cutflow_" + step_name] = cutflow
+                self.tree[chan]["onecut_" + step_name] = onecut
 
                 cutflow_obj = self.selector.cutflow(*self.steps[step_label].mask_labels[chan])
                 onecut, cutflow, labels = cutflow_obj.yieldhist()
                 print(cutflow, labels)
                 print(cutflow.axes)
-                self.tree[chan]["cutflow_unweighted_" + step_name] = copy.deepcopy(cutflow)
-                self.tree[chan]["onecut_unweighted_" + step_name] = copy.deepcopy(onecut)
-                cutflow_eff = convert_uarray_to_hist(
-                    cutflow_eff, convert_hist_to_uarray(cutflow,
-                                                    poisson=True) / ufloat(cutflow[0],
-                                                                    cutflow[0]**0.5)
-                )
-                onecut_eff = convert_uarray_to_hist(
-                    onecut_eff, convert_hist_to_uarray(onecut,
-                                                    poisson=True) / ufloat(cutflow[0],
-                                                                    cutflow[0]**0.5)
-                )
-
-                self.tree[chan]["cutflow_efficiency_unweighted_" + step_name] = cutflow_eff
-                self.tree[chan]["onecut_efficiency_unweighted_" + step_name] = onecut_eff
+                self.tree[chan]["cutflow_unweighted_" + step_name] = cutflow
+                self.tree[chan]["onecut_unweighted_" + step_name] = onecut
+                # The efficiencies are computed in postprocess, from the summed cutflows
                 # self.tree[chan]["cutflow_labels_"+step_name] = labels
 
 
@@ -196,7 +219,20 @@ class SelectionProcessor(processor.ProcessorABC):
                                     parent=self.steps[parent], metadata=metadata)
 
     def process(self, events):
-        """ Main process """
+        """
+        Main process. Re-entrant: every call starts from a clean state and
+        returns an accumulator, so the outputs of the chunks of a file can be
+        merged with coffea.processor.accumulate (see selection.accumulators).
+        """
+        self.reset()
+        self.chunk_key = self.chunk_range(events)
+        self.weighted_events = self.initialize_weighted_events(events)
+
+        if self.cfg.get("output", {}).get("mode", "snapshot") == "friend":
+            # Only new columns are saved, keyed to the entries of the input file
+            self.friend_of = source_fields(events)
+            events = add_source_index(events)
+            events["entryIndex"] = np.arange(len(events)) + self.chunk_key[1]
 
         if self.cfg['isData'] == "True":
             # Golden JSON filtering for data
@@ -208,7 +244,7 @@ class SelectionProcessor(processor.ProcessorABC):
         # Get number of entries before selection
         self.cfg["nEntriesBeforeSelection"] = ak.num(events,axis=0)
 
-        events = self.pre_selection(events)
+        events = self.cached_pre_selection(events)
 
         # Compute weights for MC
         if self.cfg['isData'] == "False":
@@ -231,29 +267,84 @@ class SelectionProcessor(processor.ProcessorABC):
         #         self.histograms[chan]["onecut"] = yield_outputs[0]
         #         self.histograms[chan]["cutflow"] = yield_outputs[1]
 
+        if self.cfg.get("input_file") is None and self._mode != "dask":
+            # The input of a Runner chunk is closed after process, so the snapshots are
+            # read now; run_processor keeps its input open until the outputs are written
+            materialize_output({"tree": self.tree})
+
         if self.output_mode == "tree":
             return {
                 "tree": self.tree,
                 "weightedEvents": self.weighted_events,
-                "channels": list(self.channels.keys())
+                "channels": set(self.channels)
             }
         elif self.output_mode == "histogram":
             return {
                 "histograms": self.histograms,
                 "weightedEvents": self.weighted_events,
-                "channels": list(self.channels.keys())
+                "channels": set(self.channels)
             }
         elif self.output_mode == "both":
             return {
                 "tree": self.tree,
                 "histograms": self.histograms,
                 "weightedEvents": self.weighted_events,
-                "channels": list(self.channels.keys())
+                "channels": set(self.channels)
             }
         else:
             raise ValueError(f"Unsupported output mode: {self.output_mode}")
 
 
+    def cached_pre_selection(self, events):
+        """
+        Run pre_selection, or load its output from the pre_selection cache if
+        run_processor configured one and the code, config and input are unchanged.
+        Only selectors declaring preselection_state use the cache. A cache hit restores
+        the columns added or modified by pre_selection and the declared attributes,
+        the columns lose their NanoEvents cross-references (*Idx, matched_*). The
+        output is not cached if pre_selection sets other attributes or config entries.
+        """
+        cache = self.cfg.get("preselection_cache")
+        if cache is None or self._mode == "dask":
+            # The columns of a dask graph are only read when the outputs are computed
+            return self.pre_selection(events)
+        if self.preselection_state is None:
+            print(f"WARNING: {type(self).__name__} does not declare preselection_state, "
+                  "pre_selection is not cached.")
+            return self.pre_selection(events)
+
+        key = cache.key(self, len(events))
+        cached = cache.load(key)
+        if cached is not None:
+            print("Loading pre_selection output from cache...")
+            columns, state = cached
+            for name in self.preselection_state:
+                setattr(self, name, state.get(name, {}))
+            for field, column in columns.items():
+                events[field] = column
+            return events
+
+        n_events = len(events)
+        before = {field: events[field].layout.form for field in events.fields}
+        attributes, cfg = dict(vars(self)), dict(self.cfg)
+        events = self.pre_selection(events)
+        if len(events) != n_events:
+            print("WARNING: pre_selection removed events, its output is not cached.")
+            return events
+        undeclared = [name for name, value in vars(self).items()
+                      if name not in self.preselection_state
+                      and (name not in attributes or attributes[name] is not value)]
+        undeclared += [f"cfg[{key!r}]" for key, value in self.cfg.items()
+                       if key not in cfg or cfg[key] is not value]
+        if undeclared:
+            print(f"WARNING: pre_selection sets {', '.join(undeclared)}, which are not in "
+                  "preselection_state, its output is not cached.")
+            return events
+        columns = {field: events[field] for field in changed_fields(before, events)}
+        cache.store(key, columns, {name: getattr(self, name)
+                                   for name in self.preselection_state})
+        return events
+
     def event_selection(self, events):
         """User specified selection process to be implemented in subclasses"""
         return events
@@ -263,4 +354,5 @@ class SelectionProcessor(processor.ProcessorABC):
         return events
 
     def postprocess(self, accumulator):
-        pass
+        """Cutflow efficiencies of the merged output, which cannot be accumulated."""
+        return add_efficiencies(accumulator)
@@ -8,6 +8,7 @@ import vector
 import awkward as ak
 from coffea.lumi_tools import LumiMask
 from corrections.JME import veto_map
+from common.histo_ops import efficiency, values_variances
 
 def trailing_selection(leading_mask, subleading_mask, obj_var):
     """Apply leading and subleading masks to object variable."""
@@ -234,12 +235,64 @@ ops = {
     '~': operator.invert, # operator.not_
 }
 
-def make_snapshot(events, structure, empty_reco=False):
+FRIEND_INDEX = ["run", "luminosityBlock", "event", "entryIndex"]
+# Event identifiers, kept in the gen-level (empty_reco) snapshots
+EVENT_ID = ["run", "luminosityBlock", "event"]
+
+# Index of the objects of the input collections, added in friend mode so that the
+# collections filtered by the selector can be joined back to the input ones
+SOURCE_INDEX = "sourceIdx"
+
+def innermost_layout(layout):
+    """Layout holding the data of a list, indexed or option layout."""
+    while hasattr(layout, "content") and not isinstance(layout, ak.contents.RecordArray):
+        layout = layout.content
+    return layout
+
+def column_contents(array):
+    """
+    Innermost layout of every field of a collection, or of a plain branch (key
+    None). Selecting events or objects keeps these layouts, while fields added
+    or overwritten by the selector get new ones.
+    """
+    layout = innermost_layout(array.layout)
+    if not isinstance(layout, ak.contents.RecordArray):
+        return {None: layout}
+    return {field: innermost_layout(layout.content(field)) for field in layout.fields}
+
+def source_fields(events):
+    """Columns of each collection/branch of the input events, before any modification."""
+    return {field: column_contents(events[field]) for field in events.fields}
+
+def add_source_index(events):
+    """Number the objects of every collection of the input events (SOURCE_INDEX)."""
+    for field in events.fields:
+        if events[field].ndim > 1 and events[field].fields:
+            events[field, SOURCE_INDEX] = ak.local_index(events[field], axis=1)
+    return events
+
+def is_source_column(friend_of, array, field, subfield=None):
+    """
+    Whether a column of the events is the unmodified input column (friend_of from
+    source_fields).
+    """
+    source = friend_of.get(field, {})
+    return subfield in source and column_contents(array).get(subfield) is source[subfield]
+
+def make_snapshot(events, structure, empty_reco=False, friend_of=None):
     """
     Create a snapshot of the events based on the provided structure.
+    If friend_of (output of source_fields) is given, only the new columns are kept,
+    together with the event identifiers and the entry index in the source file.
+    The fields added or modified by the selector are new columns, and the
+    collections of the input are saved with the input index of their selected
+    objects (sourceIdx_<collection>), read back by output_formats.read_friend.
     """
     print("Creating snapshot...")
     minitree = {}
+    if friend_of is not None:
+        for field in FRIEND_INDEX:
+            minitree[field] = events[field]
     for key, value in structure.items():
         if value[-1] == ".":
             # Add entire collection
@@ -247,6 +300,11 @@ def make_snapshot(events, structure, empty_reco=False):
             if field in events.fields:
                 saved_obj = {}
                 for subfield in events[field].fields:
+                    if subfield == SOURCE_INDEX:
+                        continue
+                    if friend_of is not None and \
+                            is_source_column(friend_of, events[field], field, subfield):
+                        continue
                     if len(str(events[field][subfield].type).split("* var")) > 2:
                         print(f"WARNING: Subfield {subfield} in {field} has more than 2 var levels. Skipping...")
                         continue
@@ -255,15 +313,25 @@ def make_snapshot(events, structure, empty_reco=False):
                             ak.ones_like(events["event"]), float) * -999
                     else:
                         saved_obj[subfield] = events[field][subfield]
-                minitree[key] = ak.zip(saved_obj)
+                if friend_of is not None and field in friend_of and \
+                        SOURCE_INDEX in events[field].fields and \
+                        not (empty_reco and "gen" not in field):
+                    saved_obj[f"{SOURCE_INDEX}_{field}"] = events[field][SOURCE_INDEX]
+                if saved_obj:
+                    minitree[key] = ak.zip(saved_obj)
             else:
                 print(f"WARNING: Field {field} not found in events.")
         else:
             entry = value.split(".")
             entry.append(None)
             field, subfield = entry[:2]
+            # Objects of a collection are only aligned with the input through its index
+            if friend_of is not None and field in events.fields and \
+                    (subfield is None or events[field].ndim == 1) and \
+                    is_source_column(friend_of, events[field], field, subfield):
+                continue
             if field in events.fields:
-                if empty_reco and "gen" not in field:
+                if empty_reco and "gen" not in field and field not in EVENT_ID:
                     minitree[key] = ak.values_astype(ak.ones_like(events["event"]), float) * -999
                 else:
                     if subfield is None:
@@ -279,6 +347,31 @@ def make_snapshot(events, structure, empty_reco=False):
                 # minitree[key] = ak.values_astype(ak.ones_like(events["event"]), float) * -999
     return minitree
 
+def efficiency_hist(histogram, cutflow, poisson=False):
+    """
+    Efficiency of each bin of a cutflow/onecut histogram with respect to the
+    first bin of the cutflow, propagating the uncertainties.
+    """
+    values, variances = values_variances(cutflow, poisson=poisson)
+    return efficiency(histogram, (values[0], variances[0]), poisson=poisson)
+
+def cutflow_efficiencies(chan_tree, step_name):
+    """
+    Weighted and unweighted efficiency histograms for the cutflow and onecut
+    histograms of a step stored in a channel tree dictionary.
+    """
+    cutflow = chan_tree["cutflow_" + step_name]
+    cutflow_unweighted = chan_tree["cutflow_unweighted_" + step_name]
+    return {
+        "cutflow_efficiency_" + step_name: efficiency_hist(cutflow, cutflow),
+        "onecut_efficiency_" + step_name: efficiency_hist(
+            chan_tree["onecut_" + step_name], cutflow),
+        "cutflow_efficiency_unweighted_" + step_name: efficiency_hist(
+            cutflow_unweighted, cutflow_unweighted, poisson=True),
+        "onecut_efficiency_unweighted_" + step_name: efficiency_hist(
+            chan_tree["onecut_unweighted_" + step_name], cutflow_unweighted, poisson=True),
+    }
+
 def get_4vector_sum(obj1, obj2, corrected=False):
     """
     Returns the sum of two 4-vectors.